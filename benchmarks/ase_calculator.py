@@ -0,0 +1,89 @@
+'''Time per step of molecular dynamics of rattled bulk silicon with a model
+with random weights and the default hypers except for the width, with PETCalculator, which reuses
+the neighbor list within R_CUT + skin between rebuilds, and with
+SingleStructCalculator, which builds the neighbor list and the graph at every
+step. Also reports the fraction of steps with rebuilds of the neighbor list'''
+
+import time
+import argparse
+import tempfile
+import numpy as np
+import torch
+import ase.build
+import ase.calculators.calculator
+from ase import units
+from ase.md.verlet import VelocityVerlet
+from ase.md.velocitydistribution import MaxwellBoltzmannDistribution
+
+from pet import PETCalculator, SingleStructCalculator
+from pet.pet import PET, PETMLIPWrapper, PETUtilityWrapper
+from pet.hypers import load_hypers_from_file, save_hypers
+
+
+def save_model(path, d_model):
+    hypers = load_hypers_from_file('default_hypers/default_hypers.yaml')
+    ARCHITECTURAL_HYPERS = hypers.ARCHITECTURAL_HYPERS
+    ARCHITECTURAL_HYPERS.TRANSFORMER_D_MODEL = d_model
+    ARCHITECTURAL_HYPERS.TRANSFORMER_DIM_FEEDFORWARD = 4 * d_model
+    ARCHITECTURAL_HYPERS.HEAD_N_NEURONS = d_model
+    ARCHITECTURAL_HYPERS.D_OUTPUT = 1
+    ARCHITECTURAL_HYPERS.TARGET_TYPE = 'structural'
+    ARCHITECTURAL_HYPERS.TARGET_AGGREGATION = 'sum'
+    hypers.UTILITY_FLAGS.CALCULATION_TYPE = 'mlip'
+    save_hypers(hypers, f'{path}/hypers_used.yaml')
+    np.save(f'{path}/all_species.npy', np.array([14]))
+    np.save(f'{path}/self_contributions.npy', np.array([0.0]))
+    torch.manual_seed(0)
+    model = PETMLIPWrapper(PETUtilityWrapper(PET(ARCHITECTURAL_HYPERS, 0.0, 1), True), True, True)
+    torch.save(model.state_dict(), f'{path}/best_val_rmse_both_model_state_dict')
+
+
+class ForwardCalculator(ase.calculators.calculator.Calculator):
+    implemented_properties = ['energy', 'forces']
+
+    def __init__(self, calculator):
+        ase.calculators.calculator.Calculator.__init__(self)
+        self.calculator = calculator
+
+    def calculate(self, atoms = None, properties = ['energy'], system_changes = ase.calculators.calculator.all_changes):
+        ase.calculators.calculator.Calculator.calculate(self, atoms, properties, system_changes)
+        energy, forces = self.calculator.forward(self.atoms)
+        self.results['energy'] = float(energy[0])
+        self.results['forces'] = forces.astype(np.float64)
+
+
+def get_time_per_step(calculator, repeat, n_steps):
+    structure = ase.build.bulk('Si', cubic = True).repeat(repeat)
+    structure.rattle(0.05, seed = 0)
+    MaxwellBoltzmannDistribution(structure, temperature_K = 300, rng = np.random.RandomState(0))
+    structure.calc = calculator
+    dynamics = VelocityVerlet(structure, 1.0 * units.fs)
+    dynamics.run(1)
+    begin = time.time()
+    dynamics.run(n_steps)
+    return (time.time() - begin) / n_steps
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type = int, default = 1, help = "The conventional cubic cell is repeated this many times along each axis")
+    parser.add_argument("--d_model", type = int, default = 128, help = "TRANSFORMER_D_MODEL of the model; smaller models are dominated by preprocessing")
+    parser.add_argument("--skin", type = float, default = 0.5)
+    parser.add_argument("--n_steps", type = int, default = 50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        save_model(path, args.d_model)
+        single_struct_time = get_time_per_step(ForwardCalculator(SingleStructCalculator(path)), args.repeat, args.n_steps)
+        calculator = PETCalculator(path, skin = args.skin)
+        skin_time = get_time_per_step(calculator, args.repeat, args.n_steps)
+
+    print(f"{8 * args.repeat ** 3} atoms")
+    print(f"SingleStructCalculator: {1000 * single_struct_time:.1f} ms per step")
+    print(f"PETCalculator with skin {args.skin}: {1000 * skin_time:.1f} ms per step")
+    statistics = calculator.get_rebuild_statistics()
+    print(f"neighbor list rebuilt {statistics['n_rebuilds']} times in {statistics['n_evaluations']} evaluations")
+
+
+if __name__ == "__main__":
+    main()
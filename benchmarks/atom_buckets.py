@@ -0,0 +1,66 @@
+'''Compares the time of energies and forces for a batch of copper slabs
+with vacuum with atoms of each batch split into different numbers of 
+buckets by numbers of neighbors'''
+
+import time
+import argparse
+import torch
+import numpy as np
+from ase.build import fcc100, fcc110, fcc111
+
+from pet.pet import PET, PETMLIPWrapper, PETUtilityWrapper
+from pet.hypers import load_hypers_from_file
+from pet.molecule import PaddingCollater
+from pet.data_preparation import get_pyg_graphs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--r_cut", type = float, default = 5.0)
+    parser.add_argument("--n_atom_buckets", type = int, nargs = '+', default = [1, 2, 4, 8])
+    parser.add_argument("--vacuum", type = float, default = 10.0)
+    parser.add_argument("--n_repeat", type = int, default = 3)
+    args = parser.parse_args()
+
+    structures = []
+    for index, build in enumerate([fcc100, fcc110, fcc111]):
+        atoms = build('Cu', size = (3, 3, 5), vacuum = args.vacuum)
+        atoms.rattle(0.1, seed = index)
+        structures.append(atoms)
+    all_species = np.array([29])
+    graphs = get_pyg_graphs(structures, all_species, args.r_cut, False, False, None)
+    nums = np.concatenate([graph.nums.numpy() for graph in graphs])
+    print(f"number of atoms: {len(nums)}; numbers of neighbors from {int(np.min(nums))} to {int(np.max(nums))}, "
+          f"padding fraction: {1.0 - np.mean(nums) / np.max(nums):.3f}")
+
+    hypers = load_hypers_from_file('default_hypers/default_hypers.yaml')
+    ARCHITECTURAL_HYPERS = hypers.ARCHITECTURAL_HYPERS
+    ARCHITECTURAL_HYPERS.D_OUTPUT = 1
+    ARCHITECTURAL_HYPERS.TARGET_TYPE = 'structural'
+    ARCHITECTURAL_HYPERS.TARGET_AGGREGATION = 'sum'
+    ARCHITECTURAL_HYPERS.R_CUT = args.r_cut
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    batch = PaddingCollater(len(all_species))(graphs).to(device)
+
+    times = {}
+    for n_atom_buckets in args.n_atom_buckets:
+        ARCHITECTURAL_HYPERS.N_ATOM_BUCKETS = n_atom_buckets
+        model = PETMLIPWrapper(PETUtilityWrapper(PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species)), False),
+                               True, True).to(device)
+        model.eval()
+        model(batch, augmentation = False, create_graph = False)
+
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        begin = time.time()
+        for _ in range(args.n_repeat):
+            model(batch, augmentation = False, create_graph = False)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        times[n_atom_buckets] = (time.time() - begin) / args.n_repeat
+        print(f"N_ATOM_BUCKETS = {n_atom_buckets}: {times[n_atom_buckets]:.3f} s per energies and forces, "
+              f"speedup {times[args.n_atom_buckets[0]] / times[n_atom_buckets]:.2f}")
+
+
+if __name__ == "__main__":
+    main()
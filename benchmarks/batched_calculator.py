@@ -0,0 +1,75 @@
+'''Time of energies, forces and virials of a list of rattled images of bulk
+silicon, such as the images of NEB, with a model with random weights and the
+default hypers except for the width, evaluated one by one with
+SingleStructCalculator and with a single forward pass with BatchedCalculator'''
+
+import time
+import argparse
+import tempfile
+import numpy as np
+import torch
+import ase.build
+
+from pet import BatchedCalculator, SingleStructCalculator
+from pet.pet import PET, PETMLIPWrapper, PETUtilityWrapper
+from pet.hypers import load_hypers_from_file, save_hypers
+
+
+def save_model(path, d_model):
+    hypers = load_hypers_from_file('default_hypers/default_hypers.yaml')
+    ARCHITECTURAL_HYPERS = hypers.ARCHITECTURAL_HYPERS
+    ARCHITECTURAL_HYPERS.TRANSFORMER_D_MODEL = d_model
+    ARCHITECTURAL_HYPERS.TRANSFORMER_DIM_FEEDFORWARD = 4 * d_model
+    ARCHITECTURAL_HYPERS.HEAD_N_NEURONS = d_model
+    ARCHITECTURAL_HYPERS.D_OUTPUT = 1
+    ARCHITECTURAL_HYPERS.TARGET_TYPE = 'structural'
+    ARCHITECTURAL_HYPERS.TARGET_AGGREGATION = 'sum'
+    hypers.UTILITY_FLAGS.CALCULATION_TYPE = 'mlip'
+    save_hypers(hypers, f'{path}/hypers_used.yaml')
+    np.save(f'{path}/all_species.npy', np.array([14]))
+    np.save(f'{path}/self_contributions.npy', np.array([0.0]))
+    torch.manual_seed(0)
+    model = PETMLIPWrapper(PETUtilityWrapper(PET(ARCHITECTURAL_HYPERS, 0.0, 1), True), True, True)
+    torch.save(model.state_dict(), f'{path}/best_val_rmse_both_model_state_dict')
+
+
+def get_time(function, n_repeats):
+    function()
+    begin = time.time()
+    for _ in range(n_repeats):
+        function()
+    return (time.time() - begin) / n_repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_images", type = int, default = 15)
+    parser.add_argument("--repeat", type = int, default = 1, help = "The conventional cubic cell is repeated this many times along each axis")
+    parser.add_argument("--d_model", type = int, default = 128, help = "TRANSFORMER_D_MODEL of the model")
+    parser.add_argument("--n_repeats", type = int, default = 5)
+    args = parser.parse_args()
+
+    images = []
+    for index in range(args.n_images):
+        image = ase.build.bulk('Si', cubic = True).repeat(args.repeat)
+        image.rattle(0.05, seed = index)
+        images.append(image)
+
+    with tempfile.TemporaryDirectory() as path:
+        save_model(path, args.d_model)
+        single_struct_calculator = SingleStructCalculator(path, use_virials = True)
+        batched_calculator = BatchedCalculator(path, use_virials = True)
+
+    def run_single_struct():
+        for image in images:
+            single_struct_calculator.forward(image)
+
+    single_struct_time = get_time(run_single_struct, args.n_repeats)
+    batched_time = get_time(lambda: batched_calculator.forward(images), args.n_repeats)
+    print(f"{args.n_images} images of {8 * args.repeat ** 3} atoms")
+    print(f"SingleStructCalculator, one image at a time: {1000 * single_struct_time:.1f} ms")
+    print(f"BatchedCalculator, all the images in one batch: {1000 * batched_time:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+'''Time of the assembly of forces from the gradients with respect to the padded 
+vectors to neighbors, by assemble_forces with a single index_add over the actual 
+edges and by the former gather of the gradients of the reversed edges into a 
+second padded tensor, for batches of rattled bulk silicon mixed with methane 
+molecules, so that a large fraction of the padded tensors is padding. Includes 
+the backward pass, as needed for fitting forces'''
+
+import time
+import argparse
+import torch
+import ase.io
+import ase.build
+
+from pet.pet import assemble_forces
+from pet.molecule import PaddingCollater
+from pet.data_preparation import get_all_species, get_pyg_graphs
+
+
+def get_dense_forces(gradients, mask, neighbors_index, neighbors_pos):
+    gradients = gradients.clone()
+    messaged = gradients[neighbors_index, neighbors_pos]
+    gradients[mask] = 0.0
+    messaged[mask] = 0.0
+    return gradients.sum(dim = 1) - messaged.sum(dim = 1)
+
+
+def get_time(function, batch, device, n_repeats):
+    mask = batch.mask.to(device)
+    neighbors_index = batch.neighbors_index.transpose(0, 1).to(device)
+    neighbors_pos = batch.neighbors_pos.to(device)
+    gradients = torch.randn(batch.x.shape, device = device, requires_grad = True)
+    weights = torch.randn([batch.x.shape[0], 3], device = device)
+    for index in range(n_repeats + 1):
+        if index == 1:
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            begin = time.time()
+        forces = function(gradients, mask, neighbors_index, neighbors_pos)
+        torch.autograd.grad((forces * weights).sum(), gradients)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - begin) / n_repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_silicon", type = int, default = 4)
+    parser.add_argument("--n_methane", type = int, default = 32)
+    parser.add_argument("--n_repeats", type = int, default = 50)
+    args = parser.parse_args()
+
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    structures = ase.io.read('example/methane_val.xyz', index = f':{args.n_methane}')
+    for index in range(args.n_silicon):
+        silicon = ase.build.bulk('Si', cubic = True).repeat(2)
+        silicon.rattle(0.05, seed = index)
+        structures.append(silicon)
+    all_species = get_all_species(structures)
+    graphs = get_pyg_graphs(structures, all_species, 5.0, False, False, None)
+    batch = PaddingCollater(len(all_species))(graphs)
+    fraction = float(batch.mask.float().mean())
+    print(f"{batch.x.shape[0]} atoms, {batch.x.shape[1]} neighbor slots, {100 * fraction:.0f}% of them padding")
+
+    index_add_time = get_time(lambda gradients, mask, neighbors_index, neighbors_pos : 
+                              assemble_forces(gradients, mask, neighbors_index), batch, device, args.n_repeats)
+    dense_time = get_time(get_dense_forces, batch, device, args.n_repeats)
+    print(f"index_add over edges: {1000 * index_add_time:.3f} ms, gather of reversed edges: {1000 * dense_time:.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
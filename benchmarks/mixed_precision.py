@@ -0,0 +1,108 @@
+'''Fits the same model to forces of the example methane dataset, with the
+hypers of example/hypers.yaml, in full precision and under autocast with bf16
+and, on GPUs, fp16. Reports the time per epoch, the peak memory on GPUs,
+the error of the fitted models on the validation set, and the deviation of
+reduced precision predictions of the full precision model from its full
+precision ones'''
+
+import time
+import argparse
+import torch
+import numpy as np
+import ase.io
+
+from pet.pet import PET, PETMLIPWrapper, PETUtilityWrapper
+from pet.hypers import set_hypers_from_files
+from pet.molecule import PaddingCollater
+from pet.data_preparation import get_all_species, get_pyg_graphs, get_forces, update_pyg_graphs
+from pet.utilities import get_autocast, get_grad_scaler, get_rmse
+
+
+def get_loader(structures, all_species, R_CUT, batch_size, shuffle):
+    graphs = get_pyg_graphs(structures, all_species, R_CUT, False, False, None)
+    update_pyg_graphs(graphs, 'forces', get_forces(structures, 'forces'))
+    return torch.utils.data.DataLoader(graphs, batch_size = batch_size, shuffle = shuffle,
+                                       collate_fn = PaddingCollater(len(all_species)))
+
+
+def predict_forces(model, loader, device, mixed_precision):
+    model.eval()
+    predictions = []
+    for batch in loader:
+        batch.to(device)
+        with get_autocast(device, mixed_precision):
+            _, forces = model(batch, augmentation = False, create_graph = False)
+        predictions.append(forces.detach().cpu().numpy())
+    return np.concatenate(predictions, axis = 0)
+
+
+def fit(model, loader, device, mixed_precision, n_epochs, lr):
+    optim = torch.optim.Adam(model.parameters(), lr = lr)
+    scaler = get_grad_scaler(device, mixed_precision)
+    model.train()
+    begin = time.time()
+    for _ in range(n_epochs):
+        for batch in loader:
+            batch.to(device)
+            with get_autocast(device, mixed_precision):
+                _, forces = model(batch, augmentation = True, create_graph = True)
+            loss = torch.mean((forces - batch.forces) ** 2)
+            scaler.scale(loss).backward()
+            scaler.step(optim)
+            scaler.update()
+            optim.zero_grad()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - begin) / n_epochs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_epochs", type = int, default = 3)
+    parser.add_argument("--batch_size", type = int, default = 16)
+    parser.add_argument("--lr", type = float, default = 1e-4)
+    args = parser.parse_args()
+
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    hypers = set_hypers_from_files('example/hypers.yaml', 'default_hypers/default_hypers.yaml')
+    ARCHITECTURAL_HYPERS = hypers.ARCHITECTURAL_HYPERS
+    ARCHITECTURAL_HYPERS.D_OUTPUT = 1
+    ARCHITECTURAL_HYPERS.TARGET_TYPE = 'structural'
+    ARCHITECTURAL_HYPERS.TARGET_AGGREGATION = 'sum'
+
+    train_structures = ase.io.read('example/methane_train.xyz', index = ':')
+    val_structures = ase.io.read('example/methane_val.xyz', index = ':')
+    all_species = get_all_species(train_structures + val_structures)
+    train_loader = get_loader(train_structures, all_species, ARCHITECTURAL_HYPERS.R_CUT, args.batch_size, True)
+    val_loader = get_loader(val_structures, all_species, ARCHITECTURAL_HYPERS.R_CUT, args.batch_size, False)
+    val_forces = np.concatenate([structure.arrays['forces'] for structure in val_structures], axis = 0)
+
+    precisions = [None, 'bf16'] + (['fp16'] if device.type == 'cuda' else [])
+    torch.manual_seed(0)
+    initial = PETMLIPWrapper(PETUtilityWrapper(PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species)), True),
+                             False, True).state_dict()
+    reference = None
+    for mixed_precision in precisions:
+        name = 'fp32' if mixed_precision is None else mixed_precision
+        torch.manual_seed(0)
+        model = PETMLIPWrapper(PETUtilityWrapper(PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species)), True),
+                               False, True).to(device)
+        model.load_state_dict(initial)
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats()
+        time_per_epoch = fit(model, train_loader, device, mixed_precision, args.n_epochs, args.lr)
+        memory = f"{torch.cuda.max_memory_allocated() / 2 ** 20:.0f} MiB" if device.type == 'cuda' else "not measured on CPU"
+        predictions = predict_forces(model, val_loader, device, mixed_precision)
+        print(f"{name}: {time_per_epoch:.2f} s per epoch, peak memory {memory}, "
+              f"val forces rmse after {args.n_epochs} epochs {get_rmse(predictions, val_forces):.4f}")
+
+        if mixed_precision is None:
+            reference = model
+        else:
+            deviation = get_rmse(predict_forces(reference, val_loader, device, mixed_precision),
+                                 predict_forces(reference, val_loader, device, None))
+            print(f"{name}: rmse of forces of the fp32 model run with {name} from the ones in fp32 {deviation:.2e}")
+
+
+if __name__ == "__main__":
+    main()
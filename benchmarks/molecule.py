@@ -0,0 +1,42 @@
+'''Measures the memory retained by Molecule objects and the time of 
+Molecule.get_graph on a periodic box of about 1000 atoms'''
+
+import time
+import argparse
+import tracemalloc
+import numpy as np
+from ase.build import bulk
+
+from pet.molecule import Molecule
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--r_cut", type = float, default = 5.0)
+    parser.add_argument("--repeat", type = int, nargs = 3, default = [6, 6, 7])
+    parser.add_argument("--n_repeat", type = int, default = 3)
+    args = parser.parse_args()
+
+    atoms = bulk('Cu', 'fcc', a = 3.6, cubic = True).repeat(args.repeat)
+    atoms.rattle(0.1, seed = 0)
+    all_species = np.array([29])
+
+    # the structure itself is not accounted for
+    tracemalloc.start()
+    begin = time.time()
+    molecule = Molecule(atoms, args.r_cut, False, False, None)
+    time_init = time.time() - begin
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    begin = time.time()
+    for _ in range(args.n_repeat):
+        molecule.get_graph(all_species)
+    time_graph = (time.time() - begin) / args.n_repeat
+
+    print(f"number of atoms: {len(atoms)}; average number of neighbors: {np.mean(molecule.get_nums())}")
+    print(f"Molecule: {memory / 2 ** 20:.2f} MiB, built in {time_init:.3f} s; get_graph: {time_graph:.4f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+'''Compares the torch cell list with ASE on periodic boxes of increasing size,
+checking that both find the same number of pairs'''
+
+import time
+import argparse
+import numpy as np
+import torch
+import ase.neighborlist
+from ase.build import bulk
+
+from pet.neighbor_list import get_neighbor_list
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--r_cut", type = float, default = 5.0)
+    parser.add_argument("--sizes", type = int, nargs = '+', default = [3, 6, 13, 28])
+    parser.add_argument("--device", type = str, default = "cpu")
+    parser.add_argument("--skip_ase_above", type = int, default = 200000, 
+                        help = "Do not run ASE for structures with more atoms")
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        atoms = bulk('Cu', 'fcc', a = 3.6, cubic = True).repeat([size, size, size])
+        atoms.rattle(0.1, seed = 0)
+
+        positions = torch.tensor(atoms.positions, device = args.device)
+        cell = torch.tensor(np.array(atoms.cell), device = args.device)
+        pbc = torch.tensor(atoms.pbc, device = args.device)
+        get_neighbor_list(positions, cell, pbc, args.r_cut)
+        if args.device != "cpu":
+            torch.cuda.synchronize()
+        begin = time.time()
+        i, j, D, S = get_neighbor_list(positions, cell, pbc, args.r_cut)
+        if args.device != "cpu":
+            torch.cuda.synchronize()
+        time_torch = time.time() - begin
+        report = f"atoms: {len(atoms)}; pairs: {len(i)}; torch: {time_torch:.3f} s"
+
+        if len(atoms) <= args.skip_ase_above:
+            begin = time.time()
+            i_ase = ase.neighborlist.neighbor_list('i', atoms, args.r_cut)
+            time_ase = time.time() - begin
+            if len(i_ase) != len(i):
+                raise ValueError("numbers of pairs are different")
+            report += f"; ase: {time_ase:.3f} s; speedup: {time_ase / time_torch:.2f}"
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
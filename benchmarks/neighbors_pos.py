@@ -0,0 +1,54 @@
+'''Compares the construction of the reverse-pair index (neighbors_pos)
+by sorting with the naive search over neighbor lists on a periodic box
+of about 1000 atoms'''
+
+import time
+import argparse
+import numpy as np
+import ase.neighborlist
+from ase.build import bulk
+
+from pet.molecule import get_neighbors_pos
+
+
+def get_neighbors_pos_naive(i_list, j_list, S_list, n_atoms):
+    neighbors_index = [[] for _ in range(n_atoms)]
+    neighbors_shift = [[] for _ in range(n_atoms)]
+    for i, j, S in zip(i_list, j_list, S_list):
+        neighbors_index[i].append(j)
+        neighbors_shift[i].append(S)
+
+    result = []
+    for i, j, S in zip(i_list, j_list, S_list):
+        for k in range(len(neighbors_index[j])):
+            if (neighbors_index[j][k] == i) and np.all(neighbors_shift[j][k] == -S):
+                result.append(k)
+    return np.array(result)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--r_cut", type = float, default = 5.0)
+    parser.add_argument("--repeat", type = int, nargs = 3, default = [6, 6, 7])
+    args = parser.parse_args()
+
+    atoms = bulk('Cu', 'fcc', a = 3.6, cubic = True).repeat(args.repeat)
+    atoms.rattle(0.1, seed = 0)
+    i_list, j_list, S_list = ase.neighborlist.neighbor_list('ijS', atoms, args.r_cut)
+    print(f"number of atoms: {len(atoms)}; average number of neighbors: {len(i_list) / len(atoms)}")
+
+    begin = time.time()
+    naive = get_neighbors_pos_naive(i_list, j_list, S_list, len(atoms))
+    time_naive = time.time() - begin
+
+    begin = time.time()
+    vectorized = get_neighbors_pos(i_list, j_list, S_list, len(atoms))
+    time_vectorized = time.time() - begin
+
+    if not np.array_equal(naive, vectorized):
+        raise ValueError("results are different")
+    print(f"naive: {time_naive} s; vectorized: {time_vectorized} s; speedup: {time_naive / time_vectorized}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+'''Latency of energies and forces of the model with the hypers of 
+example/hypers.yaml on the example methane dataset, run by torch and by 
+onnxruntime after the ONNX export, for several batch sizes, on the CPU. Also 
+reports the time of the export and the deviation of the onnxruntime predictions'''
+
+import time
+import argparse
+import tempfile
+import torch
+import numpy as np
+import ase.io
+
+from pet.pet import PET, PETMLIPWrapper, PETUtilityWrapper
+from pet.hypers import set_hypers_from_files
+from pet.molecule import PaddingCollater
+from pet.data_preparation import get_all_species, get_pyg_graphs
+from pet.onnx_backend import export_onnx, ONNXModel
+
+
+def get_latency(model, batches, n_repeats):
+    for batch in batches[:1]:
+        model(batch, False, False)
+    begin = time.time()
+    for _ in range(n_repeats):
+        for batch in batches:
+            model(batch, False, False)
+    return (time.time() - begin) / (n_repeats * len(batches))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_sizes", type = int, nargs = '+', default = [1, 4, 16])
+    parser.add_argument("--n_repeats", type = int, default = 3)
+    parser.add_argument("--n_threads", type = int, default = 1)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.n_threads)
+    hypers = set_hypers_from_files('example/hypers.yaml', 'default_hypers/default_hypers.yaml')
+    ARCHITECTURAL_HYPERS = hypers.ARCHITECTURAL_HYPERS
+    ARCHITECTURAL_HYPERS.D_OUTPUT = 1
+    ARCHITECTURAL_HYPERS.TARGET_TYPE = 'structural'
+    ARCHITECTURAL_HYPERS.TARGET_AGGREGATION = 'sum'
+    hypers.UTILITY_FLAGS.CALCULATION_TYPE = 'mlip'
+    hypers.MLIP_SETTINGS.USE_ENERGIES = True
+    hypers.MLIP_SETTINGS.USE_FORCES = True
+
+    structures = ase.io.read('example/methane_val.xyz', index = ':')
+    all_species = get_all_species(structures)
+    graphs = get_pyg_graphs(structures, all_species, ARCHITECTURAL_HYPERS.R_CUT, False, False, None)
+
+    torch.manual_seed(0)
+    model = PETMLIPWrapper(PETUtilityWrapper(PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species)), True), True, True)
+    model.eval()
+    with tempfile.TemporaryDirectory() as directory:
+        begin = time.time()
+        export_onnx(model.model.pet_model, directory + '/model.onnx', True)
+        print(f"export: {time.time() - begin:.1f} s")
+        onnx_model = ONNXModel(directory + '/model.onnx', hypers, n_threads = args.n_threads)
+
+    for batch_size in args.batch_sizes:
+        collater = PaddingCollater(len(all_species))
+        batches = [collater(graphs[index : index + batch_size]) for index in range(0, len(graphs), batch_size)]
+        torch_latency = get_latency(model, batches, args.n_repeats)
+        onnx_latency = get_latency(onnx_model, batches, args.n_repeats)
+        deviation = max(float(torch.max(torch.abs(model(batch, False, False)[1] - onnx_model(batch, False)[1])))
+                        for batch in batches)
+        print(f"batch size {batch_size}: torch {1000 * torch_latency:.2f} ms, onnxruntime {1000 * onnx_latency:.2f} ms per batch, "
+              f"max deviation of forces {deviation:.1e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+'''Compares the time of energies and forces with padded and ragged transformers
+on a copper slab with vacuum, where surface atoms have fewer neighbors than 
+bulk ones, and the time of the attention alone, forward and backward, for 
+sequences with the numbers of tokens of the slab'''
+
+import time
+import argparse
+import torch
+import numpy as np
+from ase.build import fcc111
+
+from pet.pet import PET, PETMLIPWrapper, PETUtilityWrapper
+from pet.hypers import load_hypers_from_file
+from pet.molecule import PaddingCollater
+from pet.data_preparation import get_pyg_graphs
+from pet.transformer import AttentionBlock, get_packed_index, get_ragged_groups, pack
+
+
+def get_time(function, n_repeat, device):
+    function()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    begin = time.time()
+    for _ in range(n_repeat):
+        function()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - begin) / n_repeat
+
+
+def time_attention(batch, d_model, n_heads, n_repeat, device):
+    mask = torch.cat([torch.zeros_like(batch.mask[:, :1]), batch.mask], dim = 1).to(device)
+    multipliers = torch.logical_not(mask)[:, None, :].float()
+    attention = AttentionBlock(d_model, n_heads).to(device)
+    tokens = torch.randn([mask.shape[0], mask.shape[1], 3 * d_model], device = device, requires_grad = True)
+    ragged = get_ragged_groups(mask, multipliers, 4)
+    packed_tokens = pack(tokens.detach(), get_packed_index(mask)).requires_grad_()
+
+    def run_padded():
+        attention.get_attention(tokens, multipliers).sum().backward()
+
+    def run_ragged():
+        attention.get_ragged_attention(packed_tokens, ragged).sum().backward()
+
+    padded_time = get_time(run_padded, n_repeat, device)
+    ragged_time = get_time(run_ragged, n_repeat, device)
+    shapes = ragged['shapes']
+    print(f"attention alone: padded {1000 * padded_time:.1f} ms, ragged {1000 * ragged_time:.1f} ms in {shapes.shape[0]} groups "
+          f"with {int(torch.sum(shapes[:, 0] * shapes[:, 1]))} instead of {mask.numel()} tokens")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--r_cut", type = float, default = 5.0)
+    parser.add_argument("--size", type = int, nargs = 3, default = [4, 4, 6])
+    parser.add_argument("--vacuum", type = float, default = 10.0)
+    parser.add_argument("--n_repeat", type = int, default = 3)
+    args = parser.parse_args()
+
+    atoms = fcc111('Cu', size = args.size, vacuum = args.vacuum)
+    atoms.rattle(0.1, seed = 0)
+    all_species = np.array([29])
+    graphs = get_pyg_graphs([atoms], all_species, args.r_cut, False, False, None)
+    nums = graphs[0].nums.numpy()
+    print(f"number of atoms: {len(atoms)}; numbers of neighbors from {int(np.min(nums))} to {int(np.max(nums))}, "
+          f"padding fraction: {1.0 - np.mean(nums) / np.max(nums):.3f}")
+
+    hypers = load_hypers_from_file('default_hypers/default_hypers.yaml')
+    ARCHITECTURAL_HYPERS = hypers.ARCHITECTURAL_HYPERS
+    ARCHITECTURAL_HYPERS.D_OUTPUT = 1
+    ARCHITECTURAL_HYPERS.TARGET_TYPE = 'structural'
+    ARCHITECTURAL_HYPERS.TARGET_AGGREGATION = 'sum'
+    ARCHITECTURAL_HYPERS.R_CUT = args.r_cut
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+    for ragged in [False, True]:
+        ARCHITECTURAL_HYPERS.RAGGED_TRANSFORMER = ragged
+        model = PETMLIPWrapper(PETUtilityWrapper(PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species)), False),
+                               True, True).to(device)
+        model.eval()
+        batch = PaddingCollater(len(all_species))(graphs).to(device)
+        model(batch, augmentation = False, create_graph = False)
+
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        begin = time.time()
+        for _ in range(args.n_repeat):
+            model(batch, augmentation = False, create_graph = False)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        print(f"RAGGED_TRANSFORMER = {ragged}: {(time.time() - begin) / args.n_repeat:.3f} s per energies and forces")
+
+    time_attention(PaddingCollater(len(all_species))(graphs), ARCHITECTURAL_HYPERS.TRANSFORMER_D_MODEL,
+                   ARCHITECTURAL_HYPERS.TRANSFORMER_N_HEAD, 10 * args.n_repeat, device)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+'''Compares a transformer and a head with stacked species-specific weights,
+which select the weights of each atom on the device, with the loop over 
+species, which splits atoms by their central species with masks, runs a 
+separate layer for each species and puts the results back'''
+
+import time
+import argparse
+import torch
+import numpy as np
+
+from pet.transformer import TransformerLayer, Transformer
+from pet.species_layers import get_linear, Sequential, Elementwise
+
+
+def get_head(d_model, n_species = None):
+    return Sequential(get_linear(d_model, d_model, n_species), Elementwise(torch.nn.SiLU()),
+                      get_linear(d_model, d_model, n_species), Elementwise(torch.nn.SiLU()),
+                      get_linear(d_model, 1, n_species))
+
+
+def run_loop(layers, x, species, *args):
+    # as done by the former CentralSplitter and CentralUniter
+    central_species = species.cpu().numpy()
+    result = None
+    for specie in np.unique(central_species):
+        mask = torch.from_numpy(central_species == specie).to(x.device)
+        output = layers[specie](x[mask], *[arg[mask] for arg in args])
+        if result is None:
+            result = torch.empty([x.shape[0]] + list(output.shape[1:]), dtype = output.dtype, device = x.device)
+        result[mask] = output
+    return result
+
+
+def measure(function, device, n_repeat):
+    function()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    begin = time.time()
+    for _ in range(n_repeat):
+        function()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - begin) / n_repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_atoms", type = int, default = 1000)
+    parser.add_argument("--n_neighbors", type = int, default = 40)
+    parser.add_argument("--n_species", type = int, nargs = '+', default = [1, 2, 4, 8])
+    parser.add_argument("--d_model", type = int, default = 128)
+    parser.add_argument("--n_layers", type = int, default = 2)
+    parser.add_argument("--n_repeat", type = int, default = 5)
+    args = parser.parse_args()
+
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    x = torch.randn(args.n_atoms, args.n_neighbors, args.d_model, device = device)
+    multipliers = torch.rand(args.n_atoms, 1, args.n_neighbors, device = device)
+    pooled = torch.randn(args.n_atoms, args.d_model, device = device)
+
+    with torch.no_grad():
+        for n_species in args.n_species:
+            species = torch.randint(0, n_species, (args.n_atoms,), device = device)
+            stacked = Transformer(TransformerLayer(args.d_model, 4, n_species = n_species), args.n_layers).to(device).eval()
+            separate = [Transformer(TransformerLayer(args.d_model, 4), args.n_layers).to(device).eval() for _ in range(n_species)]
+            time_stacked = measure(lambda: stacked(x, multipliers, species = species), device, args.n_repeat)
+            time_loop = measure(lambda: run_loop(separate, x, species, multipliers), device, args.n_repeat)
+            print(f"{n_species} species, transformer: stacked {time_stacked * 1e3:.2f} ms, loop {time_loop * 1e3:.2f} ms")
+
+            stacked = get_head(args.d_model, n_species).to(device)
+            separate = [get_head(args.d_model).to(device) for _ in range(n_species)]
+            time_stacked = measure(lambda: stacked(pooled, species), device, args.n_repeat)
+            time_loop = measure(lambda: run_loop(separate, pooled, species), device, args.n_repeat)
+            print(f"{n_species} species, head: stacked {time_stacked * 1e3:.2f} ms, loop {time_loop * 1e3:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
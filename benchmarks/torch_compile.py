@@ -0,0 +1,102 @@
+'''Throughput of the model with the hypers of example/hypers.yaml on the example
+methane dataset, in the eager mode and compiled by torch.compile with batches
+padded to COMPILE_SHAPE_BUCKETS sizes per doubling of the numbers of atoms and 
+of neighbors. Reports the time of the warmup, which compiles the model once per 
+padded shape, and the time per batch of energies and forces and of training 
+steps on energies afterwards. The compiled kernels are cached on disk by inductor 
+(see TORCHINDUCTOR_CACHE_DIR), so that the warmups of later runs are faster'''
+
+import time
+import argparse
+import torch
+import ase.io
+
+from pet.pet import PET, PETMLIPWrapper, PETUtilityWrapper
+from pet.hypers import set_hypers_from_files
+from pet.molecule import PaddingCollater
+from pet.data_preparation import get_all_species, get_pyg_graphs, update_pyg_graphs
+from pet.data_preparation import get_self_contributions, get_corrected_energies
+from pet.utilities import warmup
+
+
+def get_time_per_batch(run_batch, loader, device, n_epochs):
+    begin = time.time()
+    n_batches = 0
+    for _ in range(n_epochs):
+        for batch in loader:
+            run_batch(batch)
+            n_batches += 1
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - begin) / n_batches
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type = int, default = 16)
+    parser.add_argument("--n_epochs", type = int, default = 3)
+    parser.add_argument("--compile_shape_buckets", type = int, default = 4)
+    args = parser.parse_args()
+
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    hypers = set_hypers_from_files('example/hypers.yaml', 'default_hypers/default_hypers.yaml')
+    ARCHITECTURAL_HYPERS = hypers.ARCHITECTURAL_HYPERS
+    ARCHITECTURAL_HYPERS.D_OUTPUT = 1
+    ARCHITECTURAL_HYPERS.TARGET_TYPE = 'structural'
+    ARCHITECTURAL_HYPERS.TARGET_AGGREGATION = 'sum'
+
+    structures = ase.io.read('example/methane_val.xyz', index = ':')
+    all_species = get_all_species(structures)
+    graphs = get_pyg_graphs(structures, all_species, ARCHITECTURAL_HYPERS.R_CUT, False, False, None)
+    self_contributions = get_self_contributions('energy', structures, all_species)
+    update_pyg_graphs(graphs, 'y', get_corrected_energies('energy', structures, all_species, self_contributions))
+    loader = torch.utils.data.DataLoader(graphs, batch_size = args.batch_size, shuffle = False,
+                                         collate_fn = PaddingCollater(len(all_species)))
+
+    torch.manual_seed(0)
+    initial = PETMLIPWrapper(PETUtilityWrapper(PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species)), True),
+                             True, True).state_dict()
+    for compile_model in [False, True]:
+        name = 'compiled' if compile_model else 'eager'
+        model = PETMLIPWrapper(PETUtilityWrapper(PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species)), True),
+                               True, True).to(device)
+        model.load_state_dict(initial)
+        get_padded_shape = None
+        if compile_model:
+            model.model.enable_compilation(args.compile_shape_buckets)
+            get_padded_shape = model.model.get_padded_shape
+
+        def run_inference(batch):
+            batch.to(device)
+            return model(batch, augmentation = False, create_graph = False)
+
+        optim = torch.optim.Adam(model.parameters(), lr = 1e-4)
+        def run_training_step(batch):
+            batch.to(device)
+            energies, _ = model(batch, augmentation = True, create_graph = False)
+            loss = torch.mean((energies - batch.y) ** 2)
+            loss.backward()
+            optim.step()
+            optim.zero_grad()
+
+        model.eval()
+        begin = time.time()
+        n_shapes = warmup(run_inference, loader, get_padded_shape)
+        warmup_time = time.time() - begin
+        inference_time = get_time_per_batch(run_inference, loader, device, args.n_epochs)
+
+        # training on energies only; forces in the loss need double backward,
+        # which is not supported by torch.compile
+        model.train()
+        model.use_forces = False
+        begin = time.time()
+        warmup(run_training_step, loader, get_padded_shape)
+        training_warmup_time = time.time() - begin
+        training_time = get_time_per_batch(run_training_step, loader, device, args.n_epochs)
+
+        print(f"{name}: warmup on {n_shapes} shapes {warmup_time:.1f} s, energies and forces {1000 * inference_time:.1f} ms per batch; "
+              f"training warmup {training_warmup_time:.1f} s, training step on energies {1000 * training_time:.1f} ms per batch")
+
+
+if __name__ == "__main__":
+    main()
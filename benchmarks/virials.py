@@ -0,0 +1,88 @@
+'''Time of energies, forces and virials of a rattled bulk silicon supercell
+with the default hypers, computed from a single backward pass by PETMLIPWrapper
+with use_virials = True, compared to energies and forces alone and to the
+central finite differences of the energy with respect to the 6 independent
+components of the strain, 12 additional evaluations including neighbor lists'''
+
+import time
+import argparse
+import numpy as np
+import torch
+import ase.build
+
+from pet.pet import PET, PETMLIPWrapper, PETUtilityWrapper
+from pet.hypers import load_hypers_from_file
+from pet.molecule import PaddingCollater
+from pet.data_preparation import get_all_species, get_pyg_graphs
+
+
+def get_time(function, n_repeats):
+    function()
+    begin = time.time()
+    for _ in range(n_repeats):
+        function()
+    return (time.time() - begin) / n_repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type = int, default = 2, help = "The conventional cubic cell is repeated this many times along each axis")
+    parser.add_argument("--n_repeats", type = int, default = 10)
+    args = parser.parse_args()
+
+    hypers = load_hypers_from_file('default_hypers/default_hypers.yaml')
+    ARCHITECTURAL_HYPERS = hypers.ARCHITECTURAL_HYPERS
+    ARCHITECTURAL_HYPERS.D_OUTPUT = 1
+    ARCHITECTURAL_HYPERS.TARGET_TYPE = 'structural'
+    ARCHITECTURAL_HYPERS.TARGET_AGGREGATION = 'sum'
+
+    structure = ase.build.bulk('Si', cubic = True).repeat(args.repeat)
+    structure.rattle(0.05, seed = 0)
+    all_species = get_all_species([structure])
+    collater = PaddingCollater(len(all_species))
+    print(f"{len(structure)} atoms")
+
+    torch.manual_seed(0)
+    model = PETMLIPWrapper(PETUtilityWrapper(PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species)), False),
+                           True, True)
+    model.eval()
+
+    def get_batch(structure):
+        return collater(get_pyg_graphs([structure], all_species, ARCHITECTURAL_HYPERS.R_CUT, False, False, None))
+
+    def get_energy(strain):
+        strained = structure.copy()
+        strained.set_cell(np.dot(structure.cell, np.eye(3) + strain), scale_atoms = True)
+        model.use_forces = False
+        energy = model(get_batch(strained), augmentation = False, create_graph = False)[0]
+        model.use_forces = True
+        return energy
+
+    def run_forces():
+        model.use_virials = False
+        model(get_batch(structure), augmentation = False, create_graph = False)
+
+    def run_virials():
+        model.use_virials = True
+        model(get_batch(structure), augmentation = False, create_graph = False)
+
+    def run_finite_differences():
+        run_forces()
+        with torch.no_grad():
+            for alpha in range(3):
+                for beta in range(alpha, 3):
+                    strain = np.zeros([3, 3])
+                    strain[alpha, beta] = strain[beta, alpha] = 1e-3
+                    get_energy(strain)
+                    get_energy(-strain)
+
+    forces_time = get_time(run_forces, args.n_repeats)
+    virials_time = get_time(run_virials, args.n_repeats)
+    finite_differences_time = get_time(run_finite_differences, args.n_repeats)
+    print(f"energies and forces: {1000 * forces_time:.1f} ms")
+    print(f"energies, forces and virials in the same backward pass: {1000 * virials_time:.1f} ms")
+    print(f"energies and forces, virials by finite differences: {1000 * finite_differences_time:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
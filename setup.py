@@ -15,7 +15,10 @@ setup(
             'pet_run = pet.estimate_error:main',
             'pet_run_sp = pet.estimate_error_sp:main',
             'pet_train_general_target = pet.train_model_general_target:main',
+            'pet_export = pet.export:main',
+            'pet_quantization_report = pet.quantization:main',
         ],
     },
     install_requires=requirements,
+    extras_require={'onnx': ['onnx', 'onnxscript', 'onnxruntime']},
 )
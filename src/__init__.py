@@ -1 +1,3 @@
-from .single_struct_calculator import SingleStructCalculator
\ No newline at end of file
+from .single_struct_calculator import SingleStructCalculator
+from .ase_calculator import PETCalculator
+from .batched_calculator import BatchedCalculator
@@ -0,0 +1,196 @@
+import torch
+import numpy as np
+import ase.neighborlist
+from ase.calculators.calculator import Calculator, all_changes
+from ase.stress import full_3x3_to_voigt_6_stress
+from torch_geometric.data import Data
+
+from .data_preparation import get_compositional_features
+from .molecule import PaddingCollater, NEIGHBOR_PADDING_VALUES, get_reverse_pairs, get_species_indices
+from .neighbor_list import get_neighbor_list_numpy
+from .single_struct_calculator import SingleStructCalculator
+from .utilities import get_autocast
+
+
+def get_stress(virial, atoms):
+    '''Stress in the Voigt notation of ASE from the virial of a periodic structure'''
+    # PET is not exactly invariant with respect to rotations, so the virial is symmetrized
+    virial = (virial + virial.T) / 2.0
+    return full_3x3_to_voigt_6_stress(-virial / atoms.get_volume())
+
+
+class PETCalculator(Calculator):
+    '''ASE calculator for molecular dynamics and relaxations with a fitted MLIP.
+
+    Neighbors are found within R_CUT + skin, and the padded tensors are allocated
+    for them only when the neighbor list is rebuilt. On every call, the vectors
+    from atoms to their neighbors are recomputed from the positions, the pairs
+    within R_CUT are written in place into the first slots of these tensors,
+    and the model gets views of them padded to the maximal number of neighbors
+    within R_CUT. So predictions are the same as with SingleStructCalculator,
+    and no neighbor search is needed between the rebuilds.
+    The neighbor list is rebuilt when an atom has moved by more than skin / 2
+    since the last rebuild, or when the cell, pbc or atomic numbers change.
+
+    Stress is computed from the virial, from the same backward pass as the
+    forces, for structures periodic along all the three directions.
+    With positive cache_size, the results of recently seen geometries are
+    reused, see SingleStructCalculator'''
+
+    implemented_properties = ['energy', 'free_energy', 'forces', 'stress']
+
+    def __init__(self, path_to_calc_folder, checkpoint = "best_val_rmse_both_model", device = "cpu",
+                 skin = 0.5, use_torch_neighbor_list = False, mixed_precision = None,
+                 compile_model = False, compile_shape_buckets = 4, quantize = False,
+                 cache_size = 0, cache_tolerance = 0.0, **kwargs):
+        Calculator.__init__(self, **kwargs)
+        calculator = SingleStructCalculator(path_to_calc_folder, checkpoint, device,
+                                            mixed_precision = mixed_precision, compile_model = compile_model,
+                                            compile_shape_buckets = compile_shape_buckets, quantize = quantize,
+                                            use_virials = True, cache_size = cache_size,
+                                            cache_tolerance = cache_tolerance)
+        hypers = calculator.hypers
+        if not hypers.MLIP_SETTINGS.USE_ENERGIES:
+            raise ValueError("PETCalculator needs a model fitted on energies")
+        ARCHITECTURAL_HYPERS = hypers.ARCHITECTURAL_HYPERS
+        if ARCHITECTURAL_HYPERS.USE_ADDITIONAL_SCALAR_ATTRIBUTES or ARCHITECTURAL_HYPERS.USE_LONG_RANGE:
+            raise ValueError("PETCalculator does not support scalar attributes and long range")
+
+        self.model = calculator.model
+        # forces are computed even for models fitted without them
+        getattr(self.model, 'module', self.model).use_forces = True
+        self.all_species = calculator.all_species
+        self.self_contributions = calculator.self_contributions
+        self.mixed_precision = calculator.mixed_precision
+        self.device = calculator.device
+        self.r_cut = ARCHITECTURAL_HYPERS.R_CUT
+        self.skin = skin
+        self.neighbor_list_device = device if use_torch_neighbor_list else None
+        self.cache = calculator.cache
+
+        self.batch = None
+        self.n_evaluations = 0
+        self.n_rebuilds = 0
+
+    def needs_rebuild(self, atoms):
+        if self.batch is None:
+            return True
+        if len(atoms) != len(self.reference_positions):
+            return True
+        if not np.array_equal(atoms.numbers, self.numbers) or not np.array_equal(atoms.pbc, self.pbc):
+            return True
+        if not np.array_equal(np.array(atoms.cell), self.cell):
+            return True
+        if len(atoms) == 0:
+            return False
+        displacements = np.linalg.norm(atoms.positions - self.reference_positions, axis = 1)
+        return np.max(displacements) > self.skin / 2.0
+
+    def rebuild(self, atoms):
+        r_cut = self.r_cut + self.skin
+        if self.neighbor_list_device is None:
+            i_list, j_list, S_list = ase.neighborlist.neighbor_list('ijS', atoms, r_cut)
+        else:
+            i_list, j_list, _, S_list = get_neighbor_list_numpy(atoms, r_cut, device = self.neighbor_list_device)
+        order = np.argsort(i_list, kind = 'stable')
+        i_list, j_list, S_list = i_list[order], j_list[order], S_list[order]
+        self.i_list, self.j_list, self.S_list = i_list, j_list, S_list.astype(np.float64)
+        self.reverse = get_reverse_pairs(i_list, j_list, S_list)
+
+        # the padded tensors of the batch with all the neighbors within the skin
+        # are the buffers, into which the neighbors within R_CUT are written
+        species = atoms.get_atomic_numbers()
+        graph = Data(central_species = torch.from_numpy(get_species_indices(species, self.all_species)),
+                     x = torch.zeros([len(i_list), 3]),
+                     neighbor_species = torch.zeros([len(i_list)], dtype = torch.long),
+                     neighbors_pos = torch.zeros([len(i_list)], dtype = torch.long),
+                     neighbors_index = torch.zeros([len(i_list)], dtype = torch.long),
+                     nums = torch.FloatTensor(np.bincount(i_list, minlength = len(atoms))),
+                     n_atoms = len(atoms))
+        self.batch = PaddingCollater(len(self.all_species))([graph]).to(self.device)
+        self.buffers = {'x' : self.batch.x, 'mask' : self.batch.mask,
+                        'neighbor_species' : self.batch.neighbor_species,
+                        'neighbors_pos' : self.batch.neighbors_pos,
+                        'neighbors_index' : self.batch.neighbors_index.transpose(0, 1)}
+        self.padding_values = dict(NEIGHBOR_PADDING_VALUES, mask = True, neighbor_species = len(self.all_species))
+        self.neighbor_species = torch.from_numpy(get_species_indices(species[j_list], self.all_species)).to(self.device)
+        self.neighbors_index = torch.from_numpy(j_list.astype(np.int64)).to(self.device)
+
+        self.reference_positions = atoms.positions.copy()
+        self.cell = np.array(atoms.cell)
+        self.pbc = atoms.pbc.copy()
+        self.numbers = atoms.numbers.copy()
+        compositional_features = get_compositional_features([atoms], self.all_species)[0]
+        self.self_contributions_energy = float(np.dot(compositional_features, self.self_contributions))
+        self.n_rebuilds += 1
+
+    def update_batch(self, atoms):
+        '''Writes the pairs within R_CUT into the buffers, in the layout of pad_graph'''
+        positions = atoms.positions
+        vectors = positions[self.j_list] - positions[self.i_list] + np.dot(self.S_list, self.cell)
+        within = np.linalg.norm(vectors, axis = 1) < self.r_cut
+        within = np.logical_and(within, within[self.reverse])
+        selected = np.nonzero(within)[0]
+
+        centers = self.i_list[selected]
+        nums = np.bincount(centers, minlength = len(atoms))
+        slots = np.arange(len(selected)) - (np.cumsum(nums) - nums)[centers]
+        compact_index = np.zeros(len(within), dtype = int)
+        compact_index[selected] = np.arange(len(selected))
+        neighbors_pos = slots[compact_index[self.reverse[selected]]]
+        max_num = max(1, int(np.max(nums))) if len(atoms) > 0 else 1
+
+        index = (torch.from_numpy(centers).to(self.device), torch.from_numpy(slots).to(self.device))
+        selected = torch.from_numpy(selected).to(self.device)
+        values = {'x' : torch.from_numpy(vectors[within]), 'mask' : False,
+                  'neighbor_species' : self.neighbor_species[selected],
+                  'neighbors_pos' : torch.from_numpy(neighbors_pos),
+                  'neighbors_index' : self.neighbors_index[selected]}
+        with torch.no_grad():
+            for key, buffer in self.buffers.items():
+                view = buffer[:, :max_num]
+                view.fill_(self.padding_values[key])
+                view[index] = values[key].to(buffer) if torch.is_tensor(values[key]) else values[key]
+                setattr(self.batch, key, view)
+            self.batch.nums.copy_(torch.from_numpy(nums))
+        self.batch.neighbors_index = self.batch.neighbors_index.transpose(0, 1)
+
+    def get_rebuild_statistics(self):
+        '''Numbers of evaluations and of rebuilds of the neighbor list since the creation of the calculator'''
+        return {'n_evaluations' : self.n_evaluations, 'n_rebuilds' : self.n_rebuilds,
+                'rebuild_fraction' : self.n_rebuilds / max(self.n_evaluations, 1)}
+
+    def get_cache_statistics(self):
+        if self.cache is None:
+            raise ValueError("cache of results is disabled, set cache_size to enable it")
+        return self.cache.get_statistics()
+
+    def compute(self, atoms):
+        if self.needs_rebuild(atoms):
+            self.rebuild(atoms)
+        self.update_batch(atoms)
+        self.n_evaluations += 1
+
+        with get_autocast(self.device, self.mixed_precision):
+            energy, forces, virial = self.model(self.batch, augmentation = False, create_graph = False)
+        energy = float(energy.data.cpu().numpy()[0]) + self.self_contributions_energy
+        return energy, forces.data.cpu().numpy().astype(np.float64), virial[0].data.cpu().numpy().astype(np.float64)
+
+    def calculate(self, atoms = None, properties = ['energy'], system_changes = all_changes):
+        Calculator.calculate(self, atoms, properties, system_changes)
+        atoms = self.atoms
+        if self.cache is None:
+            energy, forces, virial = self.compute(atoms)
+        else:
+            key = self.cache.get_key(atoms)
+            results = self.cache.load(key)
+            if results is None:
+                results = self.compute(atoms)
+                self.cache.save(key, results)
+            energy, forces, virial = results
+
+        self.results['energy'] = energy
+        self.results['free_energy'] = energy
+        self.results['forces'] = forces.copy()
+        if np.all(atoms.pbc):
+            self.results['stress'] = get_stress(virial, atoms)
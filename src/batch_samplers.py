@@ -0,0 +1,189 @@
+import math
+import numpy as np
+import torch
+
+
+def get_nums(graphs):
+    '''Numbers of neighbors of all the atoms of each graph'''
+    return [graph.nums.long().numpy() for graph in graphs]
+
+
+def get_max_nums(nums):
+    return np.array([np.max(nums_now) if len(nums_now) > 0 else 0 for nums_now in nums])
+
+
+def split_into_batches(order, batch_size):
+    return [order[index : index + batch_size] for index in range(0, len(order), batch_size)]
+
+
+def get_padding_fraction(nums, batches):
+    '''Fraction of the neighbor slots which are padding when structures are
+    grouped into batches; each batch is padded to its maximal number of
+    neighbors, as done by PaddingCollater'''
+    total, padded = 0, 0
+    for batch in batches:
+        batch_nums = np.concatenate([nums[index] for index in batch])
+        slots = len(batch_nums) * max(1, np.max(batch_nums, initial = 0))
+        total += slots
+        padded += slots - np.sum(batch_nums)
+    return padded / total if total > 0 else 0.0
+
+
+def get_bucketed_order(max_nums, shuffle, generator = None):
+    '''Structures sorted by their maximal numbers of neighbors; if shuffle is True, 
+    structures with equal maximal numbers of neighbors are shuffled'''
+    if shuffle:
+        permutation = torch.randperm(len(max_nums), generator = generator).numpy()
+        return permutation[np.argsort(max_nums[permutation], kind = 'stable')]
+    return np.argsort(max_nums, kind = 'stable')
+
+
+def shuffle_batches(batches, generator = None):
+    permutation = torch.randperm(len(batches), generator = generator).numpy()
+    return [batches[index] for index in permutation]
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    '''Groups structures with similar maximal numbers of neighbors into batches,
+    so that little of each batch is padding.
+
+    If shuffle is True, structures with equal maximal numbers of neighbors are
+    shuffled, and so is the order of the batches, anew at every epoch.
+    Otherwise, batches follow the structures sorted by size; the original order
+    can be restored with restore_order'''
+
+    def __init__(self, nums, batch_size, shuffle, generator = None):
+        self.max_nums = get_max_nums(nums)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.generator = generator
+        self.batches = self.get_batches()
+
+    def get_order(self):
+        return get_bucketed_order(self.max_nums, self.shuffle, self.generator)
+
+    def get_batches(self):
+        batches = split_into_batches(self.get_order(), self.batch_size)
+        if self.shuffle:
+            batches = shuffle_batches(batches, self.generator)
+        return batches
+
+    def __iter__(self):
+        for batch in self.batches:
+            yield batch.tolist()
+        # batches for the next epoch
+        self.batches = self.get_batches()
+
+    def __len__(self):
+        return math.ceil(len(self.max_nums) / self.batch_size)
+
+
+class BudgetBatchSampler(torch.utils.data.Sampler):
+    '''Packs consecutive structures into a batch as long as it stays within 
+    max_atoms atoms or max_tokens tokens. The number of tokens is the number of 
+    atoms times the maximal number of neighbors within the batch, i. e. the size 
+    of the padded batch. A structure exceeding the budget alone forms its own batch.
+
+    If bucketed is True, structures are sorted by their maximal numbers of neighbors
+    as in BucketBatchSampler, otherwise they are taken in the original order, 
+    shuffled if shuffle is True. The order of the batches is shuffled as well'''
+
+    def __init__(self, nums, shuffle, bucketed = False, max_atoms = None, max_tokens = None, generator = None):
+        if (max_atoms is None) == (max_tokens is None):
+            raise ValueError("exactly one of max_atoms and max_tokens should be provided")
+        self.n_atoms = np.array([len(nums_now) for nums_now in nums])
+        self.max_nums = get_max_nums(nums)
+        self.shuffle = shuffle
+        self.bucketed = bucketed
+        self.max_atoms = max_atoms
+        self.max_tokens = max_tokens
+        self.generator = generator
+        self.batches = self.get_batches()
+
+    def get_order(self):
+        if self.bucketed:
+            return get_bucketed_order(self.max_nums, self.shuffle, self.generator)
+        if self.shuffle:
+            return torch.randperm(len(self.max_nums), generator = self.generator).numpy()
+        return np.arange(len(self.max_nums))
+
+    def fits(self, n_atoms, max_num):
+        if self.max_atoms is not None:
+            return n_atoms <= self.max_atoms
+        return n_atoms * max(1, max_num) <= self.max_tokens
+
+    def get_batches(self):
+        batches = []
+        current, n_atoms, max_num = [], 0, 0
+        for index in self.get_order():
+            n_atoms_now = n_atoms + self.n_atoms[index]
+            max_num_now = max(max_num, self.max_nums[index])
+            if (len(current) > 0) and (not self.fits(n_atoms_now, max_num_now)):
+                batches.append(np.array(current))
+                current, n_atoms_now, max_num_now = [], self.n_atoms[index], self.max_nums[index]
+            current.append(index)
+            n_atoms, max_num = n_atoms_now, max_num_now
+        if len(current) > 0:
+            batches.append(np.array(current))
+
+        if self.shuffle:
+            batches = shuffle_batches(batches, self.generator)
+        return batches
+
+    def __iter__(self):
+        for batch in self.batches:
+            yield batch.tolist()
+        # batches for the next epoch
+        self.batches = self.get_batches()
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def uses_batch_sampler(bucketed, max_atoms = None, max_tokens = None):
+    '''Whether get_batch_sampler returns a sampler for these settings; otherwise
+    the numbers of neighbors of the graphs are not needed'''
+    return bucketed or (max_atoms is not None) or (max_tokens is not None)
+
+
+def get_batch_sampler(nums, batch_size, shuffle, bucketed, max_atoms = None, max_tokens = None,
+                      generator = None):
+    '''Returns the batch sampler for the given settings, or None if
+    batches of batch_size consecutive structures are to be used'''
+    if (max_atoms is not None) or (max_tokens is not None):
+        return BudgetBatchSampler(nums, shuffle, bucketed = bucketed, max_atoms = max_atoms,
+                                  max_tokens = max_tokens, generator = generator)
+    if bucketed:
+        return BucketBatchSampler(nums, batch_size, shuffle, generator = generator)
+    return None
+
+
+def report_padding_fraction(nums, batch_size, sampler, name):
+    '''Prints the fraction of padded neighbor slots with batches of batch_size 
+    consecutive structures and with the batches of the given sampler for the 
+    next epoch; new batches are not generated, so that the random state is kept'''
+    if len(sampler.batches) == 0:
+        print(f"{name} batches: 0")
+        return
+    before = get_padding_fraction(nums, split_into_batches(np.arange(len(nums)), batch_size))
+    batches = sampler.batches
+    after = get_padding_fraction(nums, batches)
+    print(f"fraction of padded neighbor slots in {name} batches: {before:.3f} with {batch_size} "
+          f"consecutive structures, {after:.3f} with the batch sampler")
+    n_atoms = [np.sum([len(nums[index]) for index in batch]) for batch in batches]
+    print(f"{name} batches: {len(batches)}, atoms per batch from {np.min(n_atoms)} to {np.max(n_atoms)}")
+
+
+def restore_order(values, order, n_atoms = None):
+    '''Given values computed for the structures in the given order, returns them
+    in the original order. If n_atoms is provided, values are atomic, i. e.
+    consist of n_atoms[index] consecutive rows for each structure'''
+    inverse = np.empty(len(order), dtype = int)
+    inverse[order] = np.arange(len(order))
+    if n_atoms is None:
+        return values[inverse]
+
+    n_atoms_sorted = np.asarray(n_atoms)[order]
+    offsets = np.cumsum(n_atoms_sorted) - n_atoms_sorted
+    chunks = [values[offsets[index] : offsets[index] + n_atoms_sorted[index]] for index in inverse]
+    return np.concatenate(chunks, axis = 0)
@@ -0,0 +1,108 @@
+import numpy as np
+from ase.calculators.calculator import Calculator, all_changes
+
+from .ase_calculator import get_stress
+from .data_preparation import get_compositional_features
+from .molecule import Molecule, PaddingCollater
+from .single_struct_calculator import SingleStructCalculator
+from .utilities import get_autocast
+
+
+class BatchedCalculator(SingleStructCalculator):
+    '''Evaluates lists of structures, such as images of NEB or replicas, with a
+    single forward pass of the model over the batch of their graphs.
+
+    forward returns the list of the results of SingleStructCalculator.forward
+    for each structure. With positive cache_size, only the structures missing
+    in the cache are evaluated'''
+
+    def forward(self, structures):
+        results = [None] * len(structures)
+        if self.cache is not None:
+            keys = [self.cache.get_key(structure) for structure in structures]
+            results = [self.cache.load(key) for key in keys]
+        missing = [index for index, result in enumerate(results) if result is None]
+        if len(missing) > 0:
+            computed = self.compute_batch([structures[index] for index in missing])
+            for index, result in zip(missing, computed):
+                results[index] = result
+                if self.cache is not None:
+                    self.cache.save(keys[index], result)
+        if self.cache is None:
+            return results
+        return [tuple(np.copy(value) for value in result) for result in results]
+
+    def compute_batch(self, structures):
+        graphs = []
+        for structure in structures:
+            molecule = Molecule(structure, self.architectural_hypers.R_CUT,
+                                self.architectural_hypers.USE_ADDITIONAL_SCALAR_ATTRIBUTES,
+                                self.architectural_hypers.USE_LONG_RANGE, self.architectural_hypers.K_CUT,
+                                neighbor_list_device = self.neighbor_list_device)
+            graphs.append(molecule.get_graph(self.all_species))
+        batch = PaddingCollater(len(self.all_species))(graphs)
+        if not self.hypers.FITTING_SCHEME.MULTI_GPU:
+            batch.to(self.device)
+        with get_autocast(self.device, self.mixed_precision):
+            predictions = self.model(batch, augmentation = False, create_graph = False)
+
+        compositional_features = get_compositional_features(structures, self.all_species)
+        self_contributions_energies = np.dot(compositional_features, self.self_contributions)
+        energies = predictions[0].data.cpu().numpy() + self_contributions_energies
+        # forces are concatenated over the atoms of all the structures
+        boundaries = np.cumsum([len(structure) for structure in structures])[:-1]
+        forces = np.split(predictions[1].data.cpu().numpy(), boundaries)
+
+        results = []
+        for index in range(len(structures)):
+            result = (energies[index : index + 1], forces[index])
+            if self.use_virials:
+                result = result + (predictions[2][index].data.cpu().numpy(),)
+            results.append(result)
+        return results
+
+    def attach(self, images):
+        '''Assigns ASE calculators to all the images, so that the first request
+        of a property of any of them evaluates all the images changed since
+        their last evaluation in one batch. The images get distinct calculators,
+        as required by NEB'''
+        calculators = [ImageCalculator(self, image) for image in images]
+        for image, calculator in zip(images, calculators):
+            calculator.group = calculators
+            image.calc = calculator
+        return calculators
+
+
+class ImageCalculator(Calculator):
+    '''ASE calculator of one of the images attached to a BatchedCalculator'''
+
+    implemented_properties = ['energy', 'free_energy', 'forces', 'stress']
+
+    def __init__(self, batched_calculator, image, **kwargs):
+        Calculator.__init__(self, **kwargs)
+        self.batched_calculator = batched_calculator
+        self.image = image
+        self.group = [self]
+
+    def is_outdated(self):
+        # images to which other calculators have been assigned are skipped
+        if self.image.calc is not self:
+            return False
+        return self.atoms is None or len(self.check_state(self.image)) > 0
+
+    def calculate(self, atoms = None, properties = ['energy'], system_changes = all_changes):
+        Calculator.calculate(self, atoms, properties, system_changes)
+        calculators = [self] + [calculator for calculator in self.group
+                                if calculator is not self and calculator.is_outdated()]
+        for calculator in calculators[1:]:
+            calculator.atoms = calculator.image.copy()
+            calculator.results = {}
+
+        structures = [calculator.atoms for calculator in calculators]
+        for calculator, result in zip(calculators, self.batched_calculator.forward(structures)):
+            energy = float(result[0][0])
+            calculator.results['energy'] = energy
+            calculator.results['free_energy'] = energy
+            calculator.results['forces'] = result[1].astype(np.float64)
+            if self.batched_calculator.use_virials and np.all(calculator.atoms.pbc):
+                calculator.results['stress'] = get_stress(result[2].astype(np.float64), calculator.atoms)
@@ -2,7 +2,14 @@ import numpy as np
 from sklearn.linear_model import Ridge
 from tqdm import tqdm
 from .molecule import Molecule
+from .graph_cache import GraphCache
+from .sharded_dataset import ShardedGraphWriter, ShardedGraphDataset
+import os
 import torch
+import math
+import pickle
+import multiprocessing
+from functools import partial
 
 def get_all_species(structures):
     all_species = []
@@ -19,30 +26,125 @@ def get_forces(structures, FORCES_KEY):
     return forces
 
 
+def get_virials(structures, VIRIALS_KEY):
+    virials = []
+    for structure in structures:
+        virials.append(torch.FloatTensor(np.reshape(structure.info[VIRIALS_KEY], [1, 3, 3])))
+    return virials
+
+
 def update_pyg_graphs(pyg_graphs, key, values):
     for index in range(len(pyg_graphs)):
         pyg_graphs[index].update({key: values[index]})
 
 
-def get_pyg_graphs(structures, all_species, R_CUT, USE_ADDITIONAL_SCALAR_ATTRIBUTES, USE_LONG_RANGE, K_CUT):
-    molecules = [
-        Molecule(structure, R_CUT, USE_ADDITIONAL_SCALAR_ATTRIBUTES, USE_LONG_RANGE, K_CUT)
-        for structure in tqdm(structures)
-    ]
+def get_graphs(structures, all_species, R_CUT, USE_ADDITIONAL_SCALAR_ATTRIBUTES, USE_LONG_RANGE, K_CUT):
+    graphs = []
+    for structure in structures:
+        molecule = Molecule(structure, R_CUT, USE_ADDITIONAL_SCALAR_ATTRIBUTES, USE_LONG_RANGE, K_CUT)
+        graphs.append(molecule.get_graph(all_species))
+    return graphs
+
+
+def apply_to_chunk(function, args, chunk):
+    # plain pickling copies tensors by value; the default torch reducers would
+    # send each of them through shared memory, exhausting file descriptors
+    return pickle.dumps(function(chunk, *args))
+
+
+def run_in_chunks(function, items, n_workers, chunk_size, *args):
+    '''Applies function(chunk, *args) to consecutive chunks of items, using a pool
+    of n_workers processes if n_workers > 1, and concatenates the results in the 
+    initial order'''
+    chunks = [items[index : index + chunk_size] for index in range(0, len(items), chunk_size)]
+    result = []
+    with tqdm(total = len(items)) as pbar:
+        if n_workers > 1:
+            with multiprocessing.Pool(n_workers, initializer = torch.set_num_threads, initargs = (1,)) as pool:
+                for chunk_result in pool.imap(partial(apply_to_chunk, function, args), chunks):
+                    chunk_result = pickle.loads(chunk_result)
+                    result.extend(chunk_result)
+                    pbar.update(len(chunk_result))
+        else:
+            for chunk in chunks:
+                chunk_result = function(chunk, *args)
+                result.extend(chunk_result)
+                pbar.update(len(chunk_result))
+    return result
 
-    max_nums = [molecule.get_max_num() for molecule in molecules]
-    max_num = np.max(max_nums)
 
-    if USE_LONG_RANGE:
-        k_nums = [molecule.get_num_k() for molecule in molecules]
-        max_k_num = np.max(k_nums)
+def get_pyg_graphs(structures, all_species, R_CUT, USE_ADDITIONAL_SCALAR_ATTRIBUTES, USE_LONG_RANGE, K_CUT,
+                   n_workers = 1, chunk_size = None, cache_dir = None):
+    if cache_dir is not None:
+        cache = GraphCache(cache_dir, all_species, R_CUT, USE_ADDITIONAL_SCALAR_ATTRIBUTES,
+                           USE_LONG_RANGE, K_CUT)
+        keys = cache.get_keys(structures)
+        graphs = cache.load(keys)
     else:
-        max_k_num = None
+        graphs = [None for _ in structures]
+    
+    missing = [index for index, graph in enumerate(graphs) if graph is None]
+    if cache_dir is not None:
+        print(f"graphs cache: {len(structures) - len(missing)} hits, {len(missing)} misses")
+        
+    if len(missing) > 0:
+        if chunk_size is None:
+            # several chunks per worker to balance the load
+            chunk_size = max(1, min(1000, math.ceil(len(missing) / (4 * n_workers))))
         
-    pyg_graphs = [
-        molecule.get_graph(max_num, all_species, max_k_num) for molecule in tqdm(molecules)
-    ]
-    return pyg_graphs
+        new_graphs = run_in_chunks(get_graphs, [structures[index] for index in missing], n_workers, chunk_size,
+                                   all_species, R_CUT, USE_ADDITIONAL_SCALAR_ATTRIBUTES, USE_LONG_RANGE, K_CUT)
+        for index, graph in zip(missing, new_graphs):
+            graphs[index] = graph
+            
+        if cache_dir is not None:
+            cache.save([keys[index] for index in missing], new_graphs)
+
+    # graphs are not padded here; each batch is padded separately by PaddingCollater
+    return graphs
+
+
+def write_sharded_graphs(path, structures, targets, all_species, R_CUT, USE_ADDITIONAL_SCALAR_ATTRIBUTES,
+                         USE_LONG_RANGE, K_CUT, n_workers = 1, cache_dir = None, shard_size = 10000):
+    '''Builds graphs shard by shard, adds targets (a dictionary of key -> list of
+    values per structure) and writes them to path, never keeping more than one shard
+    of graphs in memory'''
+    writer = ShardedGraphWriter(path, shard_size = shard_size)
+    for index in range(0, len(structures), shard_size):
+        graphs = get_pyg_graphs(structures[index : index + shard_size], all_species, R_CUT,
+                                USE_ADDITIONAL_SCALAR_ATTRIBUTES, USE_LONG_RANGE, K_CUT,
+                                n_workers = n_workers, cache_dir = cache_dir)
+        for key, values in targets.items():
+            update_pyg_graphs(graphs, key, values[index : index + shard_size])
+        for graph in graphs:
+            writer.add(graph)
+    writer.close()
+    return ShardedGraphDataset(path)
+
+
+def get_graphs_dataset(structures, targets, all_species, ARCHITECTURAL_HYPERS, FITTING_SCHEME, name):
+    '''Builds graphs with targets (a dictionary of key -> list of values per structure) 
+    either in memory or, if FITTING_SCHEME.SHARDED_GRAPHS_DIR is given, 
+    in memory-mapped shards stored in its subfolder name'''
+    if FITTING_SCHEME.SHARDED_GRAPHS_DIR is not None:
+        return write_sharded_graphs(os.path.join(FITTING_SCHEME.SHARDED_GRAPHS_DIR, name), structures, targets,
+                                    all_species, ARCHITECTURAL_HYPERS.R_CUT,
+                                    ARCHITECTURAL_HYPERS.USE_ADDITIONAL_SCALAR_ATTRIBUTES,
+                                    ARCHITECTURAL_HYPERS.USE_LONG_RANGE,
+                                    ARCHITECTURAL_HYPERS.K_CUT,
+                                    n_workers = FITTING_SCHEME.NUM_WORKERS_PREPROCESSING,
+                                    cache_dir = FITTING_SCHEME.GRAPHS_CACHE_DIR,
+                                    shard_size = FITTING_SCHEME.SHARD_SIZE)
+    
+    graphs = get_pyg_graphs(structures, all_species, ARCHITECTURAL_HYPERS.R_CUT,
+                            ARCHITECTURAL_HYPERS.USE_ADDITIONAL_SCALAR_ATTRIBUTES,
+                            ARCHITECTURAL_HYPERS.USE_LONG_RANGE,
+                            ARCHITECTURAL_HYPERS.K_CUT,
+                            n_workers = FITTING_SCHEME.NUM_WORKERS_PREPROCESSING,
+                            cache_dir = FITTING_SCHEME.GRAPHS_CACHE_DIR)
+    for key, values in targets.items():
+        update_pyg_graphs(graphs, key, values)
+    return graphs
 
 
 def get_compositional_features(structures, all_species):
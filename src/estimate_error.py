@@ -1,19 +1,39 @@
 
 
+import os
 import torch
 import ase.io
 import numpy as np
 from tqdm import tqdm
-from torch_geometric.loader import DataLoader, DataListLoader
+from torch.utils.data import DataLoader
 import time
 from torch_geometric.nn import DataParallel
 import argparse
+import itertools
 
 from .hypers import load_hypers_from_file
 from .pet import PET, PETMLIPWrapper, PETUtilityWrapper
-from .utilities import get_rmse, get_mae, set_reproducibility, Accumulator, report_accuracy
+from .quantization import quantize_linear_layers
+from .onnx_backend import export_onnx, get_onnx_path, ONNXModel
+from .utilities import set_reproducibility, Accumulator, RunningAccuracy, NpyAppender, get_autocast, warmup
 from .data_preparation import get_pyg_graphs, get_compositional_features
 from .data_preparation import get_targets
+from .molecule import PaddingCollater
+from .batch_samplers import get_batch_sampler, get_nums, report_padding_fraction, restore_order, uses_batch_sampler
+
+def get_structures_chunks(structures_path, streaming, chunk_size):
+    '''Yields all the structures at once, or, if streaming is True, consecutive 
+    chunks of chunk_size structures read lazily from the file'''
+    if not streaming:
+        yield ase.io.read(structures_path, index = ':')
+        return
+    
+    structures_iterator = ase.io.iread(structures_path, index = ':')
+    while True:
+        chunk = list(itertools.islice(structures_iterator, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield chunk
 
 def main():
     parser = argparse.ArgumentParser()
@@ -29,10 +49,40 @@ def main():
     parser.add_argument("--path_save_predictions", help="Path to a folder where to save predictions.", type = str)
     parser.add_argument("--verbose", help="Show more details",
                         action="store_true")
+    parser.add_argument("--max_atoms_per_batch", help="Pack structures into batches of at most this number of atoms; batch_size is then ignored",
+                        type = int)
+    parser.add_argument("--max_tokens_per_batch", help="Pack structures into batches of at most this number of atoms times the maximal number of neighbors; batch_size is then ignored",
+                        type = int)
+    parser.add_argument("--num_workers_preprocessing", help="Number of processes building neighbor lists and graphs",
+                        type = int, default = 1)
+    parser.add_argument("--graphs_cache_dir", help="Directory to cache preprocessed graphs between runs", type = str)
+    parser.add_argument("--bucketed_batches", help="Batch together structures with similar maximal numbers of neighbors",
+                        action="store_true")
+    parser.add_argument("--streaming", help="Read, process and save structures in chunks, never keeping all of them in memory",
+                        action="store_true")
+    parser.add_argument("--streaming_chunk_size", help="Number of structures per chunk in the streaming mode",
+                        type = int, default = 1000)
+    parser.add_argument("--mixed_precision", help="Run the model under autocast with bf16 or fp16",
+                        type = str, choices = ['bf16', 'fp16'])
+    parser.add_argument("--compile", help="Run the model compiled by torch.compile, with batches padded to a few shapes",
+                        action="store_true")
+    parser.add_argument("--compile_shape_buckets", help="Number of padded sizes per doubling of the numbers of atoms and neighbors in the compiled mode",
+                        type = int, default = 4)
+    parser.add_argument("--backend", help="torch, or onnx to run the model exported to path_to_calc_folder/checkpoint.onnx, or checkpoint_grad.onnx with the gradients for forces or virials, by onnxruntime on the CPU; it is exported first if the file does not exist",
+                        type = str, choices = ['torch', 'onnx'], default = 'torch')
+    parser.add_argument("--virials", help="Also predict the virials, -stress * volume, from the same gradients as the forces",
+                        action="store_true")
+    parser.add_argument("--quantize", help="Run the linear layers of the model in int8 on the CPU; see pet_quantization_report for the loss of accuracy",
+                        action="store_true")
 
     args = parser.parse_args()
+    if args.quantize and args.compile:
+        raise ValueError("--quantize and --compile can not be used together")
+    if args.backend == 'onnx' and (args.quantize or args.compile or args.mixed_precision is not None):
+        raise ValueError("--quantize, --compile and --mixed_precision are options of the torch backend")
 
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    # the int8 kernels and onnxruntime are used only on CPUs
+    device = torch.device("cuda:0" if torch.cuda.is_available() and not args.quantize and args.backend == 'torch' else "cpu")
 
     HYPERS_PATH = args.path_to_calc_folder + '/hypers_used.yaml'
     PATH_TO_MODEL_STATE_DICT = args.path_to_calc_folder + '/' + args.checkpoint + '_state_dict'
@@ -49,6 +99,8 @@ def main():
     hypers = load_hypers_from_file(HYPERS_PATH)
     if hypers.UTILITY_FLAGS.CALCULATION_TYPE not in ['general_target', 'mlip']:
         raise ValueError("unknown calculation type")
+    if args.virials and hypers.UTILITY_FLAGS.CALCULATION_TYPE != 'mlip':
+        raise ValueError("--virials is supported only for MLIP calculations")
     
     FITTING_SCHEME = hypers.FITTING_SCHEME
     
@@ -59,126 +111,187 @@ def main():
     if args.batch_size == -1:
         args.batch_size = FITTING_SCHEME.STRUCTURAL_BATCH_SIZE
 
-    structures = ase.io.read(args.structures_path, index = ':')
-
     all_species = np.load(ALL_SPECIES_PATH)
-
-    graphs = get_pyg_graphs(structures, all_species, ARCHITECTURAL_HYPERS.R_CUT, 
-                            ARCHITECTURAL_HYPERS.USE_ADDITIONAL_SCALAR_ATTRIBUTES,
-                            ARCHITECTURAL_HYPERS.USE_LONG_RANGE,
-                            ARCHITECTURAL_HYPERS.K_CUT)
-
-    if FITTING_SCHEME.MULTI_GPU:
-        loader = DataListLoader(graphs, batch_size=args.batch_size, shuffle=False)
-    else:        
-        loader = DataLoader(graphs, batch_size=args.batch_size, shuffle=False)
+    collater = PaddingCollater(len(all_species), as_list = FITTING_SCHEME.MULTI_GPU)
 
     model = PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species)).to(device)
     model = PETUtilityWrapper(model,
                 FITTING_SCHEME.GLOBAL_AUG)
+    utility_wrapper = model
+    if args.compile:
+        if FITTING_SCHEME.MULTI_GPU:
+            raise ValueError("compilation is not supported with MULTI_GPU")
+        utility_wrapper.enable_compilation(args.compile_shape_buckets)
     
     if hypers.UTILITY_FLAGS.CALCULATION_TYPE == 'mlip':
         model = PETMLIPWrapper(model, hypers.MLIP_SETTINGS.USE_ENERGIES,
-                            hypers.MLIP_SETTINGS.USE_FORCES)
+                            hypers.MLIP_SETTINGS.USE_FORCES, args.virials)
 
     if FITTING_SCHEME.MULTI_GPU and torch.cuda.is_available():
         model = DataParallel(model)
         model = model.to( torch.device('cuda:0'))
 
-    model.load_state_dict(torch.load(PATH_TO_MODEL_STATE_DICT))
+    model.load_state_dict(torch.load(PATH_TO_MODEL_STATE_DICT, map_location = device))
     model.eval()
-
-    # warmup for correct time estimation
-    for batch in loader:
+    if args.quantize:
+        if FITTING_SCHEME.MULTI_GPU:
+            raise ValueError("--quantize is not supported for models fitted with MULTI_GPU")
+        quantize_linear_layers(utility_wrapper.pet_model)
+    if args.backend == 'onnx':
+        if FITTING_SCHEME.MULTI_GPU:
+            raise ValueError("the onnx backend is not supported for models fitted with MULTI_GPU")
+        use_gradients = hypers.UTILITY_FLAGS.CALCULATION_TYPE == 'mlip' and (hypers.MLIP_SETTINGS.USE_FORCES or args.virials)
+        onnx_path = get_onnx_path(args.path_to_calc_folder, args.checkpoint, use_gradients)
+        if not os.path.exists(onnx_path):
+            print(f"exporting the model to {onnx_path}")
+            export_onnx(utility_wrapper.pet_model, onnx_path, use_gradients)
+        model = ONNXModel(onnx_path, hypers, use_virials = args.virials)
+
+    def run_model(batch):
         if not FITTING_SCHEME.MULTI_GPU:
             batch.to(device)
-        if hypers.UTILITY_FLAGS.CALCULATION_TYPE == 'mlip':
-            _ = model(batch, augmentation = USE_AUGMENTATION, create_graph = False)
-        else:
-            _ = model(batch, augmentation = USE_AUGMENTATION)
-        break
-
-    begin = time.time()
-    batch_accumulator = Accumulator()
-    aug_accumulator = Accumulator()
-
-    for _ in tqdm(range(N_AUG)):
-        for batch in loader:
-            if not FITTING_SCHEME.MULTI_GPU:
-                batch.to(device)
-
+        with get_autocast(device, args.mixed_precision):
             if hypers.UTILITY_FLAGS.CALCULATION_TYPE == 'mlip':
-                predictions_batch = model(batch, augmentation = USE_AUGMENTATION, create_graph = False)
+                return model(batch, augmentation = USE_AUGMENTATION, create_graph = False)
             else:
-                predictions_batch = model(batch, augmentation = USE_AUGMENTATION)
-            
-            batch_accumulator.update(predictions_batch)
-        predictions = batch_accumulator.flush()
-        for index in range(len(predictions)):
-            if predictions[index] is not None:
-                predictions[index] = predictions[index][np.newaxis]
-        aug_accumulator.update(predictions)
-
-    all_predictions = aug_accumulator.flush()
-
-    total_time = time.time() - begin
-    n_atoms = np.array([len(struc.positions) for struc in structures])
-    time_per_atom = total_time / (np.sum(n_atoms) * N_AUG)
+                return model(batch, augmentation = USE_AUGMENTATION)
 
     if hypers.UTILITY_FLAGS.CALCULATION_TYPE == 'mlip':
-        all_energies_predicted, all_forces_predicted = all_predictions
         MLIP_SETTINGS = hypers.MLIP_SETTINGS
         if MLIP_SETTINGS.USE_ENERGIES:
             self_contributions = np.load(SELF_CONTRIBUTIONS_PATH)
-            energies_ground_truth = np.array([struc.info[MLIP_SETTINGS.ENERGY_KEY] for struc in structures])
-
-            compositional_features = get_compositional_features(structures, all_species)
-            self_contributions_energies = []
-            for i in range(len(structures)):
-                self_contributions_energies.append(np.dot(compositional_features[i], self_contributions))
-            self_contributions_energies = np.array(self_contributions_energies)
-
-            all_energies_predicted = all_energies_predicted + self_contributions_energies[:, np.newaxis]
-
-            report_accuracy(all_energies_predicted, energies_ground_truth, "energies",
-                            args.verbose, specify_per_component = False,
-                            target_type = 'structural', n_atoms = n_atoms,
-                            support_missing_values=FITTING_SCHEME.SUPPORT_MISSING_VALUES)
-
-        if MLIP_SETTINGS.USE_FORCES:
-            forces_ground_truth = [struc.arrays[MLIP_SETTINGS.FORCES_KEY] for struc in structures]
-            forces_ground_truth = np.concatenate(forces_ground_truth, axis = 0)
-            report_accuracy(all_forces_predicted, forces_ground_truth, "forces",
-                            args.verbose, specify_per_component = True,
-                            target_type = 'atomic', n_atoms = n_atoms,
-                            support_missing_values=FITTING_SCHEME.SUPPORT_MISSING_VALUES)
-            
-        if args.path_save_predictions is not None:
-            energies_predicted_mean = np.mean(all_energies_predicted, axis = 0)
-            forces_predicted_mean = np.mean(all_forces_predicted, axis = 0)
+        accuracies = [RunningAccuracy("energies", args.verbose, specify_per_component = False,
+                                      target_type = 'structural',
+                                      support_missing_values = FITTING_SCHEME.SUPPORT_MISSING_VALUES)
+                      if MLIP_SETTINGS.USE_ENERGIES else None,
+                      RunningAccuracy("forces", args.verbose, specify_per_component = True,
+                                      target_type = 'atomic',
+                                      support_missing_values = FITTING_SCHEME.SUPPORT_MISSING_VALUES)
+                      if MLIP_SETTINGS.USE_FORCES else None]
+        names = ['energies', 'forces']
+        atomic = [False, True]
+        if args.virials:
+            # ground truth virials are available if the model was fitted on them
+            fitted_virials = getattr(MLIP_SETTINGS, 'USE_VIRIALS', False)
+            accuracies.append(RunningAccuracy("virials", args.verbose, specify_per_component = True,
+                                              target_type = 'structural',
+                                              support_missing_values = FITTING_SCHEME.SUPPORT_MISSING_VALUES)
+                              if fitted_virials else None)
+            names.append('virials')
+            atomic.append(False)
+    else:
+        GENERAL_TARGET_SETTINGS = hypers.GENERAL_TARGET_SETTINGS
+        accuracies = [RunningAccuracy(GENERAL_TARGET_SETTINGS.TARGET_KEY, args.verbose, specify_per_component = True,
+                                      target_type = GENERAL_TARGET_SETTINGS.TARGET_TYPE,
+                                      support_missing_values = FITTING_SCHEME.SUPPORT_MISSING_VALUES)]
+        names = ['targets']
+        atomic = [GENERAL_TARGET_SETTINGS.TARGET_TYPE == 'atomic']
+
+    if args.path_save_predictions is not None:
+        appenders = [NpyAppender(args.path_save_predictions + f'/{name}_predicted.npy')
+                     if accuracy is not None or name == 'virials' else None for name, accuracy in zip(names, accuracies)]
+
+    total_time = 0.0
+    total_n_atoms = 0
+    for chunk_index, structures in enumerate(get_structures_chunks(args.structures_path, args.streaming,
+                                                                   args.streaming_chunk_size)):
+        graphs = get_pyg_graphs(structures, all_species, ARCHITECTURAL_HYPERS.R_CUT, 
+                                ARCHITECTURAL_HYPERS.USE_ADDITIONAL_SCALAR_ATTRIBUTES,
+                                ARCHITECTURAL_HYPERS.USE_LONG_RANGE,
+                                ARCHITECTURAL_HYPERS.K_CUT,
+                                n_workers = args.num_workers_preprocessing,
+                                cache_dir = args.graphs_cache_dir)
+
+        if uses_batch_sampler(args.bucketed_batches, args.max_atoms_per_batch, args.max_tokens_per_batch):
+            nums = get_nums(graphs)
+            sampler = get_batch_sampler(nums, args.batch_size, False, args.bucketed_batches,
+                                        max_atoms = args.max_atoms_per_batch, max_tokens = args.max_tokens_per_batch)
+            report_padding_fraction(nums, args.batch_size, sampler, 'inference')
+            loader = DataLoader(graphs, batch_sampler=sampler, collate_fn=collater)
+        else:
+            sampler = None
+            loader = DataLoader(graphs, batch_size=args.batch_size, shuffle=False, collate_fn=collater)
+
+        if chunk_index == 0:
+            # warmup for correct time estimation
+            warmup(run_model, loader, utility_wrapper.get_padded_shape if args.compile else None)
+
+        begin = time.time()
+        batch_accumulator = Accumulator()
+        aug_accumulator = Accumulator()
+
+        for _ in tqdm(range(N_AUG), disable = args.streaming):
+            for batch in loader:
+                predictions_batch = run_model(batch)
+                batch_accumulator.update(predictions_batch)
+            predictions = batch_accumulator.flush()
+            for index in range(len(predictions)):
+                if predictions[index] is not None:
+                    predictions[index] = predictions[index][np.newaxis]
+            aug_accumulator.update(predictions)
+
+        all_predictions = aug_accumulator.flush()
+
+        total_time += time.time() - begin
+        n_atoms = np.array([len(struc.positions) for struc in structures])
+        total_n_atoms += np.sum(n_atoms)
+
+        if sampler is not None:
+            # batches follow the order of the sampler
+            order = sampler.get_order()
+            for index in range(len(all_predictions)):
+                if all_predictions[index] is not None:
+                    predictions = np.swapaxes(all_predictions[index], 0, 1)
+                    predictions = restore_order(predictions, order, n_atoms if atomic[index] else None)
+                    all_predictions[index] = np.swapaxes(predictions, 0, 1)
+
+        if hypers.UTILITY_FLAGS.CALCULATION_TYPE == 'mlip':
+            all_energies_predicted, all_forces_predicted = all_predictions[:2]
             if MLIP_SETTINGS.USE_ENERGIES:
-                np.save(args.path_save_predictions + '/energies_predicted.npy', energies_predicted_mean)
+                energies_ground_truth = np.array([struc.info[MLIP_SETTINGS.ENERGY_KEY] for struc in structures])
+
+                compositional_features = get_compositional_features(structures, all_species)
+                self_contributions_energies = []
+                for i in range(len(structures)):
+                    self_contributions_energies.append(np.dot(compositional_features[i], self_contributions))
+                self_contributions_energies = np.array(self_contributions_energies)
+
+                all_energies_predicted = all_energies_predicted + self_contributions_energies[:, np.newaxis]
+                accuracies[0].update(all_energies_predicted, energies_ground_truth, n_atoms)
+
             if MLIP_SETTINGS.USE_FORCES:
-                np.save(args.path_save_predictions + '/forces_predicted.npy', forces_predicted_mean)
-            
-    if hypers.UTILITY_FLAGS.CALCULATION_TYPE == 'general_target':
-        if len(all_predictions) != 1:
-            raise ValueError("for general target model should predict only one target")
-        all_targets_predicted = all_predictions[0]
-        GENERAL_TARGET_SETTINGS = hypers.GENERAL_TARGET_SETTINGS
-        ground_truth = get_targets(structures, GENERAL_TARGET_SETTINGS)
-        ground_truth = [el.data.cpu().numpy() for el in ground_truth]
-        ground_truth = np.concatenate(ground_truth, axis = 0)
-
-        report_accuracy(all_targets_predicted, ground_truth, GENERAL_TARGET_SETTINGS.TARGET_KEY,
-                        args.verbose, specify_per_component = True,
-                        target_type = GENERAL_TARGET_SETTINGS.TARGET_TYPE, n_atoms = n_atoms,
-                        support_missing_values=FITTING_SCHEME.SUPPORT_MISSING_VALUES)
-        
+                forces_ground_truth = [struc.arrays[MLIP_SETTINGS.FORCES_KEY] for struc in structures]
+                forces_ground_truth = np.concatenate(forces_ground_truth, axis = 0)
+                accuracies[1].update(all_forces_predicted, forces_ground_truth, n_atoms)
+
+            if args.virials and accuracies[2] is not None:
+                virials_ground_truth = np.array([np.reshape(struc.info[MLIP_SETTINGS.VIRIALS_KEY], [9]) for struc in structures])
+                accuracies[2].update(np.reshape(all_predictions[2], [N_AUG, -1, 9]), virials_ground_truth, n_atoms)
+            all_predictions = [all_energies_predicted, all_forces_predicted] + all_predictions[2:]
+                
+        if hypers.UTILITY_FLAGS.CALCULATION_TYPE == 'general_target':
+            if len(all_predictions) != 1:
+                raise ValueError("for general target model should predict only one target")
+            ground_truth = get_targets(structures, GENERAL_TARGET_SETTINGS)
+            ground_truth = [el.data.cpu().numpy() for el in ground_truth]
+            ground_truth = np.concatenate(ground_truth, axis = 0)
+            accuracies[0].update(all_predictions[0], ground_truth, n_atoms)
+
         if args.path_save_predictions is not None:
-            targets_predicted_mean = np.mean(all_targets_predicted, axis = 0)
-            np.save(args.path_save_predictions + '/targets_predicted.npy', targets_predicted_mean)
+            for appender, predictions in zip(appenders, all_predictions):
+                if appender is not None:
+                    appender.append(np.mean(predictions, axis = 0))
+
+    if args.path_save_predictions is not None:
+        for appender in appenders:
+            if appender is not None:
+                appender.close()
+
+    for accuracy in accuracies:
+        if accuracy is not None:
+            accuracy.report()
 
+    time_per_atom = total_time / (total_n_atoms * N_AUG)
     if args.verbose:
         print(f"approximate time per atom not including neighbor list construction for batch size of {args.batch_size}: {time_per_atom} seconds")
 
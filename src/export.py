@@ -0,0 +1,157 @@
+import torch
+import numpy as np
+import argparse
+from typing import Dict
+
+from .hypers import load_hypers_from_file
+from .pet import PET, PETMLIPWrapper, PETUtilityWrapper
+from .neighbor_list import get_neighbor_list, get_neighbors_pos
+from .onnx_backend import export_from_folder
+
+
+class ExportedMLIP(torch.nn.Module):
+    '''Energies and forces of a single structure given by positions, atomic numbers,
+    cell and pbc, as computed by SingleStructCalculator. Neighbors are found by the
+    torch cell list, so that the whole computation is scriptable and the scripted
+    module does not depend on pet, torch_geometric or ase'''
+
+    def __init__(self, pet_model, all_species, self_contributions, use_forces):
+        super(ExportedMLIP, self).__init__()
+        self.pet_model = pet_model
+        self.r_cut = float(pet_model.R_CUT)
+        self.n_species = len(all_species)
+        self.use_forces = use_forces
+
+        species_lookup = torch.full([int(np.max(all_species)) + 1], -1, dtype = torch.long)
+        species_lookup[torch.LongTensor(all_species)] = torch.arange(len(all_species))
+        self.register_buffer('species_lookup', species_lookup)
+        if self_contributions is None:
+            self_contributions = np.zeros(len(all_species))
+        self.register_buffer('self_contributions', torch.tensor(self_contributions, dtype = torch.float64))
+
+    def get_species(self, atomic_numbers : torch.Tensor):
+        if atomic_numbers.shape[0] > 0:
+            if int(torch.max(atomic_numbers)) >= self.species_lookup.shape[0]:
+                raise ValueError("unknown species")
+        species = self.species_lookup[atomic_numbers]
+        if bool(torch.any(species < 0)):
+            raise ValueError("unknown species")
+        return species
+
+    def get_batch_dict(self, positions : torch.Tensor, central_species : torch.Tensor,
+                       cell : torch.Tensor, pbc : torch.Tensor) -> Dict[str, torch.Tensor]:
+        '''The same as batch_to_dict of the padded graph of Molecule'''
+        n_atoms = positions.shape[0]
+        with torch.no_grad():
+            i, j, _, S = get_neighbor_list(positions, cell, pbc, self.r_cut)
+            neighbors_pos = get_neighbors_pos(i, j, S, n_atoms)
+        # recomputed to be differentiable with respect to positions
+        D = positions[j] - positions[i] + S.to(positions.dtype) @ cell
+
+        nums = torch.bincount(i, minlength = n_atoms)
+        max_num = 1
+        if n_atoms > 0:
+            max_num = max(1, int(torch.max(nums)))
+        first_neighbors = torch.cumsum(nums, dim = 0) - nums
+        neighbor_indices = torch.arange(i.shape[0], device = i.device) - first_neighbors[i]
+
+        device = positions.device
+        x = torch.zeros([n_atoms, max_num, 3], dtype = positions.dtype, device = device)
+        x = x.index_put((i, neighbor_indices), D).to(torch.float32)
+        neighbor_species = torch.full([n_atoms, max_num], self.n_species, dtype = torch.long, device = device)
+        neighbor_species[i, neighbor_indices] = central_species[j]
+        neighbors_index = torch.zeros([n_atoms, max_num], dtype = torch.long, device = device)
+        neighbors_index[i, neighbor_indices] = j
+        padded_neighbors_pos = torch.zeros([n_atoms, max_num], dtype = torch.long, device = device)
+        padded_neighbors_pos[i, neighbor_indices] = neighbors_pos
+        mask = torch.ones([n_atoms, max_num], dtype = torch.bool, device = device)
+        mask[i, neighbor_indices] = False
+
+        return {"x" : x,
+                "central_species" : central_species,
+                "neighbor_species" : neighbor_species,
+                "mask" : mask,
+                "batch" : torch.zeros([n_atoms], dtype = torch.long, device = device),
+                "nums" : nums.to(torch.float32),
+                "neighbors_index" : neighbors_index,
+                "neighbors_pos" : padded_neighbors_pos}
+
+    def forward(self, positions : torch.Tensor, atomic_numbers : torch.Tensor,
+                cell : torch.Tensor, pbc : torch.Tensor) -> Dict[str, torch.Tensor]:
+        positions = positions.to(torch.float64)
+        cell = cell.to(torch.float64)
+        if self.use_forces:
+            positions = positions.detach().requires_grad_(True)
+        central_species = self.get_species(atomic_numbers)
+
+        batch_dict = self.get_batch_dict(positions, central_species, cell, pbc)
+        predictions = self.pet_model(batch_dict, None)
+        energy = predictions.sum().to(torch.float64) + self.self_contributions[central_species].sum()
+
+        with torch.no_grad():
+            # detach would be removed by freezing
+            result = {"energy" : energy.clone()}
+        if self.use_forces:
+            gradients = torch.autograd.grad([energy], [positions])[0]
+            if gradients is None:
+                gradients = torch.zeros_like(positions)
+            result["forces"] = -gradients
+        return result
+
+
+def load_exportable(path_to_calc_folder, checkpoint):
+    '''ExportedMLIP with the model of the given calculation, on the CPU'''
+    hypers = load_hypers_from_file(path_to_calc_folder + '/hypers_used.yaml')
+    MLIP_SETTINGS = hypers.MLIP_SETTINGS
+    ARCHITECTURAL_HYPERS = hypers.ARCHITECTURAL_HYPERS
+    if hypers.UTILITY_FLAGS.CALCULATION_TYPE != 'mlip':
+        raise ValueError("only MLIP models can be exported")
+    if ARCHITECTURAL_HYPERS.USE_ADDITIONAL_SCALAR_ATTRIBUTES or ARCHITECTURAL_HYPERS.USE_LONG_RANGE:
+        raise NotImplementedError("export of models with scalar attributes or long range is not supported")
+
+    all_species = np.load(path_to_calc_folder + '/all_species.npy')
+    self_contributions = None
+    if MLIP_SETTINGS.USE_ENERGIES:
+        self_contributions = np.load(path_to_calc_folder + '/self_contributions.npy')
+
+    model = PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species))
+    model = PETMLIPWrapper(PETUtilityWrapper(model, hypers.FITTING_SCHEME.GLOBAL_AUG),
+                           MLIP_SETTINGS.USE_ENERGIES, MLIP_SETTINGS.USE_FORCES)
+    state_dict = torch.load(path_to_calc_folder + '/' + checkpoint + '_state_dict', map_location = 'cpu')
+    # models fitted with MULTI_GPU are saved wrapped into DataParallel
+    state_dict = {(key[len('module.'):] if key.startswith('module.') else key) : value
+                  for key, value in state_dict.items()}
+    model.load_state_dict(state_dict)
+    return ExportedMLIP(model.model.pet_model, all_species, self_contributions, MLIP_SETTINGS.USE_FORCES)
+
+
+def export(path_to_calc_folder, checkpoint, output_path):
+    '''Saves the frozen TorchScript module of the given model, which loads
+    with torch.jit.load alone. hypers_used.yaml is stored as an extra file'''
+    module = load_exportable(path_to_calc_folder, checkpoint)
+    module.eval()
+    module = torch.jit.freeze(torch.jit.script(module))
+    with open(path_to_calc_folder + '/hypers_used.yaml', 'r') as f:
+        extra_files = {'hypers_used.yaml' : f.read()}
+    torch.jit.save(module, output_path, _extra_files = extra_files)
+    return module
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path_to_calc_folder", help="Path to a folder with a model to export", type = str)
+    parser.add_argument("checkpoint", help="Checkpoint to export, such as best_val_rmse_both_model", type = str)
+    parser.add_argument("output_path", help="Path of the TorchScript or ONNX file to write", type = str)
+    parser.add_argument("--format", help="torchscript for the whole MLIP computation, or onnx for the graph of PET and its gradients, to be run by pet_run --backend onnx or onnxruntime",
+                        type = str, choices = ['torchscript', 'onnx'], default = 'torchscript')
+    args = parser.parse_args()
+
+    if args.format == 'onnx':
+        export_from_folder(args.path_to_calc_folder, args.checkpoint, args.output_path)
+    else:
+        export(args.path_to_calc_folder, args.checkpoint, args.output_path)
+    print(f"exported {args.path_to_calc_folder}/{args.checkpoint} to {args.output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import os
+import copy
+import pickle
+import hashlib
+import numpy as np
+
+# should be increased whenever the content of cached graphs changes
+CACHE_VERSION = 2
+
+
+def get_settings_hash(all_species, R_CUT, USE_ADDITIONAL_SCALAR_ATTRIBUTES, USE_LONG_RANGE, K_CUT):
+    hasher = hashlib.sha256()
+    hasher.update(str(CACHE_VERSION).encode())
+    hasher.update(np.asarray(all_species, dtype = np.int64).tobytes())
+    settings = [R_CUT, USE_ADDITIONAL_SCALAR_ATTRIBUTES, USE_LONG_RANGE, K_CUT]
+    hasher.update(repr([repr(value) for value in settings]).encode())
+    return hasher.hexdigest()
+
+
+def get_structure_hash(structure, use_additional_scalar_attributes, tolerance = 0.0):
+    '''With positive tolerance, positions and cell are rounded to multiples of it,
+    so that geometries differing by less than the tolerance share the hash,
+    unless they fall on different sides of a rounding boundary'''
+    hasher = hashlib.sha256()
+    geometry = [np.asarray(structure.get_positions(), dtype = np.float64),
+                np.asarray(structure.get_cell(), dtype = np.float64)]
+    if tolerance > 0.0:
+        geometry = [np.round(array / tolerance).astype(np.int64) for array in geometry]
+    arrays = [np.asarray(structure.get_atomic_numbers(), dtype = np.int64),
+              *geometry,
+              np.asarray(structure.get_pbc(), dtype = bool)]
+    if use_additional_scalar_attributes:
+        arrays.append(np.asarray(structure.arrays['scalar_attributes'], dtype = np.float64))
+    for array in arrays:
+        hasher.update(np.ascontiguousarray(array).tobytes())
+    return hasher.hexdigest()
+
+
+class GraphCache:
+    '''Persistent cache of graphs addressed by the content of each structure
+    and the settings of graph construction.
+
+    Graphs are stored in chunks; each chunk consists of a file with the hashes
+    of its structures and a pickle with the graphs. Chunks are never modified,
+    so several processes can share the same cache directory'''
+
+    def __init__(self, cache_dir, all_species, R_CUT, USE_ADDITIONAL_SCALAR_ATTRIBUTES,
+                 USE_LONG_RANGE, K_CUT, chunk_size = 10000):
+        settings_hash = get_settings_hash(all_species, R_CUT, USE_ADDITIONAL_SCALAR_ATTRIBUTES,
+                                          USE_LONG_RANGE, K_CUT)
+        self.path = os.path.join(cache_dir, settings_hash)
+        os.makedirs(self.path, exist_ok = True)
+        self.use_additional_scalar_attributes = USE_ADDITIONAL_SCALAR_ATTRIBUTES
+        self.chunk_size = chunk_size
+
+    def get_keys(self, structures):
+        return [get_structure_hash(structure, self.use_additional_scalar_attributes)
+                for structure in structures]
+
+    def load(self, keys):
+        '''Returns the list of cached graphs with None for missing keys. Repeated
+        keys get separate copies, so that targets can be set for each of them'''
+        needed = set(keys)
+        found = {}
+        for name in sorted(os.listdir(self.path)):
+            if not name.endswith('.hashes'):
+                continue
+            chunk_name = name[:-len('.hashes')]
+            with open(os.path.join(self.path, name), 'r') as f:
+                chunk_keys = f.read().split()
+            if not needed.intersection(chunk_keys):
+                continue
+            with open(os.path.join(self.path, chunk_name + '.pickle'), 'rb') as f:
+                chunk_graphs = pickle.load(f)
+            for key, graph in zip(chunk_keys, chunk_graphs):
+                if key in needed:
+                    found[key] = graph
+                    needed.remove(key)
+            if not needed:
+                break
+        return [copy.copy(found[key]) if key in found else None for key in keys]
+
+    def save(self, keys, graphs):
+        for index in range(0, len(keys), self.chunk_size):
+            chunk_keys = keys[index : index + self.chunk_size]
+            chunk_graphs = graphs[index : index + self.chunk_size]
+            chunk_name = hashlib.sha256(''.join(chunk_keys).encode()).hexdigest()
+
+            # the pickle is written first and both files are moved atomically,
+            # so that a chunk is visible only when it is complete
+            self.write_atomically(chunk_name + '.pickle', pickle.dumps(chunk_graphs))
+            self.write_atomically(chunk_name + '.hashes', '\n'.join(chunk_keys).encode())
+
+    def write_atomically(self, name, content):
+        path = os.path.join(self.path, name)
+        path_tmp = f"{path}.tmp{os.getpid()}"
+        with open(path_tmp, 'wb') as f:
+            f.write(content)
+        os.replace(path_tmp, path)
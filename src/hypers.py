@@ -3,6 +3,11 @@ import warnings
 import re
 import inspect
 
+def validate_mixed_precision(value):
+    if value not in (None, 'bf16', 'fp16'):
+        raise ValueError("unknown mixed precision; should be None, bf16 or fp16")
+    return value
+
 def propagate_duplicated_params(provided_hypers, default_hypers, first_key, second_key):
    
     if (first_key in provided_hypers.keys()) and (second_key in provided_hypers.keys()):
@@ -71,10 +76,22 @@ def combine_hypers(provided_hypers, default_hypers):
         if (result['FITTING_SCHEME']['ENERGY_WEIGHT'] is not None):
             warnings.warn("ENERGY_WEIGHT was provided, but in the current calculation, it doesn't affect anything since only one target of energies and forces is used")
 
+    if result['MLIP_SETTINGS']['USE_VIRIALS']:
+        if (not result['MLIP_SETTINGS']['USE_ENERGIES']) or (not result['MLIP_SETTINGS']['USE_FORCES']):
+            raise ValueError("virials can be fitted only together with energies and forces")
+
     if result['ARCHITECTURAL_HYPERS']['USE_ADDITIONAL_SCALAR_ATTRIBUTES']:
         if result['ARCHITECTURAL_HYPERS']['SCALAR_ATTRIBUTES_SIZE'] is None:
             raise ValueError("scalar attributes size must be provided if use_additional_scalar_attributes == True")
         
+    if (result['FITTING_SCHEME']['MAX_ATOMS_PER_BATCH'] is not None) and (result['FITTING_SCHEME']['MAX_TOKENS_PER_BATCH'] is not None):
+        raise ValueError("only one of MAX_ATOMS_PER_BATCH and MAX_TOKENS_PER_BATCH should be provided")
+        
+    validate_mixed_precision(result['FITTING_SCHEME']['MIXED_PRECISION'])
+
+    if result['FITTING_SCHEME']['COMPILE'] and result['FITTING_SCHEME']['MULTI_GPU']:
+        raise ValueError("COMPILE is not supported with MULTI_GPU")
+
     if result['FITTING_SCHEME']['DO_GRADIENT_CLIPPING']:
         if result['FITTING_SCHEME']['GRADIENT_CLIPPING_MAX_NORM'] is None:
             raise ValueError("gradient clipping max_norm must be provided if do_gradient_clipping == True")
@@ -1,78 +1,120 @@
 
 import torch
 import ase.io
+import ase.neighborlist
 import numpy as np
-from torch_geometric.data import Data
+from torch_geometric.data import Data, Batch
 from .long_range import get_reciprocal, get_all_k
+from .neighbor_list import get_neighbor_list_numpy
 
+def get_reverse_pairs(i_list, j_list, S_list):
+    '''For each pair (i, j, S) of the neighbor list finds the index of the 
+    reverse pair (j, i, -S) in the neighbor list.
+    Pairs are matched by sorting both keys instead of scanning neighbor lists'''
+    forward = np.lexsort((S_list[:, 2], S_list[:, 1], S_list[:, 0], j_list, i_list))
+    backward = np.lexsort((-S_list[:, 2], -S_list[:, 1], -S_list[:, 0], i_list, j_list))
+    reverse = np.empty(len(i_list), dtype = int)
+    reverse[backward] = forward
+    
+    if not (np.array_equal(i_list[reverse], j_list) and np.array_equal(j_list[reverse], i_list)
+            and np.array_equal(S_list[reverse], -S_list)):
+        raise ValueError("neighbor list is not symmetric")
+    return reverse
+
+def get_neighbors_pos(i_list, j_list, S_list, n_atoms):
+    '''For each pair (i, j, S) of the neighbor list finds the position of the 
+    reverse pair (j, i, -S) within the neighbors of atom j'''
+    
+    n_pairs = len(i_list)
+    counts = np.bincount(i_list, minlength = n_atoms)
+    offsets = np.cumsum(counts) - counts
+    
+    # position of each pair within the neighbors of its central atom
+    order = np.argsort(i_list, kind = 'stable')
+    local_index = np.empty(n_pairs, dtype = int)
+    local_index[order] = np.arange(n_pairs) - offsets[i_list[order]]
+    
+    return local_index[get_reverse_pairs(i_list, j_list, S_list)]
+
+def get_species_lookup(all_species):
+    '''Table mapping atomic numbers to indices in all_species; 
+    -1 for the species not in all_species'''
+    lookup = np.full(np.max(all_species) + 1, -1, dtype = int)
+    lookup[all_species] = np.arange(len(all_species))
+    return lookup
+
+def get_species_indices(species, all_species):
+    lookup = get_species_lookup(all_species)
+    if len(species) > 0 and np.max(species) >= len(lookup):
+        raise ValueError("unknown species")
+    result = lookup[species]
+    if np.any(result < 0):
+        raise ValueError("unknown species")
+    return result
+    
 class Molecule():
+    '''Neighbors of all the atoms are stored concatenated, sorted by the central atom; 
+    the neighbors of atom i are entries offsets[i] : offsets[i + 1].
+    
+    If neighbor_list_device is provided, neighbors are found by the torch 
+    cell list on this device instead of ASE'''
+    __slots__ = ['n_atoms', 'central_species', 'central_scalar_attributes', 'offsets', 
+                 'relative_positions', 'neighbors_index', 'neighbors_shift', 'neighbor_species', 
+                 'neighbors_pos', 'neighbor_scalar_attributes', 'use_additional_scalar_attributes', 
+                 'use_long_range', 'cell', 'reciprocal', 'k_vectors', 'k_cut']
+    
     def __init__(self, atoms, r_cut, use_additional_scalar_attributes, 
-                 use_long_range, k_cut):
+                 use_long_range, k_cut, neighbor_list_device = None):
         
         self.use_additional_scalar_attributes = use_additional_scalar_attributes
-             
-        self.atoms = atoms
-        
-        positions = self.atoms.get_positions()
-        species = self.atoms.get_atomic_numbers()
+        self.n_atoms = len(atoms)
         
-        self.central_species = []
-        for i in range(len(positions)):
-            self.central_species.append(species[i])
+        species = atoms.get_atomic_numbers()
+        self.central_species = species
                    
         if use_additional_scalar_attributes:
-            scalar_attributes = self.atoms.arrays['scalar_attributes']
+            scalar_attributes = atoms.arrays['scalar_attributes']
             if len(scalar_attributes.shape) == 1:
                 scalar_attributes = scalar_attributes[:, np.newaxis]
         
             self.central_scalar_attributes = scalar_attributes
                
-        i_list, j_list, D_list, S_list = ase.neighborlist.neighbor_list('ijDS', atoms, r_cut)
+        if neighbor_list_device is None:
+            i_list, j_list, D_list, S_list = ase.neighborlist.neighbor_list('ijDS', atoms, r_cut)
+        else:
+            i_list, j_list, D_list, S_list = get_neighbor_list_numpy(atoms, r_cut, device = neighbor_list_device)
             
-        self.neighbors_index = [[] for i in range(len(positions))]
-        self.neighbors_shift = [[] for i in range(len(positions))]
-        
-        for i, j, D, S in zip(i_list, j_list, D_list, S_list):
-            self.neighbors_index[i].append(j)
-            self.neighbors_shift[i].append(S)
+        order = np.argsort(i_list, kind = 'stable')
+        i_list, j_list, D_list, S_list = i_list[order], j_list[order], D_list[order], S_list[order]
         
-        self.relative_positions = [[] for i in range(len(positions))]
-        self.neighbor_species = [[] for i in range(len(positions))]
-        self.neighbors_pos = [[] for i in range(len(positions))]
+        # graphs are built in single precision, so nothing is lost storing it
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(i_list, minlength = self.n_atoms))])
+        self.relative_positions = D_list.astype(np.float32)
+        self.neighbors_index = j_list.astype(np.int32)
+        self.neighbors_shift = S_list.astype(np.int32)
+        self.neighbor_species = species[j_list].astype(np.uint8)
+        self.neighbors_pos = get_neighbors_pos(i_list, j_list, S_list, self.n_atoms).astype(np.int32)
         
         if use_additional_scalar_attributes:
-            self.neighbor_scalar_attributes = [[] for i in range(len(positions))]
-        
-        def is_same(first, second):
-            for i in range(len(first)):
-                if first[i] != second[i]:
-                    return False
-            return True
-            
-        for i, j, D, S in zip(i_list, j_list, D_list, S_list):
-            self.relative_positions[i].append(D)
-            self.neighbor_species[i].append(species[j])
-            if use_additional_scalar_attributes:
-                self.neighbor_scalar_attributes[i].append(scalar_attributes[j])
-            for k in range(len(self.neighbors_index[j])):
-                if (self.neighbors_index[j][k] == i) and is_same(self.neighbors_shift[j][k], -S):
-                    self.neighbors_pos[i].append(k)
+            self.neighbor_scalar_attributes = scalar_attributes[j_list]
 
         self.use_long_range = use_long_range
         if self.use_long_range:
-            self.cell = np.array(self.atoms.get_cell())
+            self.cell = np.array(atoms.get_cell())
             w_1, w_2, w_3 = get_reciprocal(self.cell[0], self.cell[1], self.cell[2])
             reciprocal = np.concatenate([w_1[np.newaxis], w_2[np.newaxis], w_3[np.newaxis]], axis = 0)
             self.reciprocal = reciprocal
             self.k_vectors = get_all_k(self.cell[0], self.cell[1], self.cell[2], k_cut)
             self.k_cut = k_cut
+    
+    def get_nums(self):
+        '''Numbers of neighbors of all the atoms'''
+        return np.diff(self.offsets)
                              
     def get_max_num(self):
-        maximum = None
-        for chunk in self.relative_positions:
-            if (maximum is None) or (len(chunk) > maximum):
-                maximum = len(chunk)
-        return maximum
+        if self.n_atoms == 0:
+            return None
+        return int(np.max(self.get_nums()))
     
     def get_num_k(self):
         if self.use_long_range:
@@ -80,77 +122,94 @@ class Molecule():
         else:
             return None
     
-    def get_graph(self, max_num, all_species, max_num_k):
-        central_species = [np.where(all_species == specie)[0][0] for specie in self.central_species]
-        central_species = torch.LongTensor(central_species)
-        
-        nums = []
-        mask = []
-        relative_positions = np.zeros([len(self.relative_positions), max_num, 3])
-        neighbors_pos = np.zeros([len(self.relative_positions), max_num], dtype = int)
-        neighbors_index = np.zeros([len(self.relative_positions), max_num], dtype = int)
-        
-        if self.use_additional_scalar_attributes:
-            neighbor_scalar_attributes = np.zeros([len(self.relative_positions), max_num, 1])
-        
-        for i in range(len(self.relative_positions)):
-            now = np.array(self.relative_positions[i])
-            if len(now) > 0:
-                if self.use_additional_scalar_attributes:
-                    neighbor_scalar_attributes[i, :len(now)] = self.neighbor_scalar_attributes[i]
-                relative_positions[i, :len(now), :] = now
-                neighbors_pos[i, :len(now)] = self.neighbors_pos[i]
-                neighbors_index[i, :len(now)] = self.neighbors_index[i]
-            
-            nums.append(len(self.relative_positions[i]))
-            current_mask = np.zeros(max_num)
-            current_mask[len(self.relative_positions[i]):] = True
-            mask.append(current_mask[np.newaxis, :])
-            
-            
-        mask = np.concatenate(mask, axis = 0)
-        relative_positions = torch.FloatTensor(relative_positions)
-        nums = torch.FloatTensor(nums)
-        mask = torch.BoolTensor(mask)
-        
-        neighbors_pos = torch.LongTensor(neighbors_pos)
-        neighbors_index = torch.LongTensor(neighbors_index)
-        
-        neighbor_species = len(all_species) * np.ones([len(self.neighbor_species), max_num], dtype = int)
-        for i in range(len(self.neighbor_species)):
-            now = np.array(self.neighbor_species[i])
-            now = np.array([np.where(all_species == specie)[0][0] for specie in now])
-            neighbor_species[i, :len(now)] = now
-        neighbor_species = torch.LongTensor(neighbor_species)
-        
-        kwargs = {'central_species' : central_species,
-                  'x' : relative_positions,
-                  'neighbor_species' : neighbor_species,
-                  'neighbors_pos' : neighbors_pos,
-                  'neighbors_index' : neighbors_index.transpose(0, 1),
-                  'nums' : nums,
-                  'mask' : mask,
-                  'n_atoms' : len(self.atoms.positions)}
+    def get_graph(self, all_species):
+        '''Returns the graph with neighbors of all atoms concatenated along the first
+        dimension; it is padded to the maximal number of neighbors only when
+        collated into a batch, see pad_graph and PaddingCollater'''
+        kwargs = {'central_species' : torch.from_numpy(get_species_indices(self.central_species, all_species)),
+                  'x' : torch.from_numpy(self.relative_positions.copy()),
+                  'neighbor_species' : torch.from_numpy(get_species_indices(self.neighbor_species, all_species)),
+                  'neighbors_pos' : torch.from_numpy(self.neighbors_pos.astype(np.int64)),
+                  'neighbors_index' : torch.from_numpy(self.neighbors_index.astype(np.int64)),
+                  'nums' : torch.FloatTensor(self.get_nums()),
+                  'n_atoms' : self.n_atoms}
         
         if self.use_additional_scalar_attributes:
-            kwargs['neighbor_scalar_attributes'] = torch.FloatTensor(neighbor_scalar_attributes)
+            kwargs['neighbor_scalar_attributes'] = torch.FloatTensor(self.neighbor_scalar_attributes)
             kwargs['central_scalar_attributes'] = torch.FloatTensor(self.central_scalar_attributes)
 
         if self.use_long_range:
             kwargs['cell'] = torch.FloatTensor(self.cell)[None]
             kwargs['reciprocal'] = torch.FloatTensor(self.reciprocal)[None]
-            k_vectors = np.zeros([1, len(max_num_k), 3])
-            k_mask = np.zeros([max_num_k], dtype = bool)
-            for index in range(len(self.k_vectors)):
-                k_vectors[0, index] = self.k_vectors[index]
-                k_mask[index] = True
-            kwargs['k_vectors'] = torch.FloatTensor(k_vectors)
-            kwargs['k_mask'] = torch.BoolTensor(k_mask)[None]
+            kwargs['k_vectors'] = torch.FloatTensor(np.reshape(self.k_vectors, [1, -1, 3]))
+            kwargs['k_mask'] = torch.ones([1, len(self.k_vectors)], dtype = torch.bool)
 
         result = Data(**kwargs)
     
         return result
     
+def pad_tensor(tensor, dim, size, value):
+    shape = list(tensor.shape)
+    shape[dim] = size - shape[dim]
+    padding = torch.full(shape, value, dtype = tensor.dtype)
+    return torch.cat([tensor, padding], dim = dim)
+
+# entries of graphs given per neighbor and their padding values
+NEIGHBOR_PADDING_VALUES = {'x' : 0.0, 'neighbors_index' : 0, 'neighbors_pos' : 0, 
+                           'neighbor_scalar_attributes' : 0.0}
+    
+def pad_graph(graph, max_num, n_species, max_num_k = None):
+    '''Converts a graph built by Molecule.get_graph into the padded layout 
+    used by the model, with max_num neighbors per atom (and max_num_k 
+    k vectors). Always returns a new Data object'''
+    nums = graph.nums.long()
+    n_atoms = nums.shape[0]
+    atom_indices = torch.repeat_interleave(torch.arange(n_atoms), nums)
+    first_neighbors = torch.cumsum(nums, dim = 0) - nums
+    neighbor_indices = torch.arange(atom_indices.shape[0]) - first_neighbors[atom_indices]
+    
+    kwargs = {}
+    for key in graph.keys():
+        value = graph[key]
+        if (key in NEIGHBOR_PADDING_VALUES.keys()) or (key == 'neighbor_species'):
+            fill_value = n_species if key == 'neighbor_species' else NEIGHBOR_PADDING_VALUES[key]
+            padded = torch.full([n_atoms, max_num] + list(value.shape[1:]), fill_value, dtype = value.dtype)
+            padded[atom_indices, neighbor_indices] = value
+            value = padded
+        if (key in ['k_vectors', 'k_mask']) and (max_num_k is not None):
+            value = pad_tensor(value, 1, max_num_k, 0)
+        kwargs[key] = value
+        
+    kwargs['neighbors_index'] = kwargs['neighbors_index'].transpose(0, 1)
+    mask = torch.ones(n_atoms, max_num, dtype = torch.bool)
+    mask[atom_indices, neighbor_indices] = False
+    kwargs['mask'] = mask
+    return Data(**kwargs)
+
+class PaddingCollater():
+    '''Collates graphs built by Molecule.get_graph into a batch padded to the 
+    maximal number of neighbors within this batch, instead of the whole dataset.
+    If as_list is True, returns the list of padded graphs, as needed for DataParallel'''
+    def __init__(self, n_species, as_list = False):
+        self.n_species = n_species
+        self.as_list = as_list
+        
+    def __call__(self, graphs):
+        # at least one neighbor slot, so that batches of isolated atoms keep the usual layout
+        max_num = 1
+        for graph in graphs:
+            if len(graph.nums) > 0:
+                max_num = max(max_num, int(torch.max(graph.nums)))
+        
+        max_num_k = None
+        if 'k_vectors' in graphs[0].keys():
+            max_num_k = max([graph.k_vectors.shape[1] for graph in graphs])
+            
+        graphs = [pad_graph(graph, max_num, self.n_species, max_num_k) for graph in graphs]
+        if self.as_list:
+            return graphs
+        return Batch.from_data_list(graphs)
+    
 def batch_to_dict(batch):
     batch_dict = {"x" : batch.x, 
                   "central_species" : batch.central_species,
@@ -0,0 +1,181 @@
+import torch
+import numpy as np
+from typing import List, Tuple
+
+
+def complete_cell(cell: torch.Tensor, pbc: torch.Tensor) -> torch.Tensor:
+    '''Replaces cell vectors along non-periodic directions by unit vectors
+    orthogonal to the remaining ones, so that the cell can be inverted.
+    Only the periodic cell vectors affect the neighbor list'''
+    result = cell.clone()
+    missing: List[int] = []
+    present: List[int] = []
+    for index in range(3):
+        if (not bool(pbc[index])) or (float(torch.linalg.norm(cell[index])) == 0.0):
+            result[index] = 0.0
+            missing.append(index)
+        else:
+            present.append(index)
+
+    if len(missing) == 3:
+        return torch.eye(3, dtype = cell.dtype, device = cell.device)
+
+    if len(missing) == 2:
+        a = result[present[0]] / torch.linalg.norm(result[present[0]])
+        axis = torch.zeros(3, dtype = cell.dtype, device = cell.device)
+        axis[int(torch.argmin(torch.abs(a)))] = 1.0
+        b = torch.linalg.cross(a, axis)
+        b = b / torch.linalg.norm(b)
+        result[missing[0]] = b
+        result[missing[1]] = torch.linalg.cross(a, b)
+
+    if len(missing) == 1:
+        first = result[(missing[0] + 1) % 3]
+        second = result[(missing[0] + 2) % 3]
+        normal = torch.linalg.cross(first, second)
+        result[missing[0]] = normal / torch.linalg.norm(normal)
+    return result
+
+
+def get_neighbor_list(positions: torch.Tensor, cell: torch.Tensor, pbc: torch.Tensor, r_cut: float,
+                      chunk_size: int = 10000) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    '''Neighbor list with the cell list method, running on the device of positions.
+
+    Returns i, j, D and S as ase.neighborlist.neighbor_list('ijDS', ...) does,
+    i. e. D = positions[j] - positions[i] + S @ cell for all pairs closer than r_cut,
+    sorted by i. Atoms are wrapped into the cell, periodic images within r_cut of
+    the cell are added as ghost atoms, and all the atoms are sorted into bins of
+    size r_cut; neighbors of each atom are then searched only in the 27
+    surrounding bins. Occupied bins are found by binary search, so that empty
+    space costs nothing. chunk_size bounds the number of central atoms
+    processed at once.'''
+    device = positions.device
+    n_atoms = positions.shape[0]
+    # directions with zero cell vectors are not periodic
+    pbc = torch.logical_and(pbc.to(torch.bool).to(device), torch.linalg.norm(cell, dim = 1) > 0)
+    empty = torch.zeros(0, dtype = torch.long, device = device)
+    if n_atoms == 0:
+        return empty, empty, torch.zeros([0, 3], dtype = positions.dtype, device = device), torch.zeros([0, 3], dtype = torch.long, device = device)
+
+    # fractional coordinates, wrapped into the cell along periodic directions
+    full_cell = complete_cell(cell, pbc)
+    inverse = torch.linalg.inv(full_cell)
+    fractional = positions @ inverse
+    wrapping = torch.where(pbc[None, :], torch.floor(fractional), torch.zeros_like(fractional))
+    fractional = fractional - wrapping
+    wrapping = wrapping.to(torch.long)
+
+    # number of periodic images needed along each direction
+    plane_distances = 1.0 / torch.linalg.norm(inverse, dim = 0)
+    n_images = torch.where(pbc, torch.ceil(r_cut / plane_distances), torch.zeros_like(plane_distances)).to(torch.long)
+    margins = r_cut / plane_distances
+
+    images_index = [torch.arange(n_atoms, device = device)]
+    images_shift = [torch.zeros([n_atoms, 3], dtype = torch.long, device = device)]
+    images_fractional = [fractional]
+    ranges = [torch.arange(-int(n_images[index]), int(n_images[index]) + 1, device = device) for index in range(3)]
+    shifts = torch.cartesian_prod(ranges[0], ranges[1], ranges[2])
+    for shift in shifts:
+        if bool(torch.all(shift == 0)):
+            continue
+        image = fractional + shift[None, :].to(fractional.dtype)
+        inside = torch.logical_or(torch.logical_not(pbc[None, :]),
+                                  torch.logical_and(image >= -margins[None, :], image <= 1.0 + margins[None, :]))
+        selected = torch.nonzero(torch.all(inside, dim = 1))[:, 0]
+        images_index.append(selected)
+        images_shift.append(shift[None, :].expand(selected.shape[0], 3))
+        images_fractional.append(image[selected])
+    points_index = torch.cat(images_index)
+    points_shift = torch.cat(images_shift)
+    points = torch.cat(images_fractional) @ full_cell
+
+    # points sorted by bins of size r_cut
+    lower = torch.min(points, dim = 0).values
+    bins = torch.floor((points - lower[None, :]) / r_cut).to(torch.long)
+    n_bins = torch.max(bins, dim = 0).values + 1
+    bin_ids = (bins[:, 0] * n_bins[1] + bins[:, 1]) * n_bins[2] + bins[:, 2]
+    bin_ids, order = torch.sort(bin_ids)
+
+    offsets = torch.cartesian_prod(torch.arange(-1, 2, device = device), torch.arange(-1, 2, device = device),
+                                   torch.arange(-1, 2, device = device))
+
+    result_i: List[torch.Tensor] = []
+    result_j: List[torch.Tensor] = []
+    result_S: List[torch.Tensor] = []
+    for begin in range(0, n_atoms, chunk_size):
+        central = torch.arange(begin, min(begin + chunk_size, n_atoms), device = device)
+        neighbor_bins = bins[central][:, None, :] + offsets[None, :, :]
+        valid = torch.all(torch.logical_and(neighbor_bins >= 0, neighbor_bins < n_bins[None, None, :]), dim = 2)
+        neighbor_ids = (neighbor_bins[:, :, 0] * n_bins[1] + neighbor_bins[:, :, 1]) * n_bins[2] + neighbor_bins[:, :, 2]
+        starts = torch.searchsorted(bin_ids, neighbor_ids)
+        ends = torch.searchsorted(bin_ids, neighbor_ids, right = True)
+        counts = torch.where(valid, ends - starts, torch.zeros_like(starts)).reshape(-1)
+        starts = starts.reshape(-1)
+
+        # all the points of the surrounding bins, for each central atom
+        total = int(torch.sum(counts))
+        first = torch.cumsum(counts, dim = 0) - counts
+        candidates = torch.repeat_interleave(starts - first, counts) + torch.arange(total, device = device)
+        candidates = order[candidates]
+        pair_i = torch.repeat_interleave(central, counts.reshape(central.shape[0], 27).sum(dim = 1))
+
+        # the final check uses the vectors computed from the initial positions,
+        # so that pairs at the distance of r_cut are treated as in ASE
+        vectors = points[candidates] - points[pair_i]
+        close = torch.sum(vectors * vectors, dim = 1) < (r_cut + 1e-6) ** 2
+        pair_i, candidates = pair_i[close], candidates[close]
+        pair_j = points_index[candidates]
+        not_self = torch.logical_or(pair_i != pair_j, candidates >= n_atoms)
+        pair_i, pair_j, candidates = pair_i[not_self], pair_j[not_self], candidates[not_self]
+        pair_S = points_shift[candidates] - wrapping[pair_j] + wrapping[pair_i]
+
+        vectors = positions[pair_j] - positions[pair_i] + pair_S.to(positions.dtype) @ cell
+        close = torch.sum(vectors * vectors, dim = 1) < r_cut * r_cut
+
+        result_i.append(pair_i[close])
+        result_j.append(pair_j[close])
+        result_S.append(pair_S[close])
+
+    i = torch.cat(result_i)
+    j = torch.cat(result_j)
+    S = torch.cat(result_S)
+
+    # deterministic order, sorted by i and then by j
+    permutation = torch.argsort(j, stable = True)
+    permutation = permutation[torch.argsort(i[permutation], stable = True)]
+    i, j, S = i[permutation], j[permutation], S[permutation]
+    D = positions[j] - positions[i] + S.to(positions.dtype) @ cell
+    return i, j, D, S
+
+
+def get_neighbor_list_numpy(atoms, r_cut, device = 'cpu'):
+    '''Drop-in replacement of ase.neighborlist.neighbor_list('ijDS', atoms, r_cut)
+    computing the neighbor list on the given device'''
+    positions = torch.tensor(atoms.get_positions(), dtype = torch.float64, device = device)
+    cell = torch.tensor(np.array(atoms.get_cell()), dtype = torch.float64, device = device)
+    pbc = torch.tensor(atoms.get_pbc(), dtype = torch.bool, device = device)
+    i, j, D, S = get_neighbor_list(positions, cell, pbc, r_cut)
+    return i.cpu().numpy(), j.cpu().numpy(), D.cpu().numpy(), S.cpu().numpy()
+
+
+def lexsort(keys: List[torch.Tensor]) -> torch.Tensor:
+    '''The same as np.lexsort; the last key is the primary one'''
+    permutation = torch.argsort(keys[0], stable = True)
+    for key in keys[1:]:
+        permutation = permutation[torch.argsort(key[permutation], stable = True)]
+    return permutation
+
+
+def get_neighbors_pos(i: torch.Tensor, j: torch.Tensor, S: torch.Tensor, n_atoms: int) -> torch.Tensor:
+    '''The same as molecule.get_neighbors_pos for the neighbor list of
+    get_neighbor_list, i. e. sorted by i: for each pair (i, j, S) the position 
+    of the reverse pair (j, i, -S) within the neighbors of atom j'''
+    counts = torch.bincount(i, minlength = n_atoms)
+    offsets = torch.cumsum(counts, dim = 0) - counts
+    local_index = torch.arange(i.shape[0], device = i.device) - offsets[i]
+
+    forward = lexsort([S[:, 2], S[:, 1], S[:, 0], j, i])
+    backward = lexsort([-S[:, 2], -S[:, 1], -S[:, 0], i, j])
+    reverse = torch.empty_like(forward)
+    reverse[backward] = forward
+    return local_index[reverse]
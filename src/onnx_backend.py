@@ -0,0 +1,202 @@
+import os
+import copy
+import torch
+import numpy as np
+from typing import Dict
+
+from .hypers import load_hypers_from_file
+from .pet import PET, PETMLIPWrapper, PETUtilityWrapper, assemble_forces, assemble_virials
+from .utilities import get_rotations
+
+# inputs of the exported graphs, the tensors of batch_to_dict except for batch, 
+# which is only needed for pooling, done by ONNXModel
+INPUT_NAMES = ['x', 'central_species', 'neighbor_species', 'mask', 'nums', 'neighbors_index', 'neighbors_pos']
+
+
+def check_exportable(ARCHITECTURAL_HYPERS):
+    '''Options giving shapes which depend on the values of the inputs, 
+    which are not supported by torch.export'''
+    if ARCHITECTURAL_HYPERS.USE_ADDITIONAL_SCALAR_ATTRIBUTES or ARCHITECTURAL_HYPERS.USE_LONG_RANGE:
+        raise NotImplementedError("ONNX export of models with scalar attributes or long range is not supported")
+    if ARCHITECTURAL_HYPERS.TRANSFORMERS_CENTRAL_SPECIFIC or ARCHITECTURAL_HYPERS.HEADS_CENTRAL_SPECIFIC:
+        raise NotImplementedError("ONNX export of species-specific models is not supported")
+    n_atom_buckets = getattr(ARCHITECTURAL_HYPERS, 'N_ATOM_BUCKETS', None)
+    if getattr(ARCHITECTURAL_HYPERS, 'RAGGED_TRANSFORMER', False) or (n_atom_buckets is not None and n_atom_buckets > 1):
+        raise NotImplementedError("ONNX export with RAGGED_TRANSFORMER or N_ATOM_BUCKETS is not supported")
+
+
+class AtomicPredictor(torch.nn.Module):
+    '''Atomic predictions of PET and, if use_gradients is True, the gradients of 
+    their sum with respect to x, as functions of the tensors of batch_dict'''
+    def __init__(self, pet_model, use_gradients):
+        super(AtomicPredictor, self).__init__()
+        self.pet_model = copy.deepcopy(pet_model)
+        self.pet_model.TARGET_TYPE = 'atomic'
+        self.pet_model.eval()
+        for parameter in self.pet_model.parameters():
+            parameter.requires_grad_(False)
+        self.use_gradients = use_gradients
+
+    def get_atomic_predictions(self, x, central_species, neighbor_species, mask, nums, neighbors_index, neighbors_pos):
+        batch_dict : Dict[str, torch.Tensor] = {'x' : x, 'central_species' : central_species,
+                                                'neighbor_species' : neighbor_species, 'mask' : mask,
+                                                'nums' : nums, 'neighbors_index' : neighbors_index, 
+                                                'neighbors_pos' : neighbors_pos,
+                                                'batch' : torch.zeros_like(central_species)}
+        return self.pet_model(batch_dict)
+
+    def forward(self, x, central_species, neighbor_species, mask, nums, neighbors_index, neighbors_pos):
+        if not self.use_gradients:
+            return self.get_atomic_predictions(x, central_species, neighbor_species, mask, nums,
+                                               neighbors_index, neighbors_pos)
+        with torch.enable_grad():
+            x = x.detach().requires_grad_(True)
+            atomic_predictions = self.get_atomic_predictions(x, central_species, neighbor_species, mask, nums,
+                                                             neighbors_index, neighbors_pos)
+            gradients = torch.autograd.grad(atomic_predictions.sum(), x)[0]
+        return atomic_predictions.detach(), gradients
+
+
+def get_example_inputs(n_species, n_atoms = 7, length = 5):
+    '''Inputs for tracing. Their values do not matter; both the numbers of atoms and 
+    of neighbors should be larger than one, so that they are not specialized'''
+    generator = torch.Generator().manual_seed(0)
+    mask = torch.arange(length)[None, :] >= torch.randint(1, length + 1, [n_atoms], generator = generator)[:, None]
+    neighbor_species = torch.randint(0, n_species, [n_atoms, length], generator = generator)
+    neighbor_species[mask] = n_species
+    return (torch.randn([n_atoms, length, 3], generator = generator).masked_fill(mask[:, :, None], 0.0),
+            torch.randint(0, n_species, [n_atoms], generator = generator),
+            neighbor_species, mask,
+            torch.logical_not(mask).sum(dim = 1).float(),
+            torch.randint(0, n_atoms, [n_atoms, length], generator = generator),
+            torch.randint(0, length, [n_atoms, length], generator = generator))
+
+
+def export_onnx(pet_model, output_path, use_gradients):
+    '''Writes the ONNX graph of AtomicPredictor with dynamic numbers of atoms and of 
+    neighbors. torch.export does not trace through autograd, so the forward and the 
+    backward passes are first traced together into a graph of core aten 
+    operations by make_fx, with symbolic shapes'''
+    from torch.fx.experimental.proxy_tensor import make_fx
+    from torch._decomp import core_aten_decompositions
+
+    check_exportable(pet_model.hypers)
+    module = AtomicPredictor(pet_model, use_gradients)
+    inputs = get_example_inputs(pet_model.N_SPECIES)
+    graph = make_fx(module, tracing_mode = 'symbolic', decomposition_table = core_aten_decompositions(),
+                    _allow_non_fake_inputs = True)(*inputs)
+
+    n_atoms, length = torch.export.Dim('n_atoms'), torch.export.Dim('length')
+    dynamic_shapes = ({0 : n_atoms, 1 : length}, {0 : n_atoms}, {0 : n_atoms, 1 : length}, 
+                      {0 : n_atoms, 1 : length}, {0 : n_atoms}, 
+                      {0 : n_atoms, 1 : length}, {0 : n_atoms, 1 : length})
+    output_names = ['atomic_predictions', 'gradients'] if use_gradients else ['atomic_predictions']
+    torch.onnx.export(graph, inputs, output_path, dynamo = True, input_names = INPUT_NAMES,
+                      output_names = output_names, dynamic_shapes = dynamic_shapes, verbose = False)
+
+
+def load_pet_model(path_to_calc_folder, checkpoint):
+    '''PET of the given calculation, on the CPU, with its hypers'''
+    hypers = load_hypers_from_file(path_to_calc_folder + '/hypers_used.yaml')
+    all_species = np.load(path_to_calc_folder + '/all_species.npy')
+    model = PETUtilityWrapper(PET(hypers.ARCHITECTURAL_HYPERS, 0.0, len(all_species)),
+                              hypers.FITTING_SCHEME.GLOBAL_AUG)
+    if hypers.UTILITY_FLAGS.CALCULATION_TYPE == 'mlip':
+        model = PETMLIPWrapper(model, hypers.MLIP_SETTINGS.USE_ENERGIES, hypers.MLIP_SETTINGS.USE_FORCES)
+    state_dict = torch.load(path_to_calc_folder + '/' + checkpoint + '_state_dict', map_location = 'cpu')
+    # models fitted with MULTI_GPU are saved wrapped into DataParallel
+    state_dict = {(key[len('module.'):] if key.startswith('module.') else key) : value
+                  for key, value in state_dict.items()}
+    model.load_state_dict(state_dict)
+    if hypers.UTILITY_FLAGS.CALCULATION_TYPE == 'mlip':
+        model = model.model
+    return model.pet_model, hypers
+
+
+def export_from_folder(path_to_calc_folder, checkpoint, output_path):
+    '''Exports the given calculation, with the gradients if it is an MLIP using forces'''
+    pet_model, hypers = load_pet_model(path_to_calc_folder, checkpoint)
+    use_gradients = hypers.UTILITY_FLAGS.CALCULATION_TYPE == 'mlip' and hypers.MLIP_SETTINGS.USE_FORCES
+    export_onnx(pet_model, output_path, use_gradients)
+
+
+def get_onnx_path(path_to_calc_folder, checkpoint, use_gradients):
+    '''Where pet_run looks for the exported model; models exported with and 
+    without the gradients are stored in different files'''
+    return os.path.join(path_to_calc_folder, checkpoint + ('_grad' if use_gradients else '') + '.onnx')
+
+
+class ONNXModel():
+    '''Runs an exported model with onnxruntime on the CPU. Called in the same way as 
+    PETMLIPWrapper for MLIP calculations and as PETUtilityWrapper otherwise; pooling 
+    over structures and rotational augmentations are done here in numpy'''
+    def __init__(self, path, hypers, n_threads = None, use_virials = False):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if n_threads is not None:
+            options.intra_op_num_threads = n_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers = ['CPUExecutionProvider'])
+        # inputs not used by the model, such as nums without AVERAGE_POOLING, are removed from the graph
+        self.input_names = [node.name for node in self.session.get_inputs()]
+
+        self.is_mlip = hypers.UTILITY_FLAGS.CALCULATION_TYPE == 'mlip'
+        if self.is_mlip:
+            self.use_energies = hypers.MLIP_SETTINGS.USE_ENERGIES
+            self.use_forces = hypers.MLIP_SETTINGS.USE_FORCES
+        self.use_virials = use_virials
+        self.target_type = hypers.ARCHITECTURAL_HYPERS.TARGET_TYPE
+        self.target_aggregation = hypers.ARCHITECTURAL_HYPERS.TARGET_AGGREGATION
+        self.global_aug = hypers.FITTING_SCHEME.GLOBAL_AUG
+
+    def run(self, batch, rotations):
+        inputs = {'x' : batch.x, 'central_species' : batch.central_species, 
+                  'neighbor_species' : batch.neighbor_species, 'mask' : batch.mask,
+                  'nums' : batch.nums, 'neighbors_index' : batch.neighbors_index.transpose(0, 1),
+                  'neighbors_pos' : batch.neighbors_pos}
+        inputs = {name : inputs[name].data.cpu().numpy() for name in self.input_names}
+        if rotations is not None:
+            inputs['x'] = np.matmul(inputs['x'], rotations)
+        outputs = self.session.run(None, inputs)
+        if len(outputs) == 1:
+            return outputs[0], None
+        gradients = outputs[1]
+        if rotations is not None:
+            gradients = np.matmul(gradients, np.swapaxes(rotations, 1, 2))
+        return outputs[0], gradients
+
+    def pool(self, atomic_predictions, batch):
+        indices = batch.batch.data.cpu().numpy()
+        result = np.zeros([batch.num_graphs, atomic_predictions.shape[1]], dtype = atomic_predictions.dtype)
+        np.add.at(result, indices, atomic_predictions)
+        if self.target_aggregation == 'mean':
+            result = result / np.bincount(indices, minlength = batch.num_graphs)[:, np.newaxis]
+        return result
+
+    def get_forces(self, gradients, batch):
+        # entries of padding may be nan, since the length of padding vectors is zero,
+        # but they are not used by assemble_forces
+        return assemble_forces(torch.from_numpy(gradients), batch.mask.cpu(),
+                               batch.neighbors_index.transpose(0, 1).cpu())
+
+    def __call__(self, batch, augmentation, create_graph = False):
+        rotations = None
+        if augmentation:
+            rotations = get_rotations(batch.batch.data.cpu().numpy(), global_aug = self.global_aug).astype(np.float32)
+        atomic_predictions, gradients = self.run(batch, rotations)
+        
+        if self.target_type == 'structural':
+            predictions = self.pool(atomic_predictions, batch)
+        else:
+            predictions = atomic_predictions
+        if not self.is_mlip:
+            return torch.from_numpy(predictions)
+        
+        energies = torch.from_numpy(predictions[:, 0]) if self.use_energies else None
+        forces = self.get_forces(gradients, batch) if self.use_forces else None
+        if not self.use_virials:
+            return [energies, forces]
+        if gradients is None:
+            raise ValueError("virials need a model exported with the gradients")
+        virials = assemble_virials(torch.from_numpy(gradients), batch.mask.cpu(), batch.x.cpu(),
+                                   batch.batch.cpu(), batch.num_graphs)
+        return [energies, forces, virials]
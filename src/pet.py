@@ -3,61 +3,13 @@ import torch
 import numpy as np
 import torch_geometric
 from torch import nn
-from typing import Dict, Optional
+from typing import Dict, List, Optional
+import torch.nn.functional as F
 
-from .transformer import TransformerLayer, Transformer
+from .transformer import TransformerLayer, Transformer, get_packed_index, get_ragged_groups, pack, unpack
 from .molecule import batch_to_dict
 from .utilities import get_rotations, NeverRun
-
-class CentralSplitter(torch.nn.Module):
-    def __init__(self): 
-        super(CentralSplitter, self).__init__()
-        
-    def forward(self, features, central_species):
-        all_species = np.unique(central_species)
-        all_species = [str(specie) for specie in all_species]
-        
-        result = {}
-        for specie in all_species:
-            result[specie] = {}
-            
-        for key, value in features.items():
-            for specie in all_species:
-                mask_now = (central_species == int(specie))
-                result[specie][key] = value[mask_now]       
-        return result
-        
-class CentralUniter(torch.nn.Module):
-    def __init__(self):
-        super(CentralUniter, self).__init__()
-        
-    def forward(self, features, central_species):
-        all_species = np.unique(central_species)
-        all_species = [str(specie) for specie in all_species]
-        specie = all_species[0]
-        
-        shapes = {}
-        for key, value in features[specie].items():
-            now = list(value.shape)
-            now[0] = 0
-            shapes[key] = now       
-            
-        device = None
-        for specie in all_species:
-            for key, value in features[specie].items():
-                num = features[specie][key].shape[0]
-                device = features[specie][key].device
-                shapes[key][0] += num
-                
-          
-        result = {key : torch.empty(shape, dtype = torch.get_default_dtype()).to(device) for key, shape in shapes.items()}        
-        
-        for specie in features.keys():
-            for key, value in features[specie].items():
-                mask = (int(specie) == central_species)
-                result[key][mask] = features[specie][key]
-            
-        return result
+from .species_layers import get_linear, get_embedding, Sequential, Elementwise
 
 def cutoff_func(grid : torch.Tensor, r_cut : float, delta : float):
     mask_bigger = grid >= r_cut
@@ -65,10 +17,82 @@ def cutoff_func(grid : torch.Tensor, r_cut : float, delta : float):
     grid = (grid - r_cut + delta) / delta
     f = 1/2.0 + torch.cos(np.pi * grid)/2.0
     
-    f[mask_bigger] = 0.0
-    f[mask_smaller] = 1.0
+    f = f.masked_fill(mask_bigger, 0.0)
+    f = f.masked_fill(mask_smaller, 1.0)
     return f
 
+def get_geometry(x : torch.Tensor, mask : torch.Tensor, r_cut : float, delta : float) -> Dict[str, torch.Tensor]:
+    '''Geometric quantities shared by all the GNN and transformer layers, 
+    computed once per forward pass. Attention multipliers are [N, 1, M] views, 
+    broadcast over the queries instead of being repeated, and include 
+    the multiplier of the central token in the central_ version'''
+    neighbor_lengths = torch.sqrt(torch.sum(x ** 2, dim = 2) + 1e-15)[:, :, None]
+    lengths = torch.sqrt(torch.sum(x * x, dim = 2) + 1e-16)
+    # out of place, without boolean indexing, which syncs with the device and breaks compiled graphs
+    multipliers = cutoff_func(lengths, r_cut, delta).masked_fill(mask, 0.0)
+
+    central_multipliers = torch.ones([mask.shape[0], 1], dtype = multipliers.dtype, device = multipliers.device)
+    central_multipliers = torch.cat([central_multipliers, multipliers], dim = 1)
+    return {'neighbor_lengths' : neighbor_lengths,
+            'multipliers' : multipliers,
+            'attention_multipliers' : multipliers[:, None, :],
+            'central_attention_multipliers' : central_multipliers[:, None, :]}
+
+
+def get_atom_buckets(nums : torch.Tensor, n_buckets : int) -> List[torch.Tensor]:
+    '''Splits atoms into at most n_buckets groups of about the same size
+    by quantiles of their numbers of neighbors'''
+    order = torch.argsort(nums, stable = True)
+    buckets : List[torch.Tensor] = []
+    for bucket in torch.tensor_split(order, n_buckets):
+        if bucket.shape[0] > 0:
+            buckets.append(bucket)
+    return buckets
+
+def select_atoms(batch_dict : Dict[str, torch.Tensor], index : torch.Tensor, length : int) -> Dict[str, torch.Tensor]:
+    '''Atoms with the given indices, with the neighbors truncated to length'''
+    result : Dict[str, torch.Tensor] = {}
+    for key, value in batch_dict.items():
+        if key in ['x', 'neighbor_species', 'mask', 'neighbors_index', 'neighbors_pos', 
+                   'neighbor_scalar_attributes', 'input_messages']:
+            result[key] = value[index, :length]
+        if key in ['central_species', 'batch', 'nums', 'central_scalar_attributes']:
+            result[key] = value[index]
+    return result
+
+def get_shape_bucket(size : int, buckets_per_octave : int) -> int:
+    '''Smallest size not less than the given one among buckets_per_octave
+    equally spaced sizes within each interval between powers of two'''
+    if size <= buckets_per_octave:
+        return max(size, 1)
+    power = 1 << (size.bit_length() - 1)
+    step = max(1, power // buckets_per_octave)
+    return ((size + step - 1) // step) * step
+
+# entries of batch_dict given per neighbor and per atom, and their padding values
+NEIGHBOR_PADDING_VALUES = {'x' : 0.0, 'mask' : True, 'neighbors_index' : 0, 'neighbors_pos' : 0,
+                           'neighbor_scalar_attributes' : 0.0}
+# nums of padded atoms are 1, so that averages over their neighbors stay finite
+ATOMIC_PADDING_VALUES = {'central_species' : 0, 'nums' : 1.0, 'central_scalar_attributes' : 0.0}
+
+def pad_batch_dict(batch_dict, n_atoms, length, n_species, padding_graph):
+    '''Pads atoms up to n_atoms and neighbors up to length. Padded atoms have 
+    no neighbors and belong to the separate graph with index padding_graph'''
+    result = {}
+    for key, value in batch_dict.items():
+        if key in NEIGHBOR_PADDING_VALUES.keys() or key == 'neighbor_species':
+            fill_value = n_species if key == 'neighbor_species' else NEIGHBOR_PADDING_VALUES[key]
+            padded = torch.full([n_atoms, length] + list(value.shape[2:]), fill_value, 
+                                dtype = value.dtype, device = value.device)
+            value = torch.cat([value, padded[value.shape[0]:, :value.shape[1]]], dim = 0)
+            value = torch.cat([value, padded[:, value.shape[1]:]], dim = 1)
+        if key in ATOMIC_PADDING_VALUES.keys() or key == 'batch':
+            fill_value = padding_graph if key == 'batch' else ATOMIC_PADDING_VALUES[key]
+            padded = torch.full([n_atoms - value.shape[0]] + list(value.shape[1:]), fill_value, 
+                                dtype = value.dtype, device = value.device)
+            value = torch.cat([value, padded], dim = 0)
+        result[key] = value
+    return result
 
 
 def get_activation(hypers):
@@ -82,16 +106,21 @@ class CartesianTransformer(torch.nn.Module):
     def __init__(self, hypers, d_model, n_head,
                        dim_feedforward,n_layers, 
                        dropout, n_atomic_species, add_central_token,
-                       is_first):
-        
+                       is_first, species_specific = False):
+        '''If species_specific is True, all the layers have separate weights
+        for each central species'''
         super(CartesianTransformer, self).__init__()
+        n_species = n_atomic_species if species_specific else None
         self.hypers = hypers
         self.is_first = is_first
         self.trans_layer = TransformerLayer(d_model=d_model, n_heads = n_head,
                                                 dim_feedforward = dim_feedforward,
                                                         dropout = dropout,
                                                         activation = get_activation(hypers),
-                                                        transformer_type = hypers.TRANSFORMER_TYPE)
+                                                        transformer_type = hypers.TRANSFORMER_TYPE,
+                                                        # absent in the hypers of older models
+                                                        attention_implementation = getattr(hypers, 'ATTENTION_IMPLEMENTATION', 'explicit'),
+                                                        n_species = n_species)
         self.trans = Transformer(self.trans_layer, 
                                                    num_layers=n_layers)
         
@@ -107,11 +136,11 @@ class CartesianTransformer(torch.nn.Module):
             input_dim += hypers.SCALAR_ATTRIBUTES_SIZE
         
         if hypers.R_EMBEDDING_ACTIVATION:
-            self.r_embedding = nn.Sequential(
-                nn.Linear(input_dim, d_model),
-                get_activation(hypers))
+            self.r_embedding = Sequential(
+                get_linear(input_dim, d_model, n_species),
+                Elementwise(get_activation(hypers)))
         else:
-            self.r_embedding = nn.Linear(input_dim, d_model)
+            self.r_embedding = get_linear(input_dim, d_model, n_species)
             
         if hypers.BLEND_NEIGHBOR_SPECIES and (not is_first):
             n_merge = 3
@@ -120,17 +149,17 @@ class CartesianTransformer(torch.nn.Module):
             
         self.compress = None        
         if hypers.COMPRESS_MODE == 'linear':
-            self.compress = nn.Linear(n_merge * d_model, d_model)
+            self.compress = get_linear(n_merge * d_model, d_model, n_species)
         if hypers.COMPRESS_MODE == 'mlp':
-            self.compress = nn.Sequential(
-            nn.Linear(n_merge * d_model, d_model), 
-            get_activation(hypers), nn.Linear(d_model, d_model))
+            self.compress = Sequential(
+            get_linear(n_merge * d_model, d_model, n_species), 
+            Elementwise(get_activation(hypers)), get_linear(d_model, d_model, n_species))
         if self.compress is None:
             raise ValueError("unknown compress mode")
         
         self.neighbor_embedder = NeverRun() # for torchscript
         if hypers.BLEND_NEIGHBOR_SPECIES and (not is_first):
-            self.neighbor_embedder = nn.Embedding(n_atomic_species + 1, d_model)
+            self.neighbor_embedder = get_embedding(n_atomic_species + 1, d_model, n_species)
             
         self.add_central_token = add_central_token
 
@@ -139,21 +168,21 @@ class CartesianTransformer(torch.nn.Module):
         self.central_compress = NeverRun() # for torchscript
 
         if add_central_token:
-            self.central_embedder = nn.Embedding(n_atomic_species + 1, d_model)
+            self.central_embedder = get_embedding(n_atomic_species + 1, d_model, n_species)
             if hypers.USE_ADDITIONAL_SCALAR_ATTRIBUTES:
                 if hypers.R_EMBEDDING_ACTIVATION:
-                    self.central_scalar_embedding = nn.Sequential(nn.Linear(hypers.SCALAR_ATTRIBUTES_SIZE, d_model),
-                                                                  get_activation(hypers))
+                    self.central_scalar_embedding = Sequential(get_linear(hypers.SCALAR_ATTRIBUTES_SIZE, d_model, n_species),
+                                                               Elementwise(get_activation(hypers)))
                 else:
-                    self.central_scalar_embedding = nn.Linear(hypers.SCALAR_ATTRIBUTES_SIZE, d_model)
+                    self.central_scalar_embedding = get_linear(hypers.SCALAR_ATTRIBUTES_SIZE, d_model, n_species)
                 
                 if hypers.COMPRESS_MODE == 'linear':
-                    self.central_compress = nn.Linear(2 * d_model, d_model)
+                    self.central_compress = get_linear(2 * d_model, d_model, n_species)
                 if hypers.COMPRESS_MODE == 'mlp':
-                    self.central_compress = nn.Sequential(
-                        nn.Linear(2 * d_model, d_model),
-                        get_activation(hypers),
-                        nn.Linear(d_model, d_model))
+                    self.central_compress = Sequential(
+                        get_linear(2 * d_model, d_model, n_species),
+                        Elementwise(get_activation(hypers)),
+                        get_linear(d_model, d_model, n_species))
                     
         # assign hypers one by one for torch.script
         self.USE_LENGTH = hypers.USE_LENGTH
@@ -162,13 +191,30 @@ class CartesianTransformer(torch.nn.Module):
         self.USE_ONLY_LENGTH = hypers.USE_ONLY_LENGTH            
         self.R_CUT = hypers.R_CUT
         self.CUTOFF_DELTA = hypers.CUTOFF_DELTA
+        self.RAGGED_TRANSFORMER = getattr(hypers, 'RAGGED_TRANSFORMER', False)
+        self.SPECIES_SPECIFIC = species_specific
+                    
+    def run_transformer(self, tokens : torch.Tensor, multipliers : torch.Tensor,
+                        ragged : Optional[Dict[str, torch.Tensor]], species : Optional[torch.Tensor]):
+        if ragged is None:
+            return self.trans(tokens, multipliers = multipliers, species = species)
+        # tokens are packed and unpacked once for all the layers
+        packed_index = ragged['packed_index']
+        output = self.trans(pack(tokens, packed_index), ragged = ragged, species = species)
+        return unpack(output, packed_index, tokens.shape[0], tokens.shape[1])
+
+    def get_ragged(self, batch_dict : Dict[str, torch.Tensor], prefix : str):
+        ragged : Dict[str, torch.Tensor] = {}
+        for key in ['packed_index', 'gather', 'multipliers', 'select', 'shapes']:
+            ragged[key] = batch_dict[prefix + 'ragged_' + key]
+        return ragged
                     
     def forward(self, batch_dict : Dict[str, torch.Tensor]):
         
         x = batch_dict["x"]
 
         if self.USE_LENGTH:
-            neighbor_lengths = torch.sqrt(torch.sum(x ** 2, dim = 2) + 1e-15)[:, :, None]
+            neighbor_lengths = batch_dict['neighbor_lengths']
         else:
             neighbor_lengths = torch.FloatTensor()  # for torch script
 
@@ -178,9 +224,13 @@ class CartesianTransformer(torch.nn.Module):
         mask = batch_dict['mask']
         batch = batch_dict['batch']
         nums = batch_dict['nums']
+        
+        species : Optional[torch.Tensor] = None
+        if self.SPECIES_SPECIFIC:
+            species = central_species
 
         if self.BLEND_NEIGHBOR_SPECIES and (not self.is_first):
-            neighbor_embedding = self.neighbor_embedder(neighbor_species)
+            neighbor_embedding = self.neighbor_embedder(neighbor_species, species)
         else:
             neighbor_embedding = torch.FloatTensor()  # for torch script
             
@@ -191,9 +241,6 @@ class CartesianTransformer(torch.nn.Module):
             neighbor_scalar_attributes = torch.FloatTensor()  # for torch script
             central_scalar_attributes = torch.FloatTensor()  # for torch script
         
-        initial_n_tokens = x.shape[1]
-        max_number = int(torch.max(nums))
-        
         if self.USE_ONLY_LENGTH:
             coordinates = [neighbor_lengths]
         else:
@@ -204,100 +251,62 @@ class CartesianTransformer(torch.nn.Module):
         if self.USE_ADDITIONAL_SCALAR_ATTRIBUTES:
             coordinates.append(neighbor_scalar_attributes)
         coordinates = torch.cat(coordinates, dim = 2)
-        coordinates = self.r_embedding(coordinates)   
+        coordinates = self.r_embedding(coordinates, species)   
         
         if self.BLEND_NEIGHBOR_SPECIES and (not self.is_first):
             tokens = torch.cat([coordinates, neighbor_embedding, input_messages], dim = 2)
         else:
             tokens = torch.cat([coordinates, input_messages], dim = 2) 
         
-        tokens = self.compress(tokens)
+        tokens = self.compress(tokens, species)
         
         if self.add_central_token:           
-            central_specie_embedding = self.central_embedder(central_species)
+            central_specie_embedding = self.central_embedder(central_species, species)
             if self.USE_ADDITIONAL_SCALAR_ATTRIBUTES:
-                central_scalar_embedding = self.central_scalar_embedding(central_scalar_attributes)
+                central_scalar_embedding = self.central_scalar_embedding(central_scalar_attributes, species)
                 central_token = torch.cat([central_specie_embedding, central_scalar_embedding], dim = 1)
-                central_token = self.central_compress(central_token)
+                central_token = self.central_compress(central_token, species)
             else:
                 central_token = central_specie_embedding
                 
             tokens = torch.cat([central_token[:, None, :], tokens], dim = 1)
 
-            submask = torch.zeros(mask.shape[0], dtype = torch.bool).to(mask.device)
-            total_mask = torch.cat([submask[:, None], mask], dim = 1)
-            
-            lengths = torch.sqrt(torch.sum(x * x, dim = 2) + 1e-16)
-            multipliers = cutoff_func(lengths, self.R_CUT, self.CUTOFF_DELTA)   
-            sub_multipliers = torch.ones(mask.shape[0], device = mask.device)
-            multipliers = torch.cat([sub_multipliers[:, None], multipliers], dim = 1)
-            multipliers[total_mask] = 0.0
-            
-            multipliers = multipliers[:, None, :]
-            multipliers = multipliers.repeat(1, multipliers.shape[2], 1)
-            
-            output_messages = self.trans(tokens[:, :(max_number + 1), :],
-                                                 multipliers=multipliers[:, :(max_number + 1), :(max_number + 1)])
-            if max_number < initial_n_tokens:
-                padding = torch.zeros(output_messages.shape[0], initial_n_tokens - max_number,
-                                      output_messages.shape[2], device = output_messages.device)
-                output_messages = torch.cat([output_messages, padding], dim = 1)
+            ragged : Optional[Dict[str, torch.Tensor]] = None
+            if self.RAGGED_TRANSFORMER:
+                ragged = self.get_ragged(batch_dict, 'central_')
+                if self.SPECIES_SPECIFIC:
+                    species = batch_dict['central_packed_species']
+            output_messages = self.run_transformer(tokens, batch_dict['central_attention_multipliers'], ragged, species)
             
             return {"output_messages" : output_messages[:, 1:, :],
                     "central_token" : output_messages[:, 0, :]}
         else:
-          
-            lengths = torch.sqrt(torch.sum(x * x, dim = 2) + 1e-16)
-            
-            
-            multipliers = cutoff_func(lengths, self.R_CUT, self.CUTOFF_DELTA)           
-            multipliers[mask] = 0.0
-            
-            multipliers = multipliers[:, None, :]
-            multipliers = multipliers.repeat(1, multipliers.shape[2], 1)
-            
-            output_messages = self.trans(tokens[:, :max_number, :],
-                                                 multipliers = multipliers[:, :max_number, :max_number])
-            if max_number < initial_n_tokens:
-                padding = torch.zeros(output_messages.shape[0], initial_n_tokens - max_number,
-                                      output_messages.shape[2], device = output_messages.device)
-                output_messages = torch.cat([output_messages, padding], dim = 1)
+            ragged : Optional[Dict[str, torch.Tensor]] = None
+            if self.RAGGED_TRANSFORMER:
+                ragged = self.get_ragged(batch_dict, '')
+                if self.SPECIES_SPECIFIC:
+                    species = batch_dict['packed_species']
+            output_messages = self.run_transformer(tokens, batch_dict['attention_multipliers'], ragged, species)
                 
             return {"output_messages" : output_messages}
 
 
-class CentralSpecificModel(torch.nn.Module):
-    def __init__(self, models):
-        super(CentralSpecificModel, self).__init__()
-        self.models = torch.nn.ModuleDict(models)
-        self.splitter = CentralSplitter()
-        self.uniter = CentralUniter()
-        
-    def forward(self, batch_dict):
-        central_indices = batch_dict["central_species"].data.cpu().numpy()
-        splitted = self.splitter(batch_dict, 
-                                 central_indices)
-        
-      
-        result = {}
-        for key in splitted.keys():
-            result[str(key)] = self.models[str(key)](splitted[key])
-        
-        
-        result = self.uniter(result, central_indices)
-        return result
-        
 class Head(torch.nn.Module):
-    def __init__(self, hypers, n_in, n_neurons):
+    def __init__(self, hypers, n_in, n_neurons, n_species = None):
+        '''If n_species is given, the head has separate weights for each central species'''
         super(Head, self).__init__()  
         self.hypers = hypers
-        self.nn = nn.Sequential(nn.Linear(n_in, n_neurons), get_activation(hypers),
-                                    nn.Linear(n_neurons, n_neurons), get_activation(hypers),
-                                    nn.Linear(n_neurons, hypers.D_OUTPUT))
+        self.nn = Sequential(get_linear(n_in, n_neurons, n_species), Elementwise(get_activation(hypers)),
+                             get_linear(n_neurons, n_neurons, n_species), Elementwise(get_activation(hypers)),
+                             get_linear(n_neurons, hypers.D_OUTPUT, n_species))
+        self.SPECIES_SPECIFIC = n_species is not None
        
     def forward(self, batch_dict : Dict[str, torch.Tensor]):
         pooled = batch_dict['pooled']
-        outputs = self.nn(pooled)
+        species : Optional[torch.Tensor] = None
+        if self.SPECIES_SPECIFIC:
+            species = batch_dict['central_species']
+        outputs = self.nn(pooled, species)
         return {"atomic_predictions" : outputs}
 
 class CentralTokensPredictor(torch.nn.Module):
@@ -319,8 +328,7 @@ class MessagesPredictor(torch.nn.Module):
 
     def forward(self, messages: torch.Tensor, mask: torch.Tensor, nums: torch.Tensor,
                  central_species: torch.Tensor, multipliers : torch.Tensor):
-        messages_proceed = messages * multipliers[:, :, None]
-        messages_proceed[mask] = 0.0
+        messages_proceed = (messages * multipliers[:, :, None]).masked_fill(mask[:, :, None], 0.0)
         if self.AVERAGE_POOLING:
             pooled = messages_proceed.sum(dim = 1) / nums[:, None]
         else:
@@ -340,7 +348,9 @@ class MessagesBondsPredictor(torch.nn.Module):
                  central_species: torch.Tensor):
         predictions = self.head({'pooled' : messages, 
                                      'central_species' : central_species})['atomic_predictions']
-        predictions[mask] = 0.0
+        # not in place; the optimized TorchScript graph rejects in-place
+        # writes into the output of the head when gradients are needed
+        predictions = predictions.masked_fill(mask[:, :, None], 0.0)
         if self.AVERAGE_BOND_ENERGIES:
             result = predictions.sum(dim = 1) / nums
         else:
@@ -359,6 +369,12 @@ class PET(torch.nn.Module):
         head_n_neurons = hypers.HEAD_N_NEURONS
         transformers_central_specific = hypers.TRANSFORMERS_CENTRAL_SPECIFIC
         heads_central_specific = hypers.HEADS_CENTRAL_SPECIFIC
+        
+        # absent in the hypers of older models
+        self.RAGGED_TRANSFORMER = getattr(hypers, 'RAGGED_TRANSFORMER', False)
+        # the attention of atoms with numbers of tokens rounded to the same
+        # one of this many sizes per doubling is computed together
+        self.RAGGED_BUCKETS_PER_OCTAVE = 4
 
         add_central_tokens = []
         for _ in range(hypers.N_GNN_LAYERS - 1):
@@ -368,45 +384,23 @@ class PET(torch.nn.Module):
 
         self.embedding = nn.Embedding(n_atomic_species + 1, transformer_d_model)
         gnn_layers = []
-        if transformers_central_specific:
-            for layer_index in range(n_gnn_layers):
-                if layer_index == 0:
-                    is_first = True
-                else:
-                    is_first = False
-                models = {str(i): CartesianTransformer(hypers, transformer_d_model, transformer_n_head,
-                                                   transformer_dim_feedforward, transformer_n_layers, 
-                                                   transformer_dropout, n_atomic_species, add_central_tokens[layer_index], 
-                                                       is_first)
-                         for i in range(len(all_species))}
-
-                gnn_layers.append(CentralSpecificModel(models))
-        else:
-            for layer_index in range(n_gnn_layers):
-                if layer_index == 0:
-                    is_first = True
-                else:
-                    is_first = False
-                model = CartesianTransformer(hypers, transformer_d_model, transformer_n_head,
-                                                   transformer_dim_feedforward, transformer_n_layers, 
-                                                   transformer_dropout, n_atomic_species, add_central_tokens[layer_index],
-                                             is_first)
-                gnn_layers.append(model)
+        for layer_index in range(n_gnn_layers):
+            if layer_index == 0:
+                is_first = True
+            else:
+                is_first = False
+            model = CartesianTransformer(hypers, transformer_d_model, transformer_n_head,
+                                               transformer_dim_feedforward, transformer_n_layers, 
+                                               transformer_dropout, n_atomic_species, add_central_tokens[layer_index],
+                                         is_first, species_specific = transformers_central_specific)
+            gnn_layers.append(model)
         
         self.gnn_layers = torch.nn.ModuleList(gnn_layers)
         
+        head_n_species = n_atomic_species if heads_central_specific else None
         heads = []
-        if heads_central_specific:
-            for _ in range(n_gnn_layers):
-                models = {str(i): Head(hypers, transformer_d_model, head_n_neurons) 
-                         for i in range(len(all_species))}
-                heads.append(CentralSpecificModel(models))
-                
-            models = {str(i): Head(hypers, transformer_d_model, head_n_neurons) 
-                         for i in range(len(all_species))}
-        else:
-            for _ in range(n_gnn_layers):
-                heads.append(Head(hypers, transformer_d_model, head_n_neurons))
+        for _ in range(n_gnn_layers):
+            heads.append(Head(hypers, transformer_d_model, head_n_neurons, n_species = head_n_species))
         
         self.heads = torch.nn.ModuleList(heads)
         self.central_tokens_predictors = torch.nn.ModuleList([CentralTokensPredictor(hypers, head) for head in heads])
@@ -414,41 +408,86 @@ class PET(torch.nn.Module):
         
         if hypers.USE_BOND_ENERGIES:
             bond_heads = []
-            if heads_central_specific:
-                for _ in range(n_gnn_layers):
-                    models = {str(i): Head(hypers, transformer_d_model, head_n_neurons) 
-                             for i in range(len(all_species))}
-                    bond_heads.append(CentralSpecificModel(models))
-
-                models = {str(i): Head(hypers, transformer_d_model, head_n_neurons) 
-                             for i in range(len(all_species))}
-            else:
-                for _ in range(n_gnn_layers):
-                    bond_heads.append(Head(hypers, transformer_d_model, head_n_neurons))
+            for _ in range(n_gnn_layers):
+                bond_heads.append(Head(hypers, transformer_d_model, head_n_neurons, n_species = head_n_species))
 
             self.bond_heads = torch.nn.ModuleList(bond_heads)
             self.messages_bonds_predictors = torch.nn.ModuleList([MessagesBondsPredictor(hypers, head) for head in bond_heads])
         else:
             self.messages_bonds_predictors = torch.nn.ModuleList([NeverRun() for _ in range(n_gnn_layers)])
         
-        self.R_CUT = hypers.R_CUT
-        self.CUTOFF_DELTA = hypers.CUTOFF_DELTA
+        # floats, so that models with integer cutoffs in hypers are scriptable
+        self.R_CUT = float(hypers.R_CUT)
+        self.CUTOFF_DELTA = float(hypers.CUTOFF_DELTA)
         self.USE_BOND_ENERGIES = hypers.USE_BOND_ENERGIES
         self.TARGET_TYPE = hypers.TARGET_TYPE
         self.TARGET_AGGREGATION = hypers.TARGET_AGGREGATION
         self.N_GNN_LAYERS = hypers.N_GNN_LAYERS
+        # absent in the hypers of older models
+        n_atom_buckets = getattr(hypers, 'N_ATOM_BUCKETS', None)
+        self.N_ATOM_BUCKETS = 1 if n_atom_buckets is None else int(n_atom_buckets)
+        self.N_SPECIES = n_atomic_species
+        self.TRANSFORMERS_CENTRAL_SPECIFIC = transformers_central_specific
+
+    def add_geometry(self, batch_dict : Dict[str, torch.Tensor]):
+        geometry = get_geometry(batch_dict['x'], batch_dict['mask'], self.R_CUT, self.CUTOFF_DELTA)
+        for key, value in geometry.items():
+            batch_dict[key] = value
+        if self.RAGGED_TRANSFORMER:
+            # computed once for all the layers, since finding the tokens which 
+            # are not padding and grouping the atoms sync with the host
+            mask = batch_dict['mask']
+            central_mask = torch.cat([torch.zeros_like(mask[:, :1]), mask], dim = 1)
+            for prefix, mask_now in [('', mask), ('central_', central_mask)]:
+                ragged = get_ragged_groups(mask_now, batch_dict[prefix + 'attention_multipliers'],
+                                           self.RAGGED_BUCKETS_PER_OCTAVE)
+                ragged['packed_index'] = get_packed_index(mask_now)
+                for key, value in ragged.items():
+                    batch_dict[prefix + 'ragged_' + key] = value
+            if self.TRANSFORMERS_CENTRAL_SPECIFIC:
+                # central species of each packed token
+                central_species = batch_dict['central_species']
+                for prefix, mask_now in [('', mask), ('central_', central_mask)]:
+                    atom_index = batch_dict[prefix + 'ragged_packed_index'] // mask_now.shape[1]
+                    batch_dict[prefix + 'packed_species'] = central_species.index_select(0, atom_index)
+
+    def get_bucket_dicts(self, batch_dict : Dict[str, torch.Tensor]):
+        '''Splits atoms into buckets by numbers of neighbors, each truncated to
+        its own maximal number of neighbors. Returns the dictionaries of
+        the buckets and the permutation restoring the order of atoms'''
+        nums = batch_dict['nums']
+        buckets = get_atom_buckets(nums, self.N_ATOM_BUCKETS)
+        bucket_dicts : List[Dict[str, torch.Tensor]] = []
+        for bucket in buckets:
+            length = max(1, int(torch.max(nums[bucket])))
+            bucket_dict = select_atoms(batch_dict, bucket, length)
+            self.add_geometry(bucket_dict)
+            bucket_dicts.append(bucket_dict)
+
+        order = torch.cat(buckets)
+        inverse = torch.empty_like(order)
+        inverse[order] = torch.arange(order.shape[0], device = order.device)
+        return bucket_dicts, buckets, inverse
 
     def get_predictions(self, batch_dict : Dict[str, torch.Tensor]):
+        # the dictionary of the caller is not modified
+        batch_dict = batch_dict.copy()
+        batch = batch_dict['batch']
         
         x = batch_dict["x"]
         central_species = batch_dict['central_species']
         neighbor_species = batch_dict['neighbor_species']
-        batch = batch_dict['batch']
         mask = batch_dict['mask']
         nums = batch_dict['nums']
         
-        lengths = torch.sqrt(torch.sum(x * x, dim = 2) + 1e-16)
-        multipliers = cutoff_func(lengths, self.R_CUT, self.CUTOFF_DELTA) 
+        self.add_geometry(batch_dict)
+        multipliers = batch_dict['multipliers']
+
+        bucket_dicts : List[Dict[str, torch.Tensor]] = []
+        buckets : List[torch.Tensor] = []
+        inverse = torch.LongTensor()  # for torch script
+        if self.N_ATOM_BUCKETS > 1:
+            bucket_dicts, buckets, inverse = self.get_bucket_dicts(batch_dict)
         
         neighbors_index = batch_dict['neighbors_index']
         neighbors_pos = batch_dict['neighbors_pos']
@@ -458,7 +497,23 @@ class PET(torch.nn.Module):
         
         for layer_index, (central_tokens_predictor, messages_predictor, gnn_layer, messages_bonds_predictor) in enumerate(zip(self.central_tokens_predictors, self.messages_predictors, self.gnn_layers, self.messages_bonds_predictors)):
             
-            result = gnn_layer(batch_dict)
+            if self.N_ATOM_BUCKETS > 1:
+                # each bucket is processed with its own number of neighbors, 
+                # and the outputs are padded back and put in the initial order
+                output_parts : List[torch.Tensor] = []
+                central_parts : List[torch.Tensor] = []
+                for bucket_dict, bucket in zip(bucket_dicts, buckets):
+                    length = bucket_dict['mask'].shape[1]
+                    bucket_dict['input_messages'] = batch_dict['input_messages'][bucket, :length]
+                    bucket_result = gnn_layer(bucket_dict)
+                    output_parts.append(F.pad(bucket_result["output_messages"], [0, 0, 0, x.shape[1] - length]))
+                    if "central_token" in bucket_result.keys():
+                        central_parts.append(bucket_result["central_token"])
+                result = {"output_messages" : torch.cat(output_parts, dim = 0)[inverse]}
+                if len(central_parts) > 0:
+                    result["central_token"] = torch.cat(central_parts, dim = 0)[inverse]
+            else:
+                result = gnn_layer(batch_dict)
             output_messages = result["output_messages"]
            
             #batch_dict['input_messages'] = output_messages[neighbors_index, neighbors_pos]
@@ -476,10 +531,10 @@ class PET(torch.nn.Module):
         if self.TARGET_TYPE == 'structural':
             if self.TARGET_AGGREGATION == 'sum':
                 return torch_geometric.nn.global_add_pool(atomic_predictions,
-                                                  batch=batch_dict['batch'])
+                                                  batch=batch)
             if self.TARGET_AGGREGATION == 'mean':
                 return torch_geometric.nn.global_mean_pool(atomic_predictions,
-                                                  batch=batch_dict['batch'])
+                                                  batch=batch)
             raise ValueError("unknown target aggregation")
         if self.TARGET_TYPE == 'atomic':
             return atomic_predictions
@@ -502,22 +557,87 @@ class PETUtilityWrapper(torch.nn.Module):
         super(PETUtilityWrapper, self).__init__()
         self.pet_model = pet_model
         self.global_aug = global_aug
+        self.shape_buckets_per_octave = None
+        self.compiled_forward = None
+
+    def enable_compilation(self, shape_buckets_per_octave = 4):
+        '''Runs pet_model compiled by torch.compile. Batches are padded to 
+        shape_buckets_per_octave sizes per doubling of the number of atoms and of 
+        the number of neighbors, which bounds the number of recompilations'''
+        self.shape_buckets_per_octave = shape_buckets_per_octave
+        self.compiled_forward = None
+
+    def __getstate__(self):
+        # the compiled function is bound to pet_model of this very wrapper,
+        # so copies, such as the ones of ModelKeeper, compile their own
+        state = self.__dict__.copy()
+        state['compiled_forward'] = None
+        return state
+
+    def get_padded_shape(self, batch):
+        return (get_shape_bucket(batch.x.shape[0], self.shape_buckets_per_octave),
+                get_shape_bucket(batch.x.shape[1], self.shape_buckets_per_octave))
+
+    def run_compiled(self, batch, batch_dict, rotations):
+        if self.compiled_forward is None:
+            self.compiled_forward = torch.compile(self.pet_model.forward, dynamic = False)
+        n_atoms = batch.x.shape[0]
+        padded_n_atoms, length = self.get_padded_shape(batch)
+        batch_dict = pad_batch_dict(batch_dict, padded_n_atoms, length, self.pet_model.N_SPECIES,
+                                    batch.num_graphs)
+        if rotations is not None:
+            identities = torch.eye(3, dtype = rotations.dtype, device = rotations.device)
+            rotations = torch.cat([rotations, identities.expand(padded_n_atoms - n_atoms, 3, 3)], dim = 0)
+        predictions = self.compiled_forward(batch_dict, rotations)
+        if self.pet_model.TARGET_TYPE == 'structural':
+            return predictions[:batch.num_graphs]
+        return predictions[:n_atoms]
 
     def forward(self, batch, augmentation):
         batch_dict = batch_to_dict(batch)
         rotations = None
-        if augmentation is not None:
+        if augmentation:
             indices = batch.batch.cpu().data.numpy()
             rotations = torch.FloatTensor(get_rotations(indices,
                                                          global_aug = self.global_aug)).to(batch.x.device)
+        if self.shape_buckets_per_octave is not None:
+            return self.run_compiled(batch, batch_dict, rotations)
         return self.pet_model(batch_dict, rotations)
 
+def assemble_forces(gradients, mask, neighbors_index):
+    '''Forces from the gradients of the energy with respect to the vectors x from 
+    atoms to their neighbors. As x[i, m] is the position of the neighbor j of i minus
+    the one of i, each actual edge adds its gradient to the force on i and subtracts 
+    it from the one on j, by a single index_add over the edges which are not padding. 
+    Out of place, so that it is differentiable with create_graph = True'''
+    edges = torch.logical_not(mask)
+    centers = torch.nonzero(edges)[:, 0]
+    edge_gradients = gradients[edges]
+    indices = torch.cat([centers, neighbors_index[edges]])
+    values = torch.cat([edge_gradients, -edge_gradients])
+    forces = torch.zeros([gradients.shape[0], 3], dtype = gradients.dtype, device = gradients.device)
+    return forces.index_add(0, indices, values)
+
+def assemble_virials(gradients, mask, x, batch, n_structures):
+    '''Virials of the structures from the same gradients with respect to x as the forces,
+    as minus the sum over edges of the outer products of x_ij and dE/dx_ij. The energy 
+    depends on the positions only through x, so for finite systems this is the sum of the 
+    outer products of r_i and F_i over atoms, and for periodic ones it also includes the
+    dependence on the cell. The stress in the convention of ASE is -virial / volume'''
+    edges = torch.logical_not(mask)
+    centers = torch.nonzero(edges)[:, 0]
+    values = -x[edges][:, :, None] * gradients[edges][:, None, :]
+    virials = torch.zeros([n_structures, 3, 3], dtype = gradients.dtype, device = gradients.device)
+    return virials.index_add(0, batch[centers], values.to(gradients.dtype))
+
 class PETMLIPWrapper(torch.nn.Module):
-    def __init__(self, model, use_energies, use_forces):
+    def __init__(self, model, use_energies, use_forces, use_virials = False):
         super(PETMLIPWrapper, self).__init__()
         self.model = model
         self.use_energies = use_energies
         self.use_forces = use_forces
+        # if True, virials are returned as the third output
+        self.use_virials = use_virials
         if self.model.pet_model.hypers.D_OUTPUT != 1:
             raise ValueError("D_OUTPUT should be 1 for MLIP; energy is a single scalar")
         if self.model.pet_model.hypers.TARGET_TYPE != 'structural':
@@ -535,18 +655,15 @@ class PETMLIPWrapper(torch.nn.Module):
 
     def forward(self, batch, augmentation, create_graph):
         
-        if self.use_forces:
+        if self.use_forces or self.use_virials:
             batch.x.requires_grad = True
             predictions = self.get_predictions(batch, augmentation)
             grads  = torch.autograd.grad(predictions, batch.x, grad_outputs = torch.ones_like(predictions),
                                     create_graph = create_graph)[0]
-            neighbors_index = batch.neighbors_index.transpose(0, 1)
-            neighbors_pos = batch.neighbors_pos
-            grads_messaged = grads[neighbors_index, neighbors_pos]
-            grads[batch.mask] = 0.0
-            first = grads.sum(dim = 1)
-            grads_messaged[batch.mask] = 0.0
-            second = grads_messaged.sum(dim = 1)
+            if self.use_forces:
+                forces = assemble_forces(grads, batch.mask, batch.neighbors_index.transpose(0, 1))
+            if self.use_virials:
+                virials = assemble_virials(grads, batch.mask, batch.x.detach(), batch.batch, batch.num_graphs)
         else:
             predictions = self.get_predictions(batch, augmentation)
 
@@ -557,8 +674,11 @@ class PETMLIPWrapper(torch.nn.Module):
             result.append(None)
             
         if self.use_forces:
-            result.append(first - second)
+            result.append(forces)
         else:
             result.append(None)
+
+        if self.use_virials:
+            result.append(virials)
             
         return result
\ No newline at end of file
@@ -4,6 +4,7 @@ from tqdm import tqdm
 from scipy.spatial.transform import Rotation
 
 from .torch_geometric.data import Batch
+from .pet import assemble_forces
 
 
 
@@ -172,14 +173,7 @@ class PETSP(torch.nn.Module):
         for predictions, grads, n_frames, weight_aux, total_main_weight in tqdm(self.get_all_contributions(batch, additional_rotations), disable = not self.show_progress):
             predictions_total += predictions
             if self.use_forces:
-                neighbors_index = batch.neighbors_index.transpose(0, 1)
-                neighbors_pos = batch.neighbors_pos
-                grads_messaged = grads[neighbors_index, neighbors_pos]
-                grads[batch.mask] = 0.0
-                first = grads.sum(dim = 1)
-                grads_messaged[batch.mask] = 0.0
-                second = grads_messaged.sum(dim = 1)
-                forces_predicted = first - second
+                forces_predicted = assemble_forces(grads, batch.mask, batch.neighbors_index.transpose(0, 1))
                 forces_predicted_total += forces_predicted
             
         if n_frames is None:
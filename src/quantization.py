@@ -0,0 +1,181 @@
+import copy
+import time
+import argparse
+import torch
+from torch import nn
+import ase.io
+import numpy as np
+from typing import Optional
+from torch.utils.data import DataLoader
+
+from .hypers import load_hypers_from_file
+from .pet import PET, PETMLIPWrapper, PETUtilityWrapper
+from .species_layers import SpeciesLinear, check_species, select_species
+from .molecule import PaddingCollater
+from .data_preparation import get_pyg_graphs, get_corrected_energies, get_forces
+from .utilities import get_rmse
+
+
+# int8 inference. Weights are quantized per output channel and activations 
+# dynamically, per tensor, by the fbgemm or qnnpack kernels of torch, so these
+# layers run on CPUs only. The quantized kernels are not differentiable, and
+# the backward pass multiplies by the dequantized weights instead, so that
+# forces stay available; the quantized layers have no trainable parameters.
+
+def quantize_weight(weight, bias):
+    '''Packed int8 weight with the bias for the quantized kernels, and the 
+    dequantized weight'''
+    weight = weight.detach().float().cpu()
+    scales = torch.clamp(torch.amax(torch.abs(weight), dim = 1), min = 1e-8) / 127.0
+    zero_points = torch.zeros(weight.shape[0], dtype = torch.long)
+    quantized = torch.quantize_per_channel(weight, scales.double(), zero_points, 0, torch.qint8)
+    packed = torch.ops.quantized.linear_prepack(quantized, bias.detach().float().cpu())
+    return packed, quantized.dequantize()
+
+
+class QuantizedLinearFunction(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, packed, dequantized_weight):
+        ctx.save_for_backward(dequantized_weight)
+        return torch.ops.quantized.linear_dynamic(x.float().contiguous(), packed, True)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        dequantized_weight, = ctx.saved_tensors
+        return torch.matmul(grad_output, dequantized_weight), None, None
+
+
+class QuantizedLinear(nn.Module):
+    def __init__(self, layer):
+        super(QuantizedLinear, self).__init__()
+        self.packed, dequantized_weight = quantize_weight(layer.weight, layer.bias)
+        self.register_buffer('dequantized_weight', dequantized_weight, persistent = False)
+
+    def forward(self, x, species : Optional[torch.Tensor] = None):
+        return QuantizedLinearFunction.apply(x, self.packed, self.dequantized_weight)
+
+
+class QuantizedSpeciesLinear(nn.Module):
+    '''The weights of all the species are packed together, and the outputs of 
+    the species of each entry are selected after a single quantized kernel'''
+    def __init__(self, layer):
+        super(QuantizedSpeciesLinear, self).__init__()
+        n_species, n_out, n_in = layer.weight.shape
+        self.packed, dequantized_weight = quantize_weight(layer.weight.reshape(n_species * n_out, n_in), 
+                                                          layer.bias.reshape(n_species * n_out))
+        self.register_buffer('dequantized_weight', dequantized_weight.reshape(n_species, n_out, n_in), persistent = False)
+
+    def forward(self, x, species : Optional[torch.Tensor] = None):
+        species = check_species(species)
+        n_species, n_out, n_in = self.dequantized_weight.shape
+        outputs = QuantizedLinearFunction.apply(x, self.packed, self.dequantized_weight.reshape(n_species * n_out, n_in))
+        return select_species(outputs, species, n_species)
+
+
+def quantize_linear_layers(module):
+    '''Replaces in place all the shared and species-specific linear layers 
+    of module by the int8 ones'''
+    for name, child in module.named_children():
+        if isinstance(child, SpeciesLinear):
+            setattr(module, name, QuantizedSpeciesLinear(child))
+        elif isinstance(child, nn.Linear):
+            setattr(module, name, QuantizedLinear(child))
+        else:
+            quantize_linear_layers(child)
+    return module
+
+
+def quantize(model):
+    '''int8 copy of an MLIP or general target model for inference on CPUs. Only the 
+    linear layers are quantized; the embeddings, layer norms, the attention weights,
+    the cutoff function and the rest of the geometric part stay in fp32'''
+    model = copy.deepcopy(model).cpu()
+    model.eval()
+    utility_wrapper = model.model if isinstance(model, PETMLIPWrapper) else model
+    quantize_linear_layers(utility_wrapper.pet_model)
+    return model
+
+
+def load_model(path_to_calc_folder, checkpoint):
+    hypers = load_hypers_from_file(path_to_calc_folder + '/hypers_used.yaml')
+    if hypers.UTILITY_FLAGS.CALCULATION_TYPE != 'mlip':
+        raise ValueError("only MLIP models are supported")
+    MLIP_SETTINGS = hypers.MLIP_SETTINGS
+    all_species = np.load(path_to_calc_folder + '/all_species.npy')
+    model = PET(hypers.ARCHITECTURAL_HYPERS, 0.0, len(all_species))
+    model = PETMLIPWrapper(PETUtilityWrapper(model, hypers.FITTING_SCHEME.GLOBAL_AUG),
+                           MLIP_SETTINGS.USE_ENERGIES, MLIP_SETTINGS.USE_FORCES)
+    state_dict = torch.load(path_to_calc_folder + '/' + checkpoint + '_state_dict', map_location = 'cpu')
+    # models fitted with MULTI_GPU are saved wrapped into DataParallel
+    state_dict = {(key[len('module.'):] if key.startswith('module.') else key) : value
+                  for key, value in state_dict.items()}
+    model.load_state_dict(state_dict)
+    model.eval()
+    return model, hypers, all_species
+
+
+def predict(model, loader):
+    '''Energies and forces of all the structures, and the time it took'''
+    energies, forces = [], []
+    begin = time.time()
+    for batch in loader:
+        energies_batch, forces_batch = model(batch, augmentation = False, create_graph = False)
+        if energies_batch is not None:
+            energies.append(energies_batch.data.numpy())
+        if forces_batch is not None:
+            forces.append(forces_batch.data.numpy())
+    total_time = time.time() - begin
+    energies = np.concatenate(energies, axis = 0) if len(energies) > 0 else None
+    forces = np.concatenate(forces, axis = 0) if len(forces) > 0 else None
+    return energies, forces, total_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Compares the int8 quantized model with the full precision one on the given structures")
+    parser.add_argument("structures_path", help="Path to an xyz file with structures for calibration", type = str)
+    parser.add_argument("path_to_calc_folder", help="Path to a folder with a model to use", type = str)
+    parser.add_argument("checkpoint", help="Checkpoint to use, such as best_val_rmse_both_model", type = str)
+    parser.add_argument("--batch_size", help="Batch size to use for inference", type = int, default = 16)
+    args = parser.parse_args()
+
+    model, hypers, all_species = load_model(args.path_to_calc_folder, args.checkpoint)
+    MLIP_SETTINGS = hypers.MLIP_SETTINGS
+    quantized = quantize(model)
+
+    structures = ase.io.read(args.structures_path, index = ':')
+    ARCHITECTURAL_HYPERS = hypers.ARCHITECTURAL_HYPERS
+    graphs = get_pyg_graphs(structures, all_species, ARCHITECTURAL_HYPERS.R_CUT,
+                            ARCHITECTURAL_HYPERS.USE_ADDITIONAL_SCALAR_ATTRIBUTES,
+                            ARCHITECTURAL_HYPERS.USE_LONG_RANGE, ARCHITECTURAL_HYPERS.K_CUT)
+    loader = DataLoader(graphs, batch_size = args.batch_size, shuffle = False,
+                        collate_fn = PaddingCollater(len(all_species)))
+    n_atoms = sum([len(structure.positions) for structure in structures])
+
+    # warmup for correct time estimation
+    for batch in loader:
+        model(batch, augmentation = False, create_graph = False)
+        quantized(batch, augmentation = False, create_graph = False)
+        break
+
+    energies, forces, time_full = predict(model, loader)
+    energies_quantized, forces_quantized, time_quantized = predict(quantized, loader)
+    print(f"time per atom: fp32 {time_full / n_atoms:.3e} s, int8 {time_quantized / n_atoms:.3e} s, speedup {time_full / time_quantized:.2f}")
+
+    ground_truth = [None, None]
+    if MLIP_SETTINGS.USE_ENERGIES and all(MLIP_SETTINGS.ENERGY_KEY in structure.info for structure in structures):
+        self_contributions = np.load(args.path_to_calc_folder + '/self_contributions.npy')
+        ground_truth[0] = get_corrected_energies(MLIP_SETTINGS.ENERGY_KEY, structures, all_species, self_contributions)
+    if MLIP_SETTINGS.USE_FORCES and all(MLIP_SETTINGS.FORCES_KEY in structure.arrays for structure in structures):
+        ground_truth[1] = np.concatenate([force.data.numpy() for force in get_forces(structures, MLIP_SETTINGS.FORCES_KEY)], axis = 0)
+
+    for name, full, reduced, target in zip(['energies', 'forces'], [energies, forces],
+                                           [energies_quantized, forces_quantized], ground_truth):
+        if full is None:
+            continue
+        print(f"{name}: rmse of int8 predictions from fp32 ones {get_rmse(reduced, full):.4e}")
+        if target is not None:
+            print(f"{name}: rmse fp32 {get_rmse(full, target):.4e}, rmse int8 {get_rmse(reduced, target):.4e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import collections
+
+from .graph_cache import get_structure_hash
+
+
+class ResultsCache:
+    '''In-memory LRU cache of the results of calculators addressed by the
+    hash of the geometry, holding at most capacity entries'''
+
+    def __init__(self, capacity, tolerance = 0.0, use_additional_scalar_attributes = False):
+        if capacity < 1:
+            raise ValueError("capacity of the cache of results should be positive")
+        if tolerance < 0.0:
+            raise ValueError("tolerance of the cache of results should be non-negative")
+        self.capacity = capacity
+        self.tolerance = tolerance
+        self.use_additional_scalar_attributes = use_additional_scalar_attributes
+        self.entries = collections.OrderedDict()
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def get_key(self, structure):
+        return get_structure_hash(structure, self.use_additional_scalar_attributes, self.tolerance)
+
+    def load(self, key):
+        '''Returns the cached results or None, and counts hits and misses'''
+        if key not in self.entries:
+            self.n_misses += 1
+            return None
+        self.n_hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def save(self, key, results):
+        self.entries[key] = results
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last = False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def get_statistics(self):
+        n_lookups = self.n_hits + self.n_misses
+        return {'n_hits' : self.n_hits, 'n_misses' : self.n_misses,
+                'hit_rate' : self.n_hits / max(n_lookups, 1),
+                'size' : len(self.entries), 'capacity' : self.capacity}
@@ -0,0 +1,113 @@
+import os
+import json
+import numpy as np
+import torch
+from torch_geometric.data import Data
+
+# per atom and per neighbor entries of the graphs; all the remaining
+# entries are stored as they are, concatenated along the first dimension
+ATOMIC_KEYS = ['central_species', 'nums', 'central_scalar_attributes']
+NEIGHBOR_KEYS = ['x', 'neighbor_species', 'neighbors_index', 'neighbors_pos', 'neighbor_scalar_attributes']
+
+
+class ShardedGraphWriter:
+    '''Writes graphs built by Molecule.get_graph into shards of numpy arrays.
+    Each shard is a folder with one .npy file per entry and offsets
+    of structures along the atoms, neighbors and other entries'''
+
+    def __init__(self, path, shard_size = 10000):
+        self.path = path
+        self.shard_size = shard_size
+        self.shard_sizes = []
+        self.graphs = []
+        os.makedirs(path, exist_ok = True)
+
+    def add(self, graph):
+        if 'k_vectors' in graph.keys():
+            raise NotImplementedError("sharded storage of long-range graphs is not supported")
+        self.graphs.append(graph)
+        if len(self.graphs) == self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.graphs) == 0:
+            return
+        arrays = {}
+        offsets = {}
+        for graph in self.graphs:
+            for key in graph.keys():
+                value = graph[key]
+                if not isinstance(value, torch.Tensor):
+                    value = torch.tensor(value)[None]
+                if key not in ATOMIC_KEYS + NEIGHBOR_KEYS:
+                    offsets.setdefault(key, [0]).append(offsets[key][-1] + value.shape[0])
+                arrays.setdefault(key, []).append(value.numpy())
+
+            offsets.setdefault('atoms', [0]).append(offsets['atoms'][-1] + len(graph.nums))
+            offsets.setdefault('neighbors', [0]).append(offsets['neighbors'][-1] + graph.x.shape[0])
+
+        shard_path = os.path.join(self.path, f"shard_{len(self.shard_sizes)}")
+        os.makedirs(shard_path, exist_ok = True)
+        for key, values in arrays.items():
+            np.save(os.path.join(shard_path, f"{key}.npy"), np.concatenate(values, axis = 0))
+        for key, values in offsets.items():
+            np.save(os.path.join(shard_path, f"{key}_offsets.npy"), np.array(values, dtype = np.int64))
+
+        self.shard_sizes.append(len(self.graphs))
+        self.graphs = []
+
+    def close(self):
+        self.flush()
+        metadata = {'shard_sizes' : self.shard_sizes}
+        with open(os.path.join(self.path, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f)
+
+
+class ShardedGraphDataset(torch.utils.data.Dataset):
+    '''Graphs stored by ShardedGraphWriter. Shards are memory-mapped,
+    so only the accessed graphs are read from disk. The graphs are returned
+    without padding, as they are built by Molecule.get_graph'''
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'metadata.json'), 'r') as f:
+            metadata = json.load(f)
+        self.shard_offsets = np.cumsum([0] + metadata['shard_sizes'])
+        self.shards = [None for _ in metadata['shard_sizes']]
+
+    def __len__(self):
+        return int(self.shard_offsets[-1])
+
+    def get_shard(self, shard_index):
+        if self.shards[shard_index] is None:
+            shard_path = os.path.join(self.path, f"shard_{shard_index}")
+            # copy-on-write mapping gives writable arrays without modifying the files
+            self.shards[shard_index] = {name[:-len('.npy')] : np.load(os.path.join(shard_path, name), mmap_mode = 'c')
+                                        for name in os.listdir(shard_path)}
+        return self.shards[shard_index]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        shard_index = int(np.searchsorted(self.shard_offsets, index, side = 'right')) - 1
+        shard = self.get_shard(shard_index)
+        local_index = index - self.shard_offsets[shard_index]
+
+        def get_slice(key, offsets_key):
+            offsets = shard[f"{offsets_key}_offsets"]
+            return torch.from_numpy(shard[key][offsets[local_index] : offsets[local_index + 1]])
+
+        kwargs = {}
+        for key in shard.keys():
+            if key.endswith('_offsets'):
+                continue
+            if key in ATOMIC_KEYS:
+                kwargs[key] = get_slice(key, 'atoms')
+            elif key in NEIGHBOR_KEYS:
+                kwargs[key] = get_slice(key, 'neighbors')
+            else:
+                kwargs[key] = get_slice(key, key)
+
+        kwargs['n_atoms'] = int(kwargs['n_atoms'][0])
+        return Data(**kwargs)
+
@@ -4,13 +4,21 @@ import numpy as np
 from torch_geometric.nn import DataParallel
 
 from .data_preparation import get_compositional_features
-from .molecule import Molecule
-from .hypers import load_hypers_from_file
+from .molecule import Molecule, PaddingCollater
+from .hypers import load_hypers_from_file, validate_mixed_precision
 from .pet import PET, PETMLIPWrapper, PETUtilityWrapper
+from .quantization import quantize_linear_layers
+from .results_cache import ResultsCache
+from .utilities import get_autocast
 
 
 class SingleStructCalculator():
-    def __init__(self, path_to_calc_folder, checkpoint="best_val_rmse_both_model", device="cpu"): 
+    def __init__(self, path_to_calc_folder, checkpoint="best_val_rmse_both_model", device="cpu",
+                 use_torch_neighbor_list=False, mixed_precision=None,
+                 compile_model=False, compile_shape_buckets=4, quantize=False, use_virials=False,
+                 cache_size=0, cache_tolerance=0.0): 
+        if quantize and (compile_model or torch.device(device).type != 'cpu'):
+            raise ValueError("quantized models run only on CPUs and can not be compiled")
         hypers_path = path_to_calc_folder + '/hypers_used.yaml'
         path_to_model_state_dict = path_to_calc_folder + '/' + checkpoint + '_state_dict'
         all_species_path = path_to_calc_folder + '/all_species.npy'
@@ -21,6 +29,8 @@ class SingleStructCalculator():
         MLIP_SETTINGS = hypers.MLIP_SETTINGS
         ARCHITECTURAL_HYPERS = hypers.ARCHITECTURAL_HYPERS
         FITTING_SCHEME = hypers.FITTING_SCHEME
+        if quantize and FITTING_SCHEME.MULTI_GPU:
+            raise ValueError("quantize is not supported for models fitted with MULTI_GPU")
 
         self.architectural_hypers = ARCHITECTURAL_HYPERS
 
@@ -31,31 +41,72 @@ class SingleStructCalculator():
         model = PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species)).to(device)
         model = PETUtilityWrapper(model,
                 FITTING_SCHEME.GLOBAL_AUG)
+        if compile_model:
+            # structures are padded to a few sizes, so that sequences of 
+            # structures of different sizes compile a bounded number of times
+            model.enable_compilation(compile_shape_buckets)
 
-        model = PETMLIPWrapper(model, MLIP_SETTINGS.USE_ENERGIES, MLIP_SETTINGS.USE_FORCES)
+        # virials come from the same gradients as the forces
+        model = PETMLIPWrapper(model, MLIP_SETTINGS.USE_ENERGIES, MLIP_SETTINGS.USE_FORCES, use_virials)
         if FITTING_SCHEME.MULTI_GPU and torch.cuda.is_available():
             model = DataParallel(model)
             model = model.to(torch.device('cuda:0'))
 
         model.load_state_dict(torch.load(path_to_model_state_dict, map_location=torch.device(device)))
         model.eval()
+        if quantize:
+            # int8 linear layers; forces are still the gradients of the energy
+            quantize_linear_layers(model.model.pet_model)
         
         self.model = model
         self.hypers = hypers
         self.all_species = all_species
+        # the torch cell list runs on the same device as the model
+        self.neighbor_list_device = device if use_torch_neighbor_list else None
+        self.mixed_precision = validate_mixed_precision(mixed_precision)
+        self.device = torch.device(device)
+        self.use_virials = use_virials
+        # results of the last cache_size distinct geometries, with positions and
+        # the cell rounded to multiples of cache_tolerance; disabled if cache_size is 0
+        self.cache = None
+        if cache_size > 0:
+            self.cache = ResultsCache(cache_size, cache_tolerance,
+                                      ARCHITECTURAL_HYPERS.USE_ADDITIONAL_SCALAR_ATTRIBUTES)
         
+    def get_cache_statistics(self):
+        if self.cache is None:
+            raise ValueError("cache of results is disabled, set cache_size to enable it")
+        return self.cache.get_statistics()
         
     def forward(self, structure):
+        if self.cache is None:
+            return self.compute(structure)
+        key = self.cache.get_key(structure)
+        results = self.cache.load(key)
+        if results is None:
+            results = self.compute(structure)
+            self.cache.save(key, results)
+        # copies, so that the cached results can not be modified by the caller
+        return tuple(np.copy(result) for result in results)
+        
+    def compute(self, structure):
         molecule = Molecule(structure, self.architectural_hypers.R_CUT, 
                             self.architectural_hypers.USE_ADDITIONAL_SCALAR_ATTRIBUTES,
-                            self.architectural_hypers.USE_LONG_RANGE, self.architectural_hypers.K_CUT)
+                            self.architectural_hypers.USE_LONG_RANGE, self.architectural_hypers.K_CUT,
+                            neighbor_list_device = self.neighbor_list_device)
         
-        graph = molecule.get_graph(molecule.get_max_num(), self.all_species, molecule.get_num_k())
-        graph.batch = torch.zeros(graph.num_nodes, dtype = torch.long, device = graph.x.device)
-        prediction_energy, prediction_forces = self.model(graph, augmentation = False, create_graph = False)
+        graph = molecule.get_graph(self.all_species)
+        batch = PaddingCollater(len(self.all_species))([graph])
+        if not self.hypers.FITTING_SCHEME.MULTI_GPU:
+            batch.to(self.device)
+        with get_autocast(self.device, self.mixed_precision):
+            predictions = self.model(batch, augmentation = False, create_graph = False)
+        prediction_energy, prediction_forces = predictions[:2]
 
         compositional_features = get_compositional_features([structure], self.all_species)[0]
         self_contributions_energy = np.dot(compositional_features, self.self_contributions)
         energy_total = prediction_energy.data.cpu().numpy() + self_contributions_energy
+        if self.use_virials:
+            return energy_total, prediction_forces.data.cpu().numpy(), predictions[2][0].data.cpu().numpy()
         return energy_total, prediction_forces.data.cpu().numpy()
 
@@ -0,0 +1,169 @@
+import math
+import torch
+from torch import nn
+import torch.nn.functional as F
+from typing import Optional
+
+# All the layers here take species, the central species of each entry of x
+# along the first dimension. Shared layers ignore them and have the same
+# parameters as the corresponding torch.nn layers, so that models without
+# species-specific weights are saved in the same way as before.
+#
+# Species-specific layers keep the weights of all the species stacked along
+# the first dimension and select them on the device, so that entries need 
+# not be sorted, and neither a loop over species nor their counts on the 
+# host are needed.
+
+
+def check_species(species : Optional[torch.Tensor]) -> torch.Tensor:
+    if species is None:
+        raise ValueError("species must be provided for species-specific layers")
+    return species
+
+
+def expand_species(values, species, n_dims : int):
+    '''values[species], [n, ..., dim], broadcastable to n_dims dimensions'''
+    shape = [species.shape[0]] + [1 for _ in range(n_dims - 2)] + [values.shape[-1]]
+    return values.index_select(0, species).reshape(shape)
+
+
+def get_rows_per_entry(x) -> int:
+    '''Number of rows of x, along all but the last dimension, per entry'''
+    n_rows = 1
+    for size in x.shape[1:-1]:
+        n_rows *= size
+    return n_rows
+
+
+def species_linear(x, weight, bias, species : Optional[torch.Tensor]):
+    '''Linear layer with the weights of the species of each entry of x,
+    weight being [n_species, n_out, n_in] and bias [n_species, n_out]'''
+    species = check_species(species)
+    n_species, n_out, n_in = weight.shape[0], weight.shape[1], weight.shape[2]
+    n_rows = get_rows_per_entry(x)
+    output_shape = list(x.shape[:-1]) + [n_out]
+    if n_in < n_rows * n_species:
+        # the weights of each entry are smaller than the outputs of all the species
+        x = x.reshape(x.shape[0], n_rows, n_in)
+        result = torch.baddbmm(bias.index_select(0, species)[:, None, :], x, 
+                               weight.index_select(0, species).transpose(1, 2))
+        return result.reshape(output_shape)
+    # one matrix multiplication for all the species
+    result = F.linear(x, weight.reshape(n_species * n_out, n_in), bias.reshape(n_species * n_out))
+    return select_species(result, species, n_species)
+
+
+def select_species(outputs, species, n_species : int):
+    '''[n, ..., n_species * n_out] -> [n, ..., n_out], the outputs of the 
+    species of each entry'''
+    n_out = outputs.shape[-1] // n_species
+    n_rows = get_rows_per_entry(outputs)
+    # rows of [n * n_rows * n_species, n_out] with the species of their entries
+    rows = torch.arange(outputs.shape[0] * n_rows, device = species.device).reshape(outputs.shape[0], n_rows)
+    index = (rows * n_species + species[:, None]).reshape(-1)
+    result = outputs.reshape(-1, n_out).index_select(0, index)
+    return result.reshape(list(outputs.shape[:-1]) + [n_out])
+
+
+class Linear(nn.Linear):
+    def forward(self, x, species : Optional[torch.Tensor] = None):
+        return F.linear(x, self.weight, self.bias)
+
+
+class SpeciesLinear(nn.Module):
+    def __init__(self, n_species, n_in, n_out):
+        super(SpeciesLinear, self).__init__()
+        self.weight = nn.Parameter(torch.empty(n_species, n_out, n_in))
+        self.bias = nn.Parameter(torch.empty(n_species, n_out))
+        # the same initialization as of nn.Linear for each species
+        bound = 1.0 / math.sqrt(n_in)
+        for index in range(n_species):
+            nn.init.kaiming_uniform_(self.weight[index], a = math.sqrt(5))
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x, species : Optional[torch.Tensor] = None):
+        return species_linear(x, self.weight, self.bias, species)
+
+
+class LayerNorm(nn.LayerNorm):
+    def forward(self, x, species : Optional[torch.Tensor] = None):
+        return F.layer_norm(x, self.normalized_shape, self.weight, self.bias, self.eps)
+
+
+class SpeciesLayerNorm(nn.Module):
+    def __init__(self, n_species, d_model, eps = 1e-5):
+        super(SpeciesLayerNorm, self).__init__()
+        self.weight = nn.Parameter(torch.ones(n_species, d_model))
+        self.bias = nn.Parameter(torch.zeros(n_species, d_model))
+        self.d_model = d_model
+        self.eps = eps
+
+    def forward(self, x, species : Optional[torch.Tensor] = None):
+        species = check_species(species)
+        x = F.layer_norm(x, [self.d_model], None, None, self.eps)
+        return x * expand_species(self.weight, species, x.dim()) + expand_species(self.bias, species, x.dim())
+
+
+class Embedding(nn.Embedding):
+    def forward(self, x, species : Optional[torch.Tensor] = None):
+        return F.embedding(x, self.weight)
+
+
+class SpeciesEmbedding(nn.Module):
+    def __init__(self, n_species, n_embeddings, d_model):
+        super(SpeciesEmbedding, self).__init__()
+        self.weight = nn.Parameter(torch.empty(n_species, n_embeddings, d_model))
+        nn.init.normal_(self.weight)
+
+    def forward(self, x, species : Optional[torch.Tensor] = None):
+        species = check_species(species)
+        shape = [species.shape[0]] + [1 for _ in range(x.dim() - 1)]
+        # embeddings of all the species as consecutive rows of one table
+        x = x + species.reshape(shape) * self.weight.shape[1]
+        return F.embedding(x, self.weight.reshape(-1, self.weight.shape[2]))
+
+
+class Elementwise(nn.Module):
+    '''Wraps a layer without weights, such as an activation or dropout'''
+    def __init__(self, module):
+        super(Elementwise, self).__init__()
+        self.module = module
+
+    def forward(self, x, species : Optional[torch.Tensor] = None):
+        return self.module(x)
+
+
+class Sequential(nn.Sequential):
+    def forward(self, x, species : Optional[torch.Tensor] = None):
+        for module in self:
+            x = module(x, species)
+        return x
+
+
+def get_linear(n_in, n_out, n_species = None):
+    '''Shared linear layer if n_species is None, species-specific otherwise'''
+    if n_species is None:
+        return Linear(n_in, n_out)
+    return SpeciesLinear(n_species, n_in, n_out)
+
+
+def get_layer_norm(d_model, n_species = None):
+    if n_species is None:
+        return LayerNorm(d_model)
+    return SpeciesLayerNorm(n_species, d_model)
+
+
+def get_embedding(n_embeddings, d_model, n_species = None):
+    if n_species is None:
+        return Embedding(n_embeddings, d_model)
+    return SpeciesEmbedding(n_species, n_embeddings, d_model)
+
+
+def xavier_uniform_(layer):
+    '''Initializes the weights of a shared or species-specific linear layer'''
+    if isinstance(layer, SpeciesLinear):
+        for index in range(layer.weight.shape[0]):
+            nn.init.xavier_uniform_(layer.weight[index])
+    else:
+        nn.init.xavier_uniform_(layer.weight)
+
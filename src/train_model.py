@@ -14,11 +14,21 @@ from .hypers import save_hypers, set_hypers_from_files
 from .pet import PET, PETMLIPWrapper, PETUtilityWrapper
 from .utilities import FullLogger, get_scheduler, load_checkpoint, get_data_loaders
 from .utilities import get_rmse, get_loss, set_reproducibility, get_calc_names
-from .utilities import get_optimizer
+from .utilities import get_optimizer, get_autocast, get_grad_scaler
 from .analysis import adapt_hypers
 from .data_preparation import get_self_contributions, get_corrected_energies
 import argparse
-from .data_preparation import get_pyg_graphs, update_pyg_graphs, get_forces
+from .data_preparation import get_forces, get_virials, get_graphs_dataset
+
+def get_virials_per_structure(predictions_virials, batch, energies_loss):
+    '''Predicted and target virials flattened per structure, and divided by 
+    the numbers of atoms if energies are fitted per atom'''
+    predictions_virials = predictions_virials.reshape(-1, 9)
+    ground_truth_virials = batch.virials.reshape(-1, 9)
+    if energies_loss == 'per_atom':
+        predictions_virials = predictions_virials / batch.n_atoms[:, None]
+        ground_truth_virials = ground_truth_virials / batch.n_atoms[:, None]
+    return predictions_virials, ground_truth_virials
 
 def main():
     TIME_SCRIPT_STARTED = time.time()
@@ -40,6 +50,9 @@ def main():
 
     if FITTING_SCHEME.USE_SHIFT_AGNOSTIC_LOSS:
         raise ValueError("shift agnostic loss is intended only for general target training")
+    if FITTING_SCHEME.COMPILE and MLIP_SETTINGS.USE_FORCES:
+        # forces in the loss need the gradients of the gradients with respect to positions
+        raise ValueError("COMPILE is not supported when fitting forces, since torch.compile does not support double backward")
 
     ARCHITECTURAL_HYPERS.D_OUTPUT = 1 # energy is a single scalar
     ARCHITECTURAL_HYPERS.TARGET_TYPE = 'structural'  # energy is structural property
@@ -67,15 +80,7 @@ def main():
     print(len(train_structures))
     print(len(val_structures))
 
-    train_graphs = get_pyg_graphs(train_structures, all_species, ARCHITECTURAL_HYPERS.R_CUT, 
-                                  ARCHITECTURAL_HYPERS.USE_ADDITIONAL_SCALAR_ATTRIBUTES,
-                                  ARCHITECTURAL_HYPERS.USE_LONG_RANGE,
-                                  ARCHITECTURAL_HYPERS.K_CUT)
-    val_graphs = get_pyg_graphs(val_structures, all_species, ARCHITECTURAL_HYPERS.R_CUT,
-                                ARCHITECTURAL_HYPERS.USE_ADDITIONAL_SCALAR_ATTRIBUTES,
-                                ARCHITECTURAL_HYPERS.USE_LONG_RANGE,
-                                ARCHITECTURAL_HYPERS.K_CUT)
-
+    train_targets, val_targets = {}, {}
     if MLIP_SETTINGS.USE_ENERGIES:
         self_contributions = get_self_contributions(MLIP_SETTINGS.ENERGY_KEY, train_structures, all_species)
         np.save(f'results/{NAME_OF_CALCULATION}/self_contributions.npy', self_contributions)
@@ -83,23 +88,35 @@ def main():
         train_energies = get_corrected_energies(MLIP_SETTINGS.ENERGY_KEY, train_structures, all_species, self_contributions)
         val_energies = get_corrected_energies(MLIP_SETTINGS.ENERGY_KEY, val_structures, all_species, self_contributions)
 
-        update_pyg_graphs(train_graphs, 'y', train_energies)
-        update_pyg_graphs(val_graphs, 'y', val_energies)
+        train_targets['y'] = train_energies
+        val_targets['y'] = val_energies
 
     if MLIP_SETTINGS.USE_FORCES:
-        train_forces = get_forces(train_structures, MLIP_SETTINGS.FORCES_KEY)
+        train_targets['forces'] = get_forces(train_structures, MLIP_SETTINGS.FORCES_KEY)
         val_forces = get_forces(val_structures, MLIP_SETTINGS.FORCES_KEY)
+        val_targets['forces'] = val_forces
+
+    if MLIP_SETTINGS.USE_VIRIALS:
+        train_targets['virials'] = get_virials(train_structures, MLIP_SETTINGS.VIRIALS_KEY)
+        val_virials = get_virials(val_structures, MLIP_SETTINGS.VIRIALS_KEY)
+        val_targets['virials'] = val_virials
+
+    train_graphs = get_graphs_dataset(train_structures, train_targets, all_species, ARCHITECTURAL_HYPERS, FITTING_SCHEME, 'train')
+    val_graphs = get_graphs_dataset(val_structures, val_targets, all_species, ARCHITECTURAL_HYPERS, FITTING_SCHEME, 'val')
+    val_n_atoms = np.array([len(struc.positions) for struc in val_structures])
 
-        update_pyg_graphs(train_graphs, 'forces', train_forces)
-        update_pyg_graphs(val_graphs, 'forces', val_forces)
+    # only graphs are needed from now on
+    del structures, train_structures, val_structures, train_targets
 
-    train_loader, val_loader = get_data_loaders(train_graphs, val_graphs, FITTING_SCHEME)
+    train_loader, val_loader = get_data_loaders(train_graphs, val_graphs, FITTING_SCHEME, len(all_species))
 
     model = PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species)).to(device)
     model = PETUtilityWrapper(model,
                 FITTING_SCHEME.GLOBAL_AUG)
+    if FITTING_SCHEME.COMPILE:
+        model.enable_compilation(FITTING_SCHEME.COMPILE_SHAPE_BUCKETS)
 
-    model = PETMLIPWrapper(model, MLIP_SETTINGS.USE_ENERGIES, MLIP_SETTINGS.USE_FORCES)
+    model = PETMLIPWrapper(model, MLIP_SETTINGS.USE_ENERGIES, MLIP_SETTINGS.USE_FORCES, MLIP_SETTINGS.USE_VIRIALS)
     if FITTING_SCHEME.MULTI_GPU and torch.cuda.is_available():
         model = DataParallel(model)
         model = model.to(torch.device('cuda:0'))
@@ -109,9 +126,10 @@ def main():
 
     optim = get_optimizer(model, FITTING_SCHEME)
     scheduler = get_scheduler(optim, FITTING_SCHEME)
+    scaler = get_grad_scaler(device, FITTING_SCHEME.MIXED_PRECISION)
 
     if name_to_load is not None:
-        load_checkpoint(model, optim, scheduler, f'results/{name_to_load}/checkpoint')
+        load_checkpoint(model, optim, scheduler, f'results/{name_to_load}/checkpoint', scaler)
 
     history = []
     if MLIP_SETTINGS.USE_ENERGIES:
@@ -120,6 +138,9 @@ def main():
     if MLIP_SETTINGS.USE_FORCES:
         forces_logger = FullLogger(FITTING_SCHEME.SUPPORT_MISSING_VALUES)
 
+    if MLIP_SETTINGS.USE_VIRIALS:
+        virials_logger = FullLogger(FITTING_SCHEME.SUPPORT_MISSING_VALUES)
+
     if MLIP_SETTINGS.USE_FORCES:
         val_forces = torch.cat(val_forces, dim = 0)
 
@@ -132,13 +153,22 @@ def main():
         if FITTING_SCHEME.ENERGIES_LOSS == 'per_structure':
             sliding_energies_rmse = get_rmse(val_energies, np.mean(val_energies))
         else:
-            val_n_atoms = np.array([len(struc.positions) for struc in val_structures])
             val_energies_per_atom = val_energies / val_n_atoms
             sliding_energies_rmse = get_rmse(val_energies_per_atom, np.mean(val_energies_per_atom))
 
         energies_rmse_model_keeper = ModelKeeper()
         energies_mae_model_keeper = ModelKeeper()
 
+    if MLIP_SETTINGS.USE_VIRIALS:
+        # virials follow the normalization of energies
+        val_virials = torch.cat(val_virials, dim = 0).data.cpu().numpy()
+        if FITTING_SCHEME.ENERGIES_LOSS == 'per_atom':
+            val_virials = val_virials / val_n_atoms[:, np.newaxis, np.newaxis]
+        sliding_virials_rmse = get_rmse(val_virials, np.mean(val_virials, axis = 0))
+
+        virials_rmse_model_keeper = ModelKeeper()
+        virials_mae_model_keeper = ModelKeeper()
+
     if MLIP_SETTINGS.USE_ENERGIES and MLIP_SETTINGS.USE_FORCES:
         multiplication_rmse_model_keeper = ModelKeeper()
         multiplication_mae_model_keeper = ModelKeeper()
@@ -152,33 +182,46 @@ def main():
             if not FITTING_SCHEME.MULTI_GPU:
                 batch.to(device)
 
-            predictions_energies, predictions_forces = model(batch, augmentation = True, create_graph = True)
+            with get_autocast(device, FITTING_SCHEME.MIXED_PRECISION):
+                predictions = model(batch, augmentation = True, create_graph = True)
+            predictions_energies, predictions_forces = predictions[:2]
             if FITTING_SCHEME.ENERGIES_LOSS == 'per_atom':
                 predictions_energies = predictions_energies / batch.n_atoms
                 ground_truth_energies = batch.y / batch.n_atoms
             else:
                 ground_truth_energies = batch.y
 
+            if MLIP_SETTINGS.USE_VIRIALS:
+                predictions_virials, ground_truth_virials = get_virials_per_structure(predictions[2], batch,
+                                                                                     FITTING_SCHEME.ENERGIES_LOSS)
+
             if MLIP_SETTINGS.USE_ENERGIES:
                 energies_logger.train_logger.update(predictions_energies, ground_truth_energies)
                 loss_energies = get_loss(predictions_energies, ground_truth_energies, FITTING_SCHEME.SUPPORT_MISSING_VALUES, FITTING_SCHEME.USE_SHIFT_AGNOSTIC_LOSS)
             if MLIP_SETTINGS.USE_FORCES:
                 forces_logger.train_logger.update(predictions_forces, batch.forces)
                 loss_forces = get_loss(predictions_forces, batch.forces, FITTING_SCHEME.SUPPORT_MISSING_VALUES, FITTING_SCHEME.USE_SHIFT_AGNOSTIC_LOSS)
+            if MLIP_SETTINGS.USE_VIRIALS:
+                virials_logger.train_logger.update(predictions_virials, ground_truth_virials)
+                loss_virials = get_loss(predictions_virials, ground_truth_virials, FITTING_SCHEME.SUPPORT_MISSING_VALUES, FITTING_SCHEME.USE_SHIFT_AGNOSTIC_LOSS)
 
             if MLIP_SETTINGS.USE_ENERGIES and MLIP_SETTINGS.USE_FORCES: 
                 loss = FITTING_SCHEME.ENERGY_WEIGHT * loss_energies / (sliding_energies_rmse ** 2) + loss_forces / (sliding_forces_rmse ** 2)
-                loss.backward()
-
             if MLIP_SETTINGS.USE_ENERGIES and (not MLIP_SETTINGS.USE_FORCES):
-                loss_energies.backward()
+                loss = loss_energies
             if MLIP_SETTINGS.USE_FORCES and (not MLIP_SETTINGS.USE_ENERGIES):
-                loss_forces.backward()
+                loss = loss_forces
+            if MLIP_SETTINGS.USE_VIRIALS:
+                loss = loss + FITTING_SCHEME.VIRIALS_WEIGHT * loss_virials / (sliding_virials_rmse ** 2)
+            scaler.scale(loss).backward()
 
             if FITTING_SCHEME.DO_GRADIENT_CLIPPING:
+                # gradients are unscaled before clipping, so that the max norm applies to the true gradients
+                scaler.unscale_(optim)
                 torch.nn.utils.clip_grad_norm_(model.parameters(),
                                                max_norm = FITTING_SCHEME.GRADIENT_CLIPPING_MAX_NORM)
-            optim.step()
+            scaler.step(optim)
+            scaler.update()
             optim.zero_grad()
 
         model.train(False)
@@ -186,7 +229,9 @@ def main():
             if not FITTING_SCHEME.MULTI_GPU:
                 batch.to(device)
 
-            predictions_energies, predictions_forces = model(batch, augmentation = False, create_graph = False)
+            with get_autocast(device, FITTING_SCHEME.MIXED_PRECISION):
+                predictions = model(batch, augmentation = False, create_graph = False)
+            predictions_energies, predictions_forces = predictions[:2]
             
             if FITTING_SCHEME.ENERGIES_LOSS == 'per_atom':
                 predictions_energies = predictions_energies / batch.n_atoms
@@ -198,6 +243,9 @@ def main():
                 energies_logger.val_logger.update(predictions_energies, ground_truth_energies)
             if MLIP_SETTINGS.USE_FORCES:
                 forces_logger.val_logger.update(predictions_forces, batch.forces)
+            if MLIP_SETTINGS.USE_VIRIALS:
+                virials_logger.val_logger.update(*get_virials_per_structure(predictions[2], batch,
+                                                                             FITTING_SCHEME.ENERGIES_LOSS))
 
         now = {}
         
@@ -211,6 +259,8 @@ def main():
             
         if MLIP_SETTINGS.USE_FORCES:
             now['forces'] = forces_logger.flush()   
+        if MLIP_SETTINGS.USE_VIRIALS:
+            now['virials'] = virials_logger.flush()
         now['lr'] = scheduler.get_last_lr()
         now['epoch'] = epoch
         now['elapsed_time'] = time.time() - TIME_SCRIPT_STARTED
@@ -227,6 +277,11 @@ def main():
             forces_mae_model_keeper.update(model, now['forces']['val']['mae'], epoch)
             forces_rmse_model_keeper.update(model, now['forces']['val']['rmse'], epoch)    
 
+        if MLIP_SETTINGS.USE_VIRIALS:
+            sliding_virials_rmse = FITTING_SCHEME.SLIDING_FACTOR * sliding_virials_rmse + (1.0 - FITTING_SCHEME.SLIDING_FACTOR) * now['virials']['val']['rmse']
+            virials_mae_model_keeper.update(model, now['virials']['val']['mae'], epoch)
+            virials_rmse_model_keeper.update(model, now['virials']['val']['rmse'], epoch)
+
         if MLIP_SETTINGS.USE_ENERGIES and MLIP_SETTINGS.USE_FORCES:
             multiplication_mae_model_keeper.update(model, now['forces']['val']['mae'] * now[energies_key]['val']['mae'], epoch,
                                                    additional_info = [now[energies_key]['val']['mae'], now['forces']['val']['mae']])
@@ -247,6 +302,11 @@ def main():
             train_mae_message += 'forces per component: '
             val_mae_message += f" {now['forces']['val']['mae']}/{now['forces']['val']['rmse']}"
             train_mae_message += f" {now['forces']['train']['mae']}/{now['forces']['train']['rmse']}"
+        if MLIP_SETTINGS.USE_VIRIALS:
+            val_mae_message += '; virials per component: '
+            train_mae_message += '; virials per component: '
+            val_mae_message += f" {now['virials']['val']['mae']}/{now['virials']['val']['rmse']}"
+            train_mae_message += f" {now['virials']['train']['mae']}/{now['virials']['train']['rmse']}"
 
         pbar.set_description(f"lr: {scheduler.get_last_lr()}; " + val_mae_message + train_mae_message)
 
@@ -261,6 +321,7 @@ def main():
                 'model_state_dict': model.state_dict(),
                 'optim_state_dict': optim.state_dict(),
                 'scheduler_state_dict' : scheduler.state_dict(),
+                'scaler_state_dict' : scaler.state_dict(),
                 }, f'results/{NAME_OF_CALCULATION}/checkpoint')
     with open(f'results/{NAME_OF_CALCULATION}/history.pickle', 'wb') as f:
         pickle.dump(history, f)
@@ -283,6 +344,13 @@ def main():
         save_model('best_val_rmse_forces_model', forces_rmse_model_keeper)
         summary += f'best val rmse in forces: {forces_rmse_model_keeper.best_error} at epoch {forces_rmse_model_keeper.best_epoch}\n'
 
+    if MLIP_SETTINGS.USE_VIRIALS:
+        save_model('best_val_mae_virials_model', virials_mae_model_keeper)
+        summary += f'best val mae in virials: {virials_mae_model_keeper.best_error} at epoch {virials_mae_model_keeper.best_epoch}\n'
+
+        save_model('best_val_rmse_virials_model', virials_rmse_model_keeper)
+        summary += f'best val rmse in virials: {virials_rmse_model_keeper.best_error} at epoch {virials_rmse_model_keeper.best_epoch}\n'
+
     if MLIP_SETTINGS.USE_ENERGIES and MLIP_SETTINGS.USE_FORCES:
         save_model('best_val_mae_both_model', multiplication_mae_model_keeper)
         summary += f'best both (multiplication) mae in energies: {multiplication_mae_model_keeper.additional_info[0]} in forces: {multiplication_mae_model_keeper.additional_info[1]} at epoch {multiplication_mae_model_keeper.best_epoch}\n'
@@ -14,10 +14,10 @@ from .hypers import save_hypers, set_hypers_from_files
 from .pet import PET, PETUtilityWrapper
 from .utilities import FullLogger, get_scheduler, load_checkpoint, get_data_loaders
 from .utilities import get_loss, set_reproducibility, get_calc_names
-from .utilities import get_optimizer
+from .utilities import get_optimizer, get_autocast, get_grad_scaler
 from .analysis import adapt_hypers
 import argparse
-from .data_preparation import get_pyg_graphs, update_pyg_graphs, get_targets
+from .data_preparation import get_targets, get_graphs_dataset
 
 def main():
     TIME_SCRIPT_STARTED = time.time()
@@ -63,26 +63,24 @@ def main():
     print(len(train_structures))
     print(len(val_structures))
 
-    train_graphs = get_pyg_graphs(train_structures, all_species, ARCHITECTURAL_HYPERS.R_CUT,
-                                  ARCHITECTURAL_HYPERS.USE_ADDITIONAL_SCALAR_ATTRIBUTES,
-                                  ARCHITECTURAL_HYPERS.USE_LONG_RANGE,
-                                  ARCHITECTURAL_HYPERS.K_CUT)
-    val_graphs = get_pyg_graphs(val_structures, all_species, ARCHITECTURAL_HYPERS.R_CUT,
-                                ARCHITECTURAL_HYPERS.USE_ADDITIONAL_SCALAR_ATTRIBUTES,
-                                ARCHITECTURAL_HYPERS.USE_LONG_RANGE,
-                                ARCHITECTURAL_HYPERS.K_CUT)
-
     train_targets = get_targets(train_structures, GENERAL_TARGET_SETTINGS)
     val_targets = get_targets(val_structures, GENERAL_TARGET_SETTINGS)
 
-    update_pyg_graphs(train_graphs, 'targets', train_targets)
-    update_pyg_graphs(val_graphs, 'targets', val_targets)
+    train_graphs = get_graphs_dataset(train_structures, {'targets' : train_targets}, all_species,
+                                      ARCHITECTURAL_HYPERS, FITTING_SCHEME, 'train')
+    val_graphs = get_graphs_dataset(val_structures, {'targets' : val_targets}, all_species,
+                                    ARCHITECTURAL_HYPERS, FITTING_SCHEME, 'val')
+
+    # only graphs are needed from now on
+    del structures, train_structures, val_structures, train_targets, val_targets
 
-    train_loader, val_loader = get_data_loaders(train_graphs, val_graphs, FITTING_SCHEME)
+    train_loader, val_loader = get_data_loaders(train_graphs, val_graphs, FITTING_SCHEME, len(all_species))
 
     model = PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species)).to(device)
     model = PETUtilityWrapper(model,
                 FITTING_SCHEME.GLOBAL_AUG)
+    if FITTING_SCHEME.COMPILE:
+        model.enable_compilation(FITTING_SCHEME.COMPILE_SHAPE_BUCKETS)
 
     if FITTING_SCHEME.MULTI_GPU and torch.cuda.is_available():
         model = DataParallel(model)
@@ -93,9 +91,10 @@ def main():
 
     optim = get_optimizer(model, FITTING_SCHEME)
     scheduler = get_scheduler(optim, FITTING_SCHEME)
+    scaler = get_grad_scaler(device, FITTING_SCHEME.MIXED_PRECISION)
 
     if name_to_load is not None:
-        load_checkpoint(model, optim, scheduler, f'results/{name_to_load}/checkpoint')
+        load_checkpoint(model, optim, scheduler, f'results/{name_to_load}/checkpoint', scaler)
 
     history = []
     logger = FullLogger(FITTING_SCHEME.SUPPORT_MISSING_VALUES)
@@ -111,14 +110,18 @@ def main():
             if not FITTING_SCHEME.MULTI_GPU:
                 batch.to(device)
 
-            predictions = model(batch, augmentation = True)
+            with get_autocast(device, FITTING_SCHEME.MIXED_PRECISION):
+                predictions = model(batch, augmentation = True)
             logger.train_logger.update(predictions, batch.targets)
             loss  = get_loss(predictions, batch.targets, FITTING_SCHEME.SUPPORT_MISSING_VALUES, FITTING_SCHEME.USE_SHIFT_AGNOSTIC_LOSS)
-            loss.backward()
+            scaler.scale(loss).backward()
             if FITTING_SCHEME.DO_GRADIENT_CLIPPING:
+                # gradients are unscaled before clipping, so that the max norm applies to the true gradients
+                scaler.unscale_(optim)
                 torch.nn.utils.clip_grad_norm_(model.parameters(),
                                                max_norm = FITTING_SCHEME.GRADIENT_CLIPPING_MAX_NORM)
-            optim.step()
+            scaler.step(optim)
+            scaler.update()
             optim.zero_grad()
 
         model.train(False)
@@ -126,7 +129,8 @@ def main():
             if not FITTING_SCHEME.MULTI_GPU:
                 batch.to(device)
 
-            predictions = model(batch, augmentation = False)
+            with get_autocast(device, FITTING_SCHEME.MIXED_PRECISION):
+                predictions = model(batch, augmentation = False)
             logger.val_logger.update(predictions, batch.targets)
 
         now = {}
@@ -159,6 +163,7 @@ def main():
                 'model_state_dict': model.state_dict(),
                 'optim_state_dict': optim.state_dict(),
                 'scheduler_state_dict' : scheduler.state_dict(),
+                'scaler_state_dict' : scaler.state_dict(),
                 }, f'results/{NAME_OF_CALCULATION}/checkpoint')
     with open(f'results/{NAME_OF_CALCULATION}/history.pickle', 'wb') as f:
         pickle.dump(history, f)
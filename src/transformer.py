@@ -5,35 +5,161 @@ from torch import nn
 import torch.nn.functional as F
 
 import copy
+from typing import Dict, List, Optional
 from .utilities import NeverRun
+from .species_layers import get_linear, get_layer_norm, xavier_uniform_, Sequential, Elementwise
+
+def get_packed_index(mask):
+    '''Positions of the tokens which are not padding, mask being True for padding,
+    in the flattened [n_sequences * length] layout'''
+    return torch.nonzero(torch.logical_not(mask.reshape(-1)))[:, 0]
+
+def pack(x, packed_index):
+    '''[n_sequences, length, dim] -> [n_tokens, dim]'''
+    return x.reshape(x.shape[0] * x.shape[1], x.shape[2])[packed_index]
+
+def unpack(x, packed_index, n_sequences : int, length : int):
+    '''[n_tokens, dim] -> [n_sequences, length, dim], with zeros for padding'''
+    result = torch.zeros([n_sequences * length, x.shape[1]], dtype = x.dtype, device = x.device)
+    result = result.index_copy(0, packed_index, x)
+    return result.reshape(n_sequences, length, x.shape[1])
+
+def get_ragged_groups(mask : torch.Tensor, multipliers : torch.Tensor, buckets_per_octave : int) -> Dict[str, torch.Tensor]:
+    '''Groups of sequences of similar lengths, so that the attention over packed 
+    tokens is computed for each group padded only to its own maximal length.
+    Lengths are rounded up to buckets_per_octave sizes per doubling, as 
+    get_shape_bucket does, and sequences with the same rounded length form a group.
+
+    Returns, for the groups concatenated one after another, "gather", the positions 
+    of the packed tokens in the [n_sequences_g, length_g] layout of each group, 
+    "multipliers" of the attention in the same layout, zero for padding, "select",
+    the positions of the packed tokens within the concatenated outputs of the 
+    groups, and "shapes", the numbers of sequences and lengths of the groups, 
+    kept on the host since they define the shapes of the tensors'''
+    device = mask.device
+    lengths = torch.logical_not(mask).sum(dim = 1)
+    offsets = torch.cumsum(lengths, dim = 0) - lengths
+    lengths_host = lengths.cpu()
+    power = torch.pow(2.0, torch.floor(torch.log2(torch.clamp(lengths_host, min = 1).double()))).long()
+    step = torch.clamp(torch.div(power, buckets_per_octave, rounding_mode = 'floor'), min = 1)
+    rounded = torch.div(lengths_host + step - 1, step, rounding_mode = 'floor') * step
+    rounded = torch.where(lengths_host <= buckets_per_octave, lengths_host, rounded)
+
+    gather : List[torch.Tensor] = []
+    group_multipliers : List[torch.Tensor] = []
+    valid : List[torch.Tensor] = []
+    shapes : List[List[int]] = []
+    # sequences without tokens are not attended at all
+    for key in torch.jit.annotate(List[int], torch.unique(rounded[lengths_host > 0]).tolist()):
+        sequences_host = torch.nonzero(rounded == key)[:, 0]
+        length = int(torch.max(lengths_host[sequences_host]))
+        sequences = sequences_host.to(device)
+        slots = torch.arange(length, device = device)
+        valid_now = slots[None, :] < lengths[sequences][:, None]
+        # padding points to the first token of the same sequence
+        gather_now = torch.where(valid_now, offsets[sequences][:, None] + slots[None, :], offsets[sequences][:, None])
+        gather.append(gather_now.reshape(-1))
+        group_multipliers.append(multipliers[sequences, 0, :length].reshape(-1))
+        valid.append(valid_now.reshape(-1))
+        shapes.append([sequences_host.shape[0], length])
+
+    if len(shapes) == 0:
+        empty = torch.zeros([0], dtype = torch.long, device = device)
+        return {'gather' : empty, 'multipliers' : multipliers.new_zeros([0]), 'select' : empty,
+                'shapes' : torch.zeros([0, 2], dtype = torch.long)}
+    gather_all = torch.cat(gather)
+    positions = torch.nonzero(torch.cat(valid))[:, 0]
+    # each packed token is exactly one of the valid positions
+    select = positions[torch.argsort(gather_all[positions])]
+    return {'gather' : gather_all, 'multipliers' : torch.cat(group_multipliers), 'select' : select,
+            'shapes' : torch.tensor(shapes, dtype = torch.long)}
 
 class AttentionBlock(nn.Module):
-    def __init__(self, total_dim, num_heads, dropout = 0.0, epsilon = 1e-15):
+    '''Multi-head self attention with the attention weights multiplied by
+    multipliers and renormalized.
+
+    With implementation == 'explicit' the weights are materialized as in
+    the original PET. With implementation == 'sdpa' the same is expressed as 
+    the softmax of logits + log(multipliers), and computed by 
+    F.scaled_dot_product_attention, which can use the memory-efficient and 
+    flash backends. Both implementations have the same parameters.
+
+    If ragged is given, x consists of the packed tokens of all the sequences, 
+    as returned by pack, and ragged holds the groups of get_ragged_groups. 
+    The attention of each group is computed on its tokens gathered into 
+    [n_sequences_g, length_g], so that neither the linear layers nor the 
+    attention process padding beyond the maximal length of each group.
+
+    If n_species is given, the linear layers have separate weights for each
+    central species, species giving the one of each entry of x'''
+    def __init__(self, total_dim, num_heads, dropout = 0.0, epsilon = 1e-15,
+                 implementation = 'explicit', n_species = None):
         super(AttentionBlock, self).__init__()
         
-        self.input_linear = nn.Linear(total_dim, 3 * total_dim)
+        self.input_linear = get_linear(total_dim, 3 * total_dim, n_species)
         self.dropout = nn.Dropout(dropout)
-        self.output_linear = nn.Linear(total_dim, total_dim)        
+        self.output_linear = get_linear(total_dim, total_dim, n_species)
         
-        nn.init.xavier_uniform_(self.input_linear.weight)
+        xavier_uniform_(self.input_linear)
         nn.init.constant_(self.input_linear.bias, 0.0)
         nn.init.constant_(self.output_linear.bias, 0.0) 
         
         self.num_heads = num_heads
         self.epsilon = epsilon
+        self.dropout_p = dropout
+
+        if implementation not in ['explicit', 'sdpa']:
+            raise ValueError("unknown attention implementation")
+        self.implementation = implementation
         
         if total_dim % num_heads != 0:
             raise ValueError("total dimension is not divisible by the number of heads")
         self.head_dim = total_dim // num_heads        
         self.preconditioning = 1.0 / np.sqrt(self.head_dim)
         
-    def forward(self, x, multipliers = None):
-        initial_shape = x.shape        
-        x = self.input_linear(x)
+    def forward(self, x, multipliers : Optional[torch.Tensor] = None,
+                ragged : Optional[Dict[str, torch.Tensor]] = None, species : Optional[torch.Tensor] = None):
+        x = self.input_linear(x, species)
+        if ragged is not None:
+            x = self.get_ragged_attention(x, ragged)
+        else:
+            x = self.get_attention(x, multipliers)
+        x = self.output_linear(x, species)       
+        return x
+
+    def get_attention(self, x, multipliers : Optional[torch.Tensor]):
+        '''[n_sequences, length, 3 * total_dim] -> [n_sequences, length, total_dim]'''
+        initial_shape = x.shape
         x = x.reshape(initial_shape[0], initial_shape[1], 3, self.num_heads, self.head_dim)
         x = x.permute(2, 0, 3, 1, 4)
         
         queries, keys, values = x[0], x[1], x[2]
+        if self.implementation == 'sdpa':
+            x = self.get_sdpa_attention(queries, keys, values, multipliers)
+        else:
+            x = self.get_explicit_attention(queries, keys, values, multipliers)
+
+        return x.transpose(1, 2).reshape(initial_shape[0], initial_shape[1], self.num_heads * self.head_dim)
+
+    def get_ragged_attention(self, x, ragged : Dict[str, torch.Tensor]):
+        '''[n_tokens, 3 * total_dim] -> [n_tokens, total_dim], group by group'''
+        shapes = torch.jit.annotate(List[List[int]], ragged['shapes'].tolist())
+        sizes = [shape[0] * shape[1] for shape in shapes]
+        # split rather than sliced, so that the backward pass concatenates the 
+        # gradients of the groups instead of adding each of them to zeros
+        gathered = torch.split(x.index_select(0, ragged['gather']), sizes)
+        multipliers = torch.split(ragged['multipliers'], sizes)
+        results : List[torch.Tensor] = []
+        for index in range(len(shapes)):
+            n_sequences, length = shapes[index][0], shapes[index][1]
+            result = self.get_attention(gathered[index].reshape(n_sequences, length, x.shape[1]),
+                                        multipliers[index].reshape(n_sequences, 1, length))
+            results.append(result.reshape(n_sequences * length, result.shape[2]))
+        if len(results) == 0:
+            return x.new_zeros([x.shape[0], self.num_heads * self.head_dim])
+        return torch.cat(results, dim = 0).index_select(0, ragged['select'])
+
+    def get_explicit_attention(self, queries, keys, values, multipliers : Optional[torch.Tensor]):
         alpha = torch.matmul(queries, keys.transpose(-2, -1)) * self.preconditioning       
         alpha = F.softmax(alpha, dim = -1)        
         alpha = self.dropout(alpha)
@@ -42,42 +168,66 @@ class AttentionBlock(nn.Module):
             alpha = alpha * multipliers[:, None, :, :]
             alpha = alpha / (alpha.sum(dim = -1)[..., None] + self.epsilon)            
 
-        x = torch.matmul(alpha, values).transpose(1, 2).reshape(initial_shape)
-        x = self.output_linear(x)       
-        return x
+        return torch.matmul(alpha, values)
+
+    def get_sdpa_attention(self, queries, keys, values, multipliers : Optional[torch.Tensor]):
+        dropout_p = self.dropout_p if self.training else 0.0
+        if multipliers is None:
+            return F.scaled_dot_product_attention(queries, keys, values, dropout_p = dropout_p,
+                                                  scale = self.preconditioning)
+
+        # double where, so that zero multipliers give neither -inf nor nan in the gradients
+        positive = multipliers > 0.0
+        safe_multipliers = torch.where(positive, multipliers, torch.ones_like(multipliers))
+        bias = torch.where(positive, torch.log(safe_multipliers),
+                           torch.full_like(multipliers, float('-inf')))
+
+        # rows with all the multipliers equal to zero are zero in the explicit 
+        # implementation; here they are computed without bias and zeroed afterwards
+        any_positive = torch.any(positive, dim = -1, keepdim = True)
+        bias = torch.where(any_positive, bias, torch.zeros_like(bias))
+
+        x = F.scaled_dot_product_attention(queries, keys, values, attn_mask = bias[:, None, :, :].to(queries.dtype),
+                                           dropout_p = dropout_p, scale = self.preconditioning)
+        return x * any_positive[:, None, :, :].to(x.dtype)
     
     
 class TransformerLayer(torch.nn.Module):
     def __init__(self, d_model, n_heads, dim_feedforward = 512, dropout = 0.0,
-                 activation = F.silu, transformer_type = 'PostLN'):
+                 activation = F.silu, transformer_type = 'PostLN', attention_implementation = 'explicit',
+                 n_species = None):
         
         super(TransformerLayer, self).__init__()
-        self.attention = AttentionBlock(d_model, n_heads, dropout = dropout) 
+        self.attention = AttentionBlock(d_model, n_heads, dropout = dropout,
+                                        implementation = attention_implementation,
+                                        n_species = n_species) 
         
         if transformer_type not in ['PostLN', 'PreLN']:
             raise ValueError("unknown transformer type")
         self.transformer_type = transformer_type
         self.d_model = d_model
-        self.norm_attention = nn.LayerNorm(d_model)
-        self.norm_mlp = nn.LayerNorm(d_model)
+        self.n_species = n_species
+        self.norm_attention = get_layer_norm(d_model, n_species)
+        self.norm_mlp = get_layer_norm(d_model, n_species)
         self.dropout = nn.Dropout(dropout)        
 
         self.activation = activation
         
-        self.mlp = nn.Sequential(nn.Linear(d_model, dim_feedforward),
-                                 self.activation,
-                                 nn.Dropout(dropout),
-                                 nn.Linear(dim_feedforward, d_model),
-                                 nn.Dropout(dropout)) 
+        self.mlp = Sequential(get_linear(d_model, dim_feedforward, n_species),
+                              Elementwise(self.activation),
+                              Elementwise(nn.Dropout(dropout)),
+                              get_linear(dim_feedforward, d_model, n_species),
+                              Elementwise(nn.Dropout(dropout))) 
 
 
-    def forward(self, x, multipliers = None): 
+    def forward(self, x, multipliers : Optional[torch.Tensor] = None,
+                ragged : Optional[Dict[str, torch.Tensor]] = None, species : Optional[torch.Tensor] = None): 
         if self.transformer_type == 'PostLN':
-            x = self.norm_attention(x + self.dropout(self.attention(x, multipliers)))
-            x = self.norm_mlp(x + self.mlp(x))
+            x = self.norm_attention(x + self.dropout(self.attention(x, multipliers, ragged, species)), species)
+            x = self.norm_mlp(x + self.mlp(x, species), species)
         if self.transformer_type == 'PreLN':
-            x = x + self.dropout(self.attention(self.norm_attention(x), multipliers))
-            x = x + self.mlp(self.norm_mlp(x))
+            x = x + self.dropout(self.attention(self.norm_attention(x, species), multipliers, ragged, species))
+            x = x + self.mlp(self.norm_mlp(x, species), species)
         return x
 
 class Transformer(torch.nn.Module):
@@ -87,13 +237,14 @@ class Transformer(torch.nn.Module):
 
         self.final_norm = NeverRun()  # for torchscript
         if trans_layer.transformer_type == 'PreLN':
-            self.final_norm = nn.LayerNorm(trans_layer.d_model)
+            self.final_norm = get_layer_norm(trans_layer.d_model, trans_layer.n_species)
         self.layers = [copy.deepcopy(trans_layer) for _ in range(num_layers)]
         self.layers = nn.ModuleList(self.layers)
 
-    def forward(self, x : torch.Tensor, multipliers = None):  
+    def forward(self, x : torch.Tensor, multipliers : Optional[torch.Tensor] = None,
+                ragged : Optional[Dict[str, torch.Tensor]] = None, species : Optional[torch.Tensor] = None):
         for layer in self.layers:           
-            x = layer(x, multipliers)
+            x = layer(x, multipliers, ragged, species)
         if self.transformer_type == 'PreLN':
-            x = self.final_norm(x)
+            x = self.final_norm(x, species)
         return x
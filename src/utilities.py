@@ -1,11 +1,18 @@
 import os
+import struct
 import random
 import torch
 import numpy as np
 from torch.optim.lr_scheduler import LambdaLR
 from scipy.spatial.transform import Rotation
-from torch_geometric.loader import DataLoader, DataListLoader
+from torch.utils.data import DataLoader
 import copy
+import contextlib
+from typing import List, Optional
+
+from .molecule import PaddingCollater
+from .hypers import validate_mixed_precision
+from .batch_samplers import get_batch_sampler, get_nums, report_padding_fraction, uses_batch_sampler
 
 
 def get_calc_names(all_completed_calcs, current_name):
@@ -225,13 +232,16 @@ def get_scheduler(optim, FITTING_SCHEME):
     return scheduler
 
 
-def load_checkpoint(model, optim, scheduler, checkpoint_path):
+def load_checkpoint(model, optim, scheduler, checkpoint_path, scaler = None):
     checkpoint = torch.load(checkpoint_path)
     model.load_state_dict(checkpoint["model_state_dict"])
     optim.load_state_dict(checkpoint["optim_state_dict"])
     scheduler.load_state_dict(checkpoint["scheduler_state_dict"])
+    # checkpoints written before mixed precision was supported have no scaler
+    if (scaler is not None) and ("scaler_state_dict" in checkpoint.keys()):
+        scaler.load_state_dict(checkpoint["scaler_state_dict"])
 
-def get_data_loaders(train_graphs, val_graphs, FITTING_SCHEME):
+def get_data_loaders(train_graphs, val_graphs, FITTING_SCHEME, n_species):
     def seed_worker(worker_id):
         worker_seed = torch.initial_seed() % 2**32
         numpy.random.seed(worker_seed)
@@ -239,12 +249,27 @@ def get_data_loaders(train_graphs, val_graphs, FITTING_SCHEME):
     g = torch.Generator()
     g.manual_seed(FITTING_SCHEME.RANDOM_SEED)
 
-    if FITTING_SCHEME.MULTI_GPU:
-        train_loader = DataListLoader(train_graphs, batch_size=FITTING_SCHEME.STRUCTURAL_BATCH_SIZE, shuffle=True, worker_init_fn=seed_worker, generator=g)
-        val_loader = DataListLoader(val_graphs, batch_size = FITTING_SCHEME.STRUCTURAL_BATCH_SIZE, shuffle = False, worker_init_fn=seed_worker, generator=g)
+    collater = PaddingCollater(n_species, as_list = FITTING_SCHEME.MULTI_GPU)
+    if uses_batch_sampler(FITTING_SCHEME.USE_BUCKETED_BATCHES, FITTING_SCHEME.MAX_ATOMS_PER_BATCH,
+                          FITTING_SCHEME.MAX_TOKENS_PER_BATCH):
+        # the numbers of neighbors are read from all the graphs, so only when needed
+        train_nums, val_nums = get_nums(train_graphs), get_nums(val_graphs)
+        train_sampler = get_batch_sampler(train_nums, FITTING_SCHEME.STRUCTURAL_BATCH_SIZE, True, 
+                                          FITTING_SCHEME.USE_BUCKETED_BATCHES,
+                                          max_atoms = FITTING_SCHEME.MAX_ATOMS_PER_BATCH,
+                                          max_tokens = FITTING_SCHEME.MAX_TOKENS_PER_BATCH, generator = g)
+        val_sampler = get_batch_sampler(val_nums, FITTING_SCHEME.STRUCTURAL_BATCH_SIZE, False, 
+                                        FITTING_SCHEME.USE_BUCKETED_BATCHES,
+                                        max_atoms = FITTING_SCHEME.MAX_ATOMS_PER_BATCH,
+                                        max_tokens = FITTING_SCHEME.MAX_TOKENS_PER_BATCH)
+        report_padding_fraction(train_nums, FITTING_SCHEME.STRUCTURAL_BATCH_SIZE, train_sampler, 'train')
+        report_padding_fraction(val_nums, FITTING_SCHEME.STRUCTURAL_BATCH_SIZE, val_sampler, 'val')
+        
+        train_loader = DataLoader(train_graphs, batch_sampler=train_sampler, collate_fn=collater, worker_init_fn=seed_worker)
+        val_loader = DataLoader(val_graphs, batch_sampler=val_sampler, collate_fn=collater, worker_init_fn=seed_worker)
     else:
-        train_loader = DataLoader(train_graphs, batch_size=FITTING_SCHEME.STRUCTURAL_BATCH_SIZE, shuffle=True, worker_init_fn=seed_worker, generator=g)
-        val_loader = DataLoader(val_graphs, batch_size = FITTING_SCHEME.STRUCTURAL_BATCH_SIZE, shuffle = False, worker_init_fn=seed_worker, generator=g)
+        train_loader = DataLoader(train_graphs, batch_size=FITTING_SCHEME.STRUCTURAL_BATCH_SIZE, shuffle=True, collate_fn=collater, worker_init_fn=seed_worker, generator=g)
+        val_loader = DataLoader(val_graphs, batch_size = FITTING_SCHEME.STRUCTURAL_BATCH_SIZE, shuffle = False, collate_fn=collater, worker_init_fn=seed_worker, generator=g)
 
     return train_loader, val_loader
 
@@ -257,6 +282,47 @@ def get_optimizer(model, FITTING_SCHEME):
         optim = torch.optim.Adam(model.parameters(), lr = FITTING_SCHEME.INITIAL_LR)
     return optim
 
+def get_autocast_dtype(mixed_precision):
+    mixed_precision = validate_mixed_precision(mixed_precision)
+    if mixed_precision == 'bf16':
+        return torch.bfloat16
+    if mixed_precision == 'fp16':
+        return torch.float16
+    return None
+
+def get_autocast(device, mixed_precision):
+    '''Context for running the model with the given MIXED_PRECISION. 
+    Autocast lowers the precision only of matrix multiplications and similar 
+    operations; the cutoff function, softmax, the sum of predictions over the 
+    layers and the gradients with respect to positions stay in fp32'''
+    dtype = get_autocast_dtype(mixed_precision)
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type = device.type, dtype = dtype)
+
+def get_grad_scaler(device, mixed_precision):
+    '''Loss scaling against underflow of fp16 gradients; 
+    does nothing for other settings'''
+    validate_mixed_precision(mixed_precision)
+    return torch.amp.GradScaler(device.type, enabled = (mixed_precision == 'fp16'))
+
+def warmup(run_model, loader, get_padded_shape = None):
+    '''Runs the model on the first batch or, for compiled models, on the first 
+    batch of each padded shape met in loader, so that all the compilations happen 
+    before the timing. Returns the number of batches run'''
+    if get_padded_shape is None:
+        for batch in loader:
+            run_model(batch)
+            return 1
+        return 0
+    shapes = set()
+    for batch in loader:
+        shape = get_padded_shape(batch)
+        if shape not in shapes:
+            shapes.add(shape)
+            run_model(batch)
+    return len(shapes)
+
 def get_rotational_discrepancy(all_predictions):
     predictions_mean = np.mean(all_predictions, axis=0)
     predictions_discrepancies = all_predictions - predictions_mean[np.newaxis]
@@ -264,43 +330,118 @@ def get_rotational_discrepancy(all_predictions):
     predictions_std = np.sqrt(np.mean(predictions_discrepancies ** 2) * correction)
     return predictions_std
 
-def report_accuracy(all_predictions, ground_truth, target_name,
-                    verbose, specify_per_component,
-                    target_type, n_atoms = None,
-                    support_missing_values = False):
-    predictions_mean = np.mean(all_predictions, axis=0)
-
-    if specify_per_component:
-        specification = "per component"
-    else:
-        specification = ""
-    print(f"{target_name} mae {specification}: {get_mae(predictions_mean, ground_truth, support_missing_values = support_missing_values)}")
-    print(f"{target_name} rmse {specification}: {get_rmse(predictions_mean, ground_truth, support_missing_values=support_missing_values)}")
-
-    if all_predictions.shape[0] > 1:
-        predictions_std = get_rotational_discrepancy(all_predictions)
-        if verbose:
-            print(f"{target_name} rotational discrepancy std {specification}: {predictions_std} ")
-
-    if target_type == 'structural':
-        if len(predictions_mean.shape) == 1:
-            predictions_mean = predictions_mean[:, np.newaxis]
-        if len(ground_truth.shape) == 1:
-            ground_truth = ground_truth[:, np.newaxis]
+class RunningAccuracy:
+    '''Accumulates the errors reported by report_accuracy over several parts
+    of a dataset, so that the predictions are not kept in memory'''
+    def __init__(self, target_name, verbose, specify_per_component,
+                 target_type, support_missing_values = False):
+        self.target_name = target_name
+        self.verbose = verbose
+        self.specify_per_component = specify_per_component
+        self.target_type = target_type
+        self.support_missing_values = support_missing_values
+        self.sums = {}
+        self.n_aug = None
 
-        predictions_mean_per_atom = predictions_mean / n_atoms[:, np.newaxis]
-        ground_truth_per_atom = ground_truth / n_atoms[:, np.newaxis]
+    def add(self, key, value):
+        self.sums[key] = self.sums.get(key, 0.0) + value
 
-        print(f"{target_name} mae per atom {specification}: {get_mae(predictions_mean_per_atom, ground_truth_per_atom, support_missing_values = support_missing_values)}")
-        print(f"{target_name} rmse per atom {specification}: {get_rmse(predictions_mean_per_atom, ground_truth_per_atom, support_missing_values=support_missing_values)}")
+    def add_errors(self, name, predictions, targets):
+        delta = predictions - targets
+        if self.support_missing_values:
+            mask_nan = np.isnan(targets)
+            delta[mask_nan] = 0.0
+            self.add(f"{name} count", np.sum(np.logical_not(mask_nan)))
+        else:
+            self.add(f"{name} count", delta.size)
+        self.add(f"{name} absolute", np.sum(np.abs(delta)))
+        self.add(f"{name} squared", np.sum(delta * delta))
 
+    def add_discrepancies(self, name, all_predictions):
         if all_predictions.shape[0] > 1:
+            discrepancies = all_predictions - np.mean(all_predictions, axis = 0)[np.newaxis]
+            self.add(f"{name} discrepancy count", discrepancies.size)
+            self.add(f"{name} discrepancy squared", np.sum(discrepancies ** 2))
+
+    def update(self, all_predictions, ground_truth, n_atoms = None):
+        self.n_aug = all_predictions.shape[0]
+        predictions_mean = np.mean(all_predictions, axis=0)
+        self.add_errors("total", predictions_mean, ground_truth)
+        self.add_discrepancies("total", all_predictions)
+
+        if self.target_type == 'structural':
+            if len(predictions_mean.shape) == 1:
+                predictions_mean = predictions_mean[:, np.newaxis]
+            if len(ground_truth.shape) == 1:
+                ground_truth = ground_truth[:, np.newaxis]
+            self.add_errors("per atom", predictions_mean / n_atoms[:, np.newaxis], ground_truth / n_atoms[:, np.newaxis])
+
             if len(all_predictions.shape) == 2:
                 all_predictions = all_predictions[:, :, np.newaxis]
-            all_predictions_per_atom = all_predictions / n_atoms[np.newaxis, :, np.newaxis]
-            predictions_std_per_atom = get_rotational_discrepancy(all_predictions_per_atom)
-            if verbose:
-                print(f"{target_name} rotational discrepancy std per atom {specification}: {predictions_std_per_atom} ")
+            self.add_discrepancies("per atom", all_predictions / n_atoms[np.newaxis, :, np.newaxis])
+
+    def report(self):
+        if self.specify_per_component:
+            specification = "per component"
+        else:
+            specification = ""
+
+        names = [("total", "")]
+        if self.target_type == 'structural':
+            names.append(("per atom", " per atom"))
+        for name, suffix in names:
+            count = self.sums[f"{name} count"]
+            print(f"{self.target_name} mae{suffix} {specification}: {self.sums[f'{name} absolute'] / count}")
+            print(f"{self.target_name} rmse{suffix} {specification}: {np.sqrt(self.sums[f'{name} squared'] / count)}")
+            if (self.n_aug > 1) and self.verbose:
+                correction = self.n_aug / (self.n_aug - 1)
+                predictions_std = np.sqrt(self.sums[f"{name} discrepancy squared"] / self.sums[f"{name} discrepancy count"] * correction)
+                print(f"{self.target_name} rotational discrepancy std{suffix} {specification}: {predictions_std} ")
+
+
+def report_accuracy(all_predictions, ground_truth, target_name,
+                    verbose, specify_per_component,
+                    target_type, n_atoms = None,
+                    support_missing_values = False):
+    accuracy = RunningAccuracy(target_name, verbose, specify_per_component,
+                               target_type, support_missing_values = support_missing_values)
+    accuracy.update(all_predictions, ground_truth, n_atoms)
+    accuracy.report()
+
+
+class NpyAppender:
+    '''Writes a .npy file by appending arrays along the first axis, without
+    keeping them in memory. A header of fixed size is reserved at the beginning
+    of the file and filled with the final shape on close'''
+    HEADER_SIZE = 128
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(b' ' * self.HEADER_SIZE)
+        self.dtype = None
+        self.shape = None
+        self.length = 0
+
+    def append(self, array):
+        array = np.ascontiguousarray(array)
+        if self.dtype is None:
+            self.dtype, self.shape = array.dtype, array.shape[1:]
+        if (array.dtype != self.dtype) or (array.shape[1:] != self.shape):
+            raise ValueError("appended arrays should have the same dtype and shape except for the first axis")
+        self.file.write(array.tobytes())
+        self.length += array.shape[0]
+
+    def close(self):
+        dtype = np.dtype(np.float64) if self.dtype is None else self.dtype
+        shape = (self.length,) + (() if self.shape is None else self.shape)
+        header = {'descr' : np.lib.format.dtype_to_descr(dtype), 'fortran_order' : False, 'shape' : shape}
+        # magic string, version and length of the header take 10 bytes
+        header = repr(header).ljust(self.HEADER_SIZE - 10 - 1) + '\n'
+        if len(header) + 10 != self.HEADER_SIZE:
+            raise ValueError("shape is too long for the header")
+        self.file.seek(0)
+        self.file.write(np.lib.format.magic(1, 0) + struct.pack('<H', len(header)) + header.encode('latin1'))
+        self.file.close()
 
 
 class NeverRun(torch.nn.Module):
@@ -310,5 +451,5 @@ class NeverRun(torch.nn.Module):
     def __init__(self):
         super(NeverRun, self).__init__()
 
-    def forward(self, x) -> torch.Tensor:
+    def forward(self, x, species : Optional[torch.Tensor] = None) -> torch.Tensor:
         raise RuntimeError("This model should never be run")
@@ -0,0 +1,142 @@
+import pytest
+import torch
+import numpy as np
+from ase import units
+from ase.build import bulk
+from ase.md.verlet import VelocityVerlet
+from ase.md.velocitydistribution import MaxwellBoltzmannDistribution
+
+from pet import PETCalculator, SingleStructCalculator, BatchedCalculator
+from pet.pet import PET, PETMLIPWrapper, PETUtilityWrapper
+from pet.hypers import set_hypers_from_files, save_hypers
+
+
+def save_model(path):
+    '''Saves a model with random weights in the layout of a calculation folder'''
+    hypers = set_hypers_from_files('hypers_minimal.yaml', '../default_hypers/default_hypers.yaml')
+    ARCHITECTURAL_HYPERS = hypers.ARCHITECTURAL_HYPERS
+    ARCHITECTURAL_HYPERS.D_OUTPUT = 1
+    ARCHITECTURAL_HYPERS.TARGET_TYPE = 'structural'
+    ARCHITECTURAL_HYPERS.TARGET_AGGREGATION = 'sum'
+    ARCHITECTURAL_HYPERS.R_CUT = 3.0
+    hypers.UTILITY_FLAGS.CALCULATION_TYPE = 'mlip'
+    save_hypers(hypers, f'{path}/hypers_used.yaml')
+
+    all_species = np.array([14])
+    np.save(f'{path}/all_species.npy', all_species)
+    np.save(f'{path}/self_contributions.npy', np.array([-1.0]))
+    torch.manual_seed(0)
+    model = PETMLIPWrapper(PETUtilityWrapper(PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species)), True), True, True)
+    torch.save(model.state_dict(), f'{path}/best_val_rmse_both_model_state_dict')
+
+
+def test_ase_calculator(tmp_path):
+    '''Along a molecular dynamics trajectory, PETCalculator should reuse the neighbor
+    list between rebuilds and match SingleStructCalculator'''
+    save_model(tmp_path)
+    structure = bulk('Si', 'diamond', a = 5.43, cubic = True)
+    structure.rattle(0.05, seed = 0)
+    MaxwellBoltzmannDistribution(structure, temperature_K = 3000, rng = np.random.RandomState(0))
+
+    structure.calc = PETCalculator(str(tmp_path), skin = 0.3)
+    reference = SingleStructCalculator(str(tmp_path), use_virials = True)
+
+    dynamics = VelocityVerlet(structure, 2.0 * units.fs)
+    for _ in range(20):
+        dynamics.run(1)
+        energy, forces, virial = reference.forward(structure)
+        assert np.allclose(structure.get_potential_energy(), energy, atol = 1e-4)
+        assert np.allclose(structure.get_forces(), forces, atol = 1e-4)
+        stress = -(virial + virial.T) / (2.0 * structure.get_volume())
+        assert np.allclose(structure.get_stress(voigt = False), stress, atol = 1e-6)
+
+    statistics = structure.calc.get_rebuild_statistics()
+    assert 1 < statistics['n_rebuilds'] < statistics['n_evaluations']
+
+
+@pytest.mark.parametrize("device", ["cpu", pytest.param("cuda", marks = pytest.mark.skipif(
+    not torch.cuda.is_available(), reason = "CUDA is not available"))])
+def test_calculators_on_device(tmp_path, device):
+    '''Calculators should move the batches to the device of the model'''
+    save_model(tmp_path)
+    structure = bulk('Si', 'diamond', a = 5.43, cubic = True)
+    structure.rattle(0.05, seed = 0)
+
+    reference = SingleStructCalculator(str(tmp_path), use_virials = True)
+    calculator = SingleStructCalculator(str(tmp_path), device = device, use_virials = True)
+    for result, expected in zip(calculator.forward(structure), reference.forward(structure)):
+        assert np.allclose(result, expected, atol = 1e-4)
+
+    calculator = BatchedCalculator(str(tmp_path), device = device, use_virials = True)
+    for result, expected in zip(calculator.forward([structure])[0], reference.forward(structure)):
+        assert np.allclose(result, expected, atol = 1e-4)
+
+
+def test_results_cache(tmp_path):
+    '''Repeated geometries should be served from the cache without forward passes,
+    with the same results as the calculators without the cache'''
+    save_model(tmp_path)
+    structure = bulk('Si', 'diamond', a = 5.43, cubic = True)
+    structure.rattle(0.05, seed = 0)
+    displaced = structure.copy()
+    displaced.positions[0] += 0.1
+
+    reference = SingleStructCalculator(str(tmp_path), use_virials = True)
+    calculator = SingleStructCalculator(str(tmp_path), use_virials = True, cache_size = 1)
+    for atoms in [structure, structure, displaced, structure]:
+        for result, expected in zip(calculator.forward(atoms), reference.forward(atoms)):
+            assert np.allclose(result, expected)
+    statistics = calculator.get_cache_statistics()
+    assert (statistics['n_hits'], statistics['n_misses'], statistics['size']) == (1, 3, 1)
+
+    calculator = PETCalculator(str(tmp_path), skin = 0.3, cache_size = 2)
+    for atoms in [structure, displaced, structure, displaced]:
+        atoms = atoms.copy()
+        atoms.calc = calculator
+        energy, forces, virial = reference.forward(atoms)
+        assert np.allclose(atoms.get_potential_energy(), energy, atol = 1e-4)
+        assert np.allclose(atoms.get_forces(), forces, atol = 1e-4)
+        stress = -(virial + virial.T) / (2.0 * atoms.get_volume())
+        assert np.allclose(atoms.get_stress(voigt = False), stress, atol = 1e-6)
+    assert calculator.get_cache_statistics()['n_hits'] == 2
+    assert calculator.get_rebuild_statistics()['n_evaluations'] == 2
+
+
+def test_batched_calculator(tmp_path):
+    '''BatchedCalculator should match SingleStructCalculator for each structure of
+    the list, and the calculators of attached images should evaluate all the
+    outdated images with a single forward pass'''
+    save_model(tmp_path)
+    structures = [bulk('Si', 'diamond', a = 5.43, cubic = True), bulk('Si', 'diamond', a = 5.43),
+                  bulk('Si', 'diamond', a = 5.5, cubic = True).repeat([2, 1, 1])]
+    for index, structure in enumerate(structures):
+        structure.rattle(0.05, seed = index)
+
+    reference = SingleStructCalculator(str(tmp_path), use_virials = True)
+    calculator = BatchedCalculator(str(tmp_path), use_virials = True)
+    for structure, results in zip(structures, calculator.forward(structures)):
+        for result, expected in zip(results, reference.forward(structure)):
+            assert result.shape == expected.shape
+            assert np.allclose(result, expected, atol = 1e-4)
+
+    n_batches = []
+    compute_batch = calculator.compute_batch
+    def count_batches(structures):
+        n_batches.append(len(structures))
+        return compute_batch(structures)
+    calculator.compute_batch = count_batches
+
+    images = [structures[0].copy() for _ in range(5)]
+    calculators = calculator.attach(images)
+    assert len(set(calculators)) == len(images)
+    for step in range(2):
+        for index, image in enumerate(images):
+            image.rattle(0.02, seed = 10 * step + index)
+        # the order of requests of NEB, one image at a time
+        for image in images:
+            energy, forces, virial = reference.forward(image)
+            assert np.allclose(image.get_potential_energy(), energy, atol = 1e-4)
+            assert np.allclose(image.get_forces(), forces, atol = 1e-4)
+            stress = -(virial + virial.T) / (2.0 * image.get_volume())
+            assert np.allclose(image.get_stress(voigt = False), stress, atol = 1e-6)
+    assert n_batches == [len(images), len(images)]
@@ -0,0 +1,88 @@
+import pytest
+import torch
+import ase.io
+
+from pet.pet import PET, PETMLIPWrapper, PETUtilityWrapper
+from pet.transformer import AttentionBlock
+from pet.hypers import load_hypers_from_file
+from pet.molecule import PaddingCollater
+from pet.data_preparation import get_all_species, get_pyg_graphs
+
+
+def get_multipliers(n_batch, n_tokens):
+    multipliers = torch.rand(n_batch, 1, n_tokens, dtype = torch.float64)
+    # padded tokens, and a structure with all the tokens being padded
+    multipliers[:, :, -2:] = 0.0
+    multipliers[0] = 0.0
+    return multipliers.repeat(1, n_tokens, 1)
+
+
+@pytest.mark.parametrize("with_multipliers", [True, False])
+def test_sdpa_attention_parity(with_multipliers):
+    '''The sdpa implementation should give the same outputs and gradients
+    as the explicit one. Gradients with respect to zero multipliers are not compared; 
+    they are zero in the sdpa implementation, which does not matter since the cutoff 
+    function has zero derivative where it is zero'''
+    torch.manual_seed(0)
+    explicit = AttentionBlock(16, 4).double()
+    sdpa = AttentionBlock(16, 4, implementation = 'sdpa').double()
+    sdpa.load_state_dict(explicit.state_dict())
+
+    x = torch.randn(5, 7, 16, dtype = torch.float64)
+    multipliers = get_multipliers(5, 7) if with_multipliers else None
+
+    outputs, gradients = [], []
+    for model in [explicit, sdpa]:
+        x_now = x.clone().requires_grad_(True)
+        inputs = [x_now]
+        multipliers_now = None
+        if multipliers is not None:
+            multipliers_now = multipliers.clone().requires_grad_(True)
+            inputs.append(multipliers_now)
+        output = model(x_now, multipliers_now)
+        outputs.append(output)
+        gradients.append(torch.autograd.grad(torch.sum(output ** 2), inputs))
+
+    assert torch.allclose(outputs[0], outputs[1], atol = 1e-10)
+
+    # multipliers shared by all the queries can be passed as a broadcast view
+    if multipliers is not None:
+        for model, output in zip([explicit, sdpa], outputs):
+            assert torch.allclose(model(x, multipliers[:, :1, :]), output, atol = 1e-10)
+
+    if multipliers is not None:
+        gradients = [[gradient_x, gradient_multipliers[multipliers > 0]]
+                     for gradient_x, gradient_multipliers in gradients]
+    for explicit_gradient, sdpa_gradient in zip(gradients[0], gradients[1]):
+        assert torch.all(torch.isfinite(sdpa_gradient))
+        assert torch.allclose(explicit_gradient, sdpa_gradient, atol = 1e-10)
+
+
+def test_sdpa_pet_parity():
+    '''A model with the sdpa attention should predict the same energies and forces 
+    with the weights of a model with the explicit attention, also after scripting'''
+    torch.manual_seed(0)
+    structures = ase.io.read('../example/methane_val.xyz', index = ':10')
+    all_species = get_all_species(structures)
+    graphs = get_pyg_graphs(structures, all_species, 5.0, False, False, None)
+
+    hypers = load_hypers_from_file('../default_hypers/default_hypers.yaml')
+    ARCHITECTURAL_HYPERS = hypers.ARCHITECTURAL_HYPERS
+    ARCHITECTURAL_HYPERS.D_OUTPUT = 1
+    ARCHITECTURAL_HYPERS.TARGET_TYPE = 'structural'
+    ARCHITECTURAL_HYPERS.TARGET_AGGREGATION = 'sum'
+
+    results = []
+    for implementation in ['explicit', 'sdpa']:
+        ARCHITECTURAL_HYPERS.ATTENTION_IMPLEMENTATION = implementation
+        torch.manual_seed(0)
+        model = PETMLIPWrapper(PETUtilityWrapper(PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species)), False),
+                               True, True)
+        model.eval()
+        batch = PaddingCollater(len(all_species))(graphs)
+        results.append(model(batch, augmentation = False, create_graph = False))
+
+    for explicit_result, sdpa_result in zip(results[0], results[1]):
+        assert torch.allclose(explicit_result, sdpa_result, atol = 1e-5)
+
+    torch.jit.script(PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species)))
@@ -0,0 +1,72 @@
+import pytest
+import torch
+import numpy as np
+
+from pet.batch_samplers import BucketBatchSampler, BudgetBatchSampler, get_padding_fraction, restore_order, report_padding_fraction
+
+
+def test_bucket_batch_sampler():
+    '''Every structure should appear exactly once, and batches should
+    be padded less than batches of consecutive structures'''
+    rng = np.random.default_rng(0)
+    nums = [rng.integers(1, 60, size = rng.integers(1, 20)) for _ in range(100)]
+
+    for shuffle in [True, False]:
+        sampler = BucketBatchSampler(nums, 8, shuffle, generator = torch.Generator().manual_seed(0))
+        batches = list(sampler)
+        assert len(batches) == len(sampler)
+        assert sorted(sum(batches, [])) == list(range(len(nums)))
+        
+        consecutive = [list(range(index, min(index + 8, len(nums)))) for index in range(0, len(nums), 8)]
+        assert get_padding_fraction(nums, batches) < get_padding_fraction(nums, consecutive)
+
+
+def test_restore_order():
+    n_atoms = np.array([2, 1, 3])
+    order = np.array([2, 0, 1])
+    structural = np.array([20.0, 0.0, 10.0])
+    atomic = np.array([20.0, 21.0, 22.0, 0.0, 1.0, 10.0])
+
+    assert np.array_equal(restore_order(structural, order), [0.0, 10.0, 20.0])
+    assert np.array_equal(restore_order(atomic, order, n_atoms), [0.0, 1.0, 10.0, 20.0, 21.0, 22.0])
+
+
+def test_budget_batch_sampler():
+    '''Batches should stay within the budget unless they consist of a single structure'''
+    rng = np.random.default_rng(0)
+    nums = [rng.integers(1, 60, size = rng.integers(1, 40)) for _ in range(100)]
+
+    for bucketed in [True, False]:
+        sampler = BudgetBatchSampler(nums, True, bucketed = bucketed, max_tokens = 1000,
+                                     generator = torch.Generator().manual_seed(0))
+        for epoch in range(2):
+            batches = list(sampler)
+            assert sorted(sum(batches, [])) == list(range(len(nums)))
+            for batch in batches:
+                batch_nums = np.concatenate([nums[index] for index in batch])
+                assert (len(batch) == 1) or (len(batch_nums) * np.max(batch_nums) <= 1000)
+
+        sampler = BudgetBatchSampler(nums, False, bucketed = bucketed, max_atoms = 50)
+        for batch in sampler:
+            assert (len(batch) == 1) or (np.sum([len(nums[index]) for index in batch]) <= 50)
+
+
+def test_report_padding_fraction_keeps_batches():
+    '''Reporting the padding should not change the batches of the following epochs'''
+    rng = np.random.default_rng(0)
+    nums = [rng.integers(1, 60, size = rng.integers(1, 20)) for _ in range(100)]
+
+    def get_samplers():
+        return [BucketBatchSampler(nums, 8, True, generator = torch.Generator().manual_seed(0)),
+                BudgetBatchSampler(nums, True, max_atoms = 50, generator = torch.Generator().manual_seed(0))]
+
+    for sampler, reported in zip(get_samplers(), get_samplers()):
+        report_padding_fraction(nums, 8, reported, 'train')
+        for _ in range(2):
+            assert list(sampler) == list(reported)
+
+
+def test_report_padding_fraction_of_empty_split():
+    for sampler in [BucketBatchSampler([], 8, True), BudgetBatchSampler([], False, max_atoms = 50)]:
+        assert len(sampler) == 0
+        report_padding_fraction([], 8, sampler, 'val')
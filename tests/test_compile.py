@@ -0,0 +1,102 @@
+import copy
+import pytest
+import torch
+import numpy as np
+import ase.io
+
+from pet.pet import PET, PETMLIPWrapper, PETUtilityWrapper, get_shape_bucket, pad_batch_dict
+from pet.hypers import load_hypers_from_file
+from pet.molecule import PaddingCollater, batch_to_dict
+from pet.data_preparation import get_all_species, get_pyg_graphs
+from pet.utilities import warmup
+
+
+def get_batches(batch_size):
+    structures = ase.io.read('../example/methane_val.xyz', index = ':12')
+    all_species = get_all_species(structures)
+    graphs = get_pyg_graphs(structures, all_species, 5.0, False, False, None)
+    loader = torch.utils.data.DataLoader(graphs, batch_size = batch_size,
+                                         collate_fn = PaddingCollater(len(all_species)))
+    return list(loader), len(all_species)
+
+
+def get_model(n_species, target_type = 'structural', **kwargs):
+    hypers = load_hypers_from_file('../default_hypers/default_hypers.yaml')
+    ARCHITECTURAL_HYPERS = hypers.ARCHITECTURAL_HYPERS
+    ARCHITECTURAL_HYPERS.D_OUTPUT = 1
+    ARCHITECTURAL_HYPERS.TARGET_TYPE = target_type
+    ARCHITECTURAL_HYPERS.TARGET_AGGREGATION = 'sum'
+    ARCHITECTURAL_HYPERS.N_GNN_LAYERS = 1
+    ARCHITECTURAL_HYPERS.N_TRANS_LAYERS = 1
+    ARCHITECTURAL_HYPERS.TRANSFORMER_D_MODEL = 16
+    ARCHITECTURAL_HYPERS.TRANSFORMER_DIM_FEEDFORWARD = 32
+    ARCHITECTURAL_HYPERS.HEAD_N_NEURONS = 16
+    for key, value in kwargs.items():
+        setattr(ARCHITECTURAL_HYPERS, key, value)
+    torch.manual_seed(0)
+    return PET(ARCHITECTURAL_HYPERS, 0.0, n_species)
+
+
+def test_shape_bucket():
+    '''Buckets should be not smaller than sizes, with the given number of them per doubling'''
+    sizes = range(1, 1000)
+    buckets = [get_shape_bucket(size, 4) for size in sizes]
+    assert all(bucket >= size for bucket, size in zip(buckets, sizes))
+    assert buckets == sorted(buckets)
+    assert get_shape_bucket(64, 4) == 64
+    assert get_shape_bucket(65, 4) == 80
+    assert len(set(bucket for bucket in buckets if 256 < bucket <= 512)) == 4
+
+
+@pytest.mark.parametrize("target_type", ["structural", "atomic"])
+@pytest.mark.parametrize("kwargs", [{}, {'AVERAGE_POOLING' : True, 'ADD_TOKEN_FIRST' : False, 'ADD_TOKEN_SECOND' : False},
+                                    {'HEADS_CENTRAL_SPECIFIC' : True, 'TRANSFORMERS_CENTRAL_SPECIFIC' : True}])
+def test_padding(target_type, kwargs):
+    '''Padded atoms and neighbors should not change predictions for the actual atoms'''
+    batches, n_species = get_batches(5)
+    model = get_model(n_species, target_type, **kwargs)
+    batch = batches[0]
+    batch_dict = batch_to_dict(batch)
+    n_atoms, length = batch.x.shape[0], batch.x.shape[1]
+    predictions = model(batch_dict)
+    padded_dict = pad_batch_dict(batch_dict, n_atoms + 7, length + 3, n_species, batch.num_graphs)
+    assert padded_dict['x'].shape == (n_atoms + 7, length + 3, 3)
+    padded_predictions = model(padded_dict)
+    if target_type == 'structural':
+        padded_predictions = padded_predictions[:batch.num_graphs]
+    else:
+        padded_predictions = padded_predictions[:n_atoms]
+    assert torch.all(torch.isfinite(padded_predictions))
+    assert torch.allclose(predictions, padded_predictions, atol = 1e-5)
+
+
+def test_compiled_model():
+    '''Compiled energies, forces and gradients with respect to parameters should
+    match the eager ones, with a compilation per padded shape'''
+    batches, n_species = get_batches(5)
+    model = PETMLIPWrapper(PETUtilityWrapper(get_model(n_species), False), True, True)
+    compiled = copy.deepcopy(model)
+    compiled.model.enable_compilation(4)
+
+    torch._dynamo.reset()
+    assert warmup(lambda batch : compiled(batch, False, False), batches, compiled.model.get_padded_shape) == 2
+    for batch in batches:
+        energies, forces = model(batch, False, False)
+        compiled_energies, compiled_forces = compiled(batch, False, False)
+        assert torch.allclose(energies, compiled_energies, atol = 1e-5)
+        assert torch.allclose(forces, compiled_forces, atol = 1e-5)
+
+    for module in [model, compiled]:
+        module.use_forces = False
+        # the same random rotations
+        np.random.seed(0)
+        energies, _ = module(batches[0], True, False)
+        energies.sum().backward()
+    for parameter, compiled_parameter in zip(model.parameters(), compiled.parameters()):
+        if parameter.grad is not None:
+            assert torch.allclose(parameter.grad, compiled_parameter.grad, atol = 1e-5)
+
+    # copies, such as the ones of ModelKeeper, should keep the state dict and compile their own
+    copied = copy.deepcopy(compiled)
+    assert copied.model.compiled_forward is None
+    assert copied.state_dict().keys() == model.state_dict().keys()
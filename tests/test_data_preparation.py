@@ -0,0 +1,91 @@
+import pytest
+import torch
+import numpy as np
+import ase.io
+
+from pet.data_preparation import get_all_species, get_pyg_graphs, update_pyg_graphs
+from pet.graph_cache import GraphCache
+from pet.results_cache import ResultsCache
+
+
+def assert_graphs_equal(first, second):
+    assert len(first) == len(second)
+    for graph_first, graph_second in zip(first, second):
+        assert set(graph_first.keys()) == set(graph_second.keys())
+        for key in graph_first.keys():
+            value_first, value_second = graph_first[key], graph_second[key]
+            if isinstance(value_first, torch.Tensor):
+                assert torch.equal(value_first, value_second), f"{key} is different"
+            else:
+                assert value_first == value_second, f"{key} is different"
+
+
+def test_parallel_graphs_are_identical():
+    '''Graphs built by the process pool should be identical to the serial ones'''
+    structures = ase.io.read('../example/methane_val.xyz', index = ':')
+    all_species = get_all_species(structures)
+
+    serial = get_pyg_graphs(structures, all_species, 5.0, False, False, None)
+    parallel = get_pyg_graphs(structures, all_species, 5.0, False, False, None,
+                              n_workers = 2, chunk_size = 7)
+    assert_graphs_equal(serial, parallel)
+
+
+def test_graphs_cache(tmp_path):
+    '''Cached graphs should be identical to the newly built ones, 
+    and only new structures should be processed'''
+    structures = ase.io.read('../example/methane_val.xyz', index = ':')
+    all_species = get_all_species(structures)
+    expected = get_pyg_graphs(structures, all_species, 5.0, False, False, None)
+
+    cache_dir = str(tmp_path)
+    first = get_pyg_graphs(structures[:50], all_species, 5.0, False, False, None,
+                           cache_dir = cache_dir)
+    second = get_pyg_graphs(structures, all_species, 5.0, False, False, None,
+                            cache_dir = cache_dir)
+    assert_graphs_equal(second, expected)
+
+    cache = GraphCache(cache_dir, all_species, 5.0, False, False, None)
+    keys = cache.get_keys(structures)
+    assert all(graph is not None for graph in cache.load(keys))
+
+    other_cache = GraphCache(cache_dir, all_species, 4.0, False, False, None)
+    assert all(graph is None for graph in other_cache.load(keys))
+
+
+
+def test_graph_cache_duplicated_structures(tmp_path):
+    '''Duplicated structures loaded from the cache should get separate graphs,
+    so that each of them keeps its own target'''
+    structure = ase.io.read('../example/methane_val.xyz', index = 0)
+    structures = [structure, structure.copy(), structure.copy()]
+    all_species = get_all_species(structures)
+    for _ in range(2):
+        graphs = get_pyg_graphs(structures, all_species, 5.0, False, False, None,
+                                cache_dir = str(tmp_path))
+        update_pyg_graphs(graphs, 'y', [torch.FloatTensor([float(index)]) for index in range(3)])
+        assert [graph.y.item() for graph in graphs] == [0.0, 1.0, 2.0]
+
+
+def test_results_cache():
+    '''ResultsCache should evict the least recently used entries and, with
+    positive tolerance, share entries between slightly different geometries'''
+    structures = ase.io.read('../example/methane_val.xyz', index = ':3')
+    cache = ResultsCache(2)
+    keys = [cache.get_key(structure) for structure in structures]
+    cache.save(keys[0], 0)
+    cache.save(keys[1], 1)
+    assert cache.load(keys[0]) == 0
+    cache.save(keys[2], 2)
+    assert cache.load(keys[1]) is None
+    assert cache.load(keys[0]) == 0 and cache.load(keys[2]) == 2
+    statistics = cache.get_statistics()
+    assert (statistics['n_hits'], statistics['n_misses'], statistics['size']) == (3, 1, 2)
+
+    displaced = structures[0].copy()
+    displaced.positions += 1e-9
+    assert cache.get_key(displaced) != keys[0]
+    cache = ResultsCache(2, tolerance = 1e-4)
+    assert cache.get_key(displaced) == cache.get_key(structures[0])
+    displaced.positions += 1e-3
+    assert cache.get_key(displaced) != cache.get_key(structures[0])
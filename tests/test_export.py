@@ -0,0 +1,46 @@
+import torch
+import numpy as np
+import ase.io
+
+from pet.pet import PET, PETMLIPWrapper, PETUtilityWrapper
+from pet.export import ExportedMLIP
+from pet.hypers import load_hypers_from_file
+from pet.molecule import PaddingCollater
+from pet.data_preparation import get_all_species, get_pyg_graphs
+
+
+def test_exported_mlip():
+    '''The frozen scripted module should give the same energies and forces as 
+    PETMLIPWrapper with self contributions, also for periodic structures'''
+    structures = ase.io.read('../example/methane_val.xyz', index = ':3')
+    # periodic images within the cutoff
+    for structure, pbc in zip(structures[1:], [True, [True, False, True]]):
+        structure.set_cell(np.diag([4.0, 4.5, 5.0]))
+        structure.set_pbc(pbc)
+    all_species = get_all_species(structures)
+    self_contributions = np.array([-10.0, -1000.0])
+
+    hypers = load_hypers_from_file('../default_hypers/default_hypers.yaml')
+    ARCHITECTURAL_HYPERS = hypers.ARCHITECTURAL_HYPERS
+    ARCHITECTURAL_HYPERS.D_OUTPUT = 1
+    ARCHITECTURAL_HYPERS.TARGET_TYPE = 'structural'
+    ARCHITECTURAL_HYPERS.TARGET_AGGREGATION = 'sum'
+    ARCHITECTURAL_HYPERS.R_CUT = 3.0
+    torch.manual_seed(0)
+    model = PETMLIPWrapper(PETUtilityWrapper(PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species)), False), True, True)
+    model.eval()
+    exported = ExportedMLIP(model.model.pet_model, all_species, self_contributions, True)
+    exported.eval()
+    exported = torch.jit.freeze(torch.jit.script(exported))
+
+    for structure in structures:
+        graphs = get_pyg_graphs([structure], all_species, 3.0, False, False, None)
+        energy, forces = model(PaddingCollater(len(all_species))(graphs), augmentation = False, create_graph = False)
+        species = np.searchsorted(all_species, structure.numbers)
+        energy = float(energy) + np.sum(self_contributions[species])
+
+        result = exported(torch.tensor(structure.positions), torch.tensor(structure.numbers),
+                          torch.tensor(np.array(structure.cell)), torch.tensor(structure.pbc))
+        assert not result['energy'].requires_grad
+        assert abs(float(result['energy']) - energy) < 1e-4
+        assert np.allclose(result['forces'].numpy(), forces.detach().numpy(), atol = 1e-5)
@@ -0,0 +1,38 @@
+import torch
+
+from pet.pet import assemble_forces
+from pet.molecule import PaddingCollater
+from pet.data_preparation import get_pyg_graphs, get_all_species
+import ase.io
+
+
+def get_dense_forces(gradients, mask, neighbors_index, neighbors_pos):
+    '''The former assembly through the gathered gradients of the reversed edges'''
+    gradients = gradients.masked_fill(mask[:, :, None], 0.0)
+    messaged = gradients[neighbors_index, neighbors_pos].masked_fill(mask[:, :, None], 0.0)
+    return gradients.sum(dim = 1) - messaged.sum(dim = 1)
+
+
+def test_assemble_forces():
+    '''assemble_forces should match the assembly through the reversed edges, 
+    ignore nan in padding and be twice differentiable'''
+    structures = ase.io.read('../example/methane_val.xyz', index = ':5')
+    all_species = get_all_species(structures)
+    graphs = get_pyg_graphs(structures, all_species, 3.0, False, False, None)
+    batch = PaddingCollater(len(all_species))(graphs)
+    mask = batch.mask
+    assert torch.any(mask)
+    neighbors_index = batch.neighbors_index.transpose(0, 1)
+
+    torch.manual_seed(0)
+    gradients = torch.randn(batch.x.shape, dtype = torch.float64)
+    expected = get_dense_forces(gradients, mask, neighbors_index, batch.neighbors_pos)
+    gradients[mask] = float('nan')
+    forces = assemble_forces(gradients, mask, neighbors_index)
+    assert torch.allclose(forces, expected)
+    # forces of the whole batch sum up to zero
+    assert torch.allclose(forces.sum(dim = 0), torch.zeros(3, dtype = torch.float64))
+
+    gradients = torch.randn(batch.x.shape, dtype = torch.float64, requires_grad = True)
+    assert torch.autograd.gradgradcheck(lambda gradients : assemble_forces(gradients, mask, neighbors_index),
+                                        [gradients])
@@ -0,0 +1,68 @@
+import pytest
+import torch
+import ase.io
+
+from pet.pet import PET, PETMLIPWrapper, PETUtilityWrapper, get_geometry
+from pet.hypers import load_hypers_from_file, validate_mixed_precision
+from pet.molecule import PaddingCollater, batch_to_dict
+from pet.data_preparation import get_all_species, get_pyg_graphs
+from pet.utilities import get_autocast, get_grad_scaler
+
+
+def get_model_and_batch(attention_implementation):
+    structures = ase.io.read('../example/methane_val.xyz', index = ':10')
+    all_species = get_all_species(structures)
+    graphs = get_pyg_graphs(structures, all_species, 5.0, False, False, None)
+    batch = PaddingCollater(len(all_species))(graphs)
+
+    hypers = load_hypers_from_file('../default_hypers/default_hypers.yaml')
+    ARCHITECTURAL_HYPERS = hypers.ARCHITECTURAL_HYPERS
+    ARCHITECTURAL_HYPERS.D_OUTPUT = 1
+    ARCHITECTURAL_HYPERS.TARGET_TYPE = 'structural'
+    ARCHITECTURAL_HYPERS.TARGET_AGGREGATION = 'sum'
+    ARCHITECTURAL_HYPERS.ATTENTION_IMPLEMENTATION = attention_implementation
+    torch.manual_seed(0)
+    model = PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species))
+    return PETMLIPWrapper(PETUtilityWrapper(model, False), True, True), batch
+
+
+@pytest.mark.parametrize("attention_implementation", ["explicit", "sdpa"])
+def test_bf16_autocast(attention_implementation):
+    '''Under bf16 autocast, energies, forces and the cutoff function should stay in fp32,
+    with predictions close to the full precision ones'''
+    model, batch = get_model_and_batch(attention_implementation)
+    model.eval()
+    device = torch.device('cpu')
+    energies, forces = model(batch, augmentation = False, create_graph = False)
+    with get_autocast(device, 'bf16'):
+        energies_bf16, forces_bf16 = model(batch, augmentation = False, create_graph = False)
+        batch_dict = batch_to_dict(batch)
+        geometry = get_geometry(batch_dict['x'], batch_dict['mask'], 5.0, 0.2)
+
+    assert energies_bf16.dtype == torch.float32
+    assert forces_bf16.dtype == torch.float32
+    assert geometry['multipliers'].dtype == torch.float32
+    assert torch.allclose(energies_bf16, energies, atol = 0.05 * float(torch.max(torch.abs(energies))))
+    assert torch.allclose(forces_bf16, forces, atol = 0.05 * float(torch.max(torch.abs(forces))))
+
+
+def test_fp16_grad_scaler():
+    '''A step with the scaled loss should give the same update of parameters as without scaling'''
+    device = torch.device('cpu')
+    for function in [validate_mixed_precision, lambda value: get_grad_scaler(device, value)]:
+        with pytest.raises(ValueError):
+            function('fp8')
+
+    results = []
+    for mixed_precision in [None, 'fp16']:
+        model, batch = get_model_and_batch("explicit")
+        model.train()
+        optim = torch.optim.SGD(model.parameters(), lr = 1e-3)
+        scaler = get_grad_scaler(device, mixed_precision)
+        energies, forces = model(batch, augmentation = False, create_graph = True)
+        loss = torch.mean(energies ** 2) + torch.mean(forces ** 2)
+        scaler.scale(loss).backward()
+        scaler.step(optim)
+        scaler.update()
+        results.append(torch.cat([parameter.detach().flatten() for parameter in model.parameters()]))
+    assert torch.allclose(results[0], results[1], atol = 1e-6)
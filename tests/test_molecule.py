@@ -0,0 +1,47 @@
+import pytest
+import numpy as np
+import ase.io
+import ase.neighborlist
+from ase.build import bulk
+
+from pet.molecule import Molecule
+
+
+def get_neighbors_pos_naive(atoms, r_cut):
+    '''Reference implementation scanning the neighbors of j for every pair (i, j)'''
+    i_list, j_list, S_list = ase.neighborlist.neighbor_list('ijS', atoms, r_cut)
+    neighbors_index = [[] for _ in range(len(atoms))]
+    neighbors_shift = [[] for _ in range(len(atoms))]
+    for i, j, S in zip(i_list, j_list, S_list):
+        neighbors_index[i].append(j)
+        neighbors_shift[i].append(S)
+
+    neighbors_pos = [[] for _ in range(len(atoms))]
+    for i, j, S in zip(i_list, j_list, S_list):
+        for k in range(len(neighbors_index[j])):
+            if (neighbors_index[j][k] == i) and np.all(neighbors_shift[j][k] == -S):
+                neighbors_pos[i].append(k)
+    return neighbors_pos
+
+
+def get_test_structures():
+    structures = ase.io.read('../example/methane_test.xyz', index = ':5')
+    periodic = bulk('Si', 'diamond', a = 5.43)
+    periodic.rattle(0.05, seed = 0)
+    structures.append(periodic)
+    supercell = bulk('Cu', 'fcc', a = 3.6, cubic = True).repeat((2, 2, 2))
+    supercell.rattle(0.05, seed = 0)
+    structures.append(supercell)
+    return structures
+
+
+@pytest.mark.parametrize("r_cut", [1.5, 5.0])
+def test_neighbors_pos(r_cut):
+    '''Compare neighbors_pos to the naive implementation with python loops'''
+    for structure in get_test_structures():
+        molecule = Molecule(structure, r_cut, False, False, None)
+        expected = get_neighbors_pos_naive(structure, r_cut)
+        assert len(molecule.offsets) == len(expected) + 1
+        for i, second in enumerate(expected):
+            first = molecule.neighbors_pos[molecule.offsets[i] : molecule.offsets[i + 1]]
+            assert list(first) == list(second), "neighbors_pos is not correct"
@@ -0,0 +1,54 @@
+import pytest
+import torch
+import numpy as np
+import ase.neighborlist
+from ase import Atoms
+from ase.build import bulk, molecule, fcc111
+
+from pet.neighbor_list import get_neighbor_list, get_neighbors_pos
+from pet.molecule import get_neighbors_pos as get_neighbors_pos_numpy
+
+
+def get_structures():
+    structures = []
+    structures.append(bulk('Cu', 'fcc', a = 3.6).repeat((3, 3, 3)))
+    # cells smaller than the cutoff, requiring several periodic images
+    structures.append(bulk('Si', 'diamond', a = 5.43))
+    structures.append(bulk('Mg', 'hcp', a = 3.2))
+    structures.append(molecule('C6H6'))
+    structures.append(fcc111('Pt', size = (3, 3, 4), vacuum = 6.0))
+    structures.append(Atoms('Cu3', cell = [[3.0, 0.0, 0.0], [1.5, 2.6, 0.0], [0.7, 0.3, 2.9]], pbc = [True, True, False],
+                            scaled_positions = [[0.1, 0.2, 0.3], [0.9, 0.5, -0.4], [1.3, -0.2, 0.1]]))
+    for index, structure in enumerate(structures):
+        structure.rattle(0.05, seed = index)
+    return structures
+
+
+@pytest.mark.parametrize("script", [False, True])
+def test_neighbor_list(script):
+    '''The same pairs with the same shifts and vectors as ASE should be found'''
+    function = torch.jit.script(get_neighbor_list) if script else get_neighbor_list
+    for structure in get_structures():
+        for r_cut in [3.0, 5.0, 7.0]:
+            i, j, D, S = ase.neighborlist.neighbor_list('ijDS', structure, r_cut)
+            expected = {(i_now, j_now, *S_now) : D_now for i_now, j_now, S_now, D_now in zip(i, j, S, D)}
+
+            i, j, D, S = function(torch.tensor(structure.positions), torch.tensor(np.array(structure.cell)),
+                                  torch.tensor(structure.pbc), r_cut)
+            assert torch.all(i[1:] >= i[:-1])
+            result = {(i_now, j_now, *S_now) : D_now for i_now, j_now, S_now, D_now 
+                      in zip(i.numpy(), j.numpy(), S.numpy(), D.numpy())}
+            assert len(result) == len(i)
+            assert set(result.keys()) == set(expected.keys())
+            for key in expected.keys():
+                assert np.allclose(result[key], expected[key])
+
+
+def test_neighbors_pos():
+    '''Positions of the reverse pairs should match the ones of the numpy implementation'''
+    for structure in get_structures():
+        i, j, D, S = get_neighbor_list(torch.tensor(structure.positions), torch.tensor(np.array(structure.cell)),
+                                       torch.tensor(structure.pbc), 5.0)
+        expected = get_neighbors_pos_numpy(i.numpy(), j.numpy(), S.numpy(), len(structure))
+        result = torch.jit.script(get_neighbors_pos)(i, j, S, len(structure))
+        assert np.array_equal(result.numpy(), expected)
@@ -0,0 +1,62 @@
+import pytest
+import torch
+import numpy as np
+import ase.io
+
+from pet.pet import PET, PETMLIPWrapper, PETUtilityWrapper
+from pet.hypers import load_hypers_from_file
+from pet.molecule import PaddingCollater
+from pet.data_preparation import get_all_species, get_pyg_graphs
+
+onnxruntime = pytest.importorskip("onnxruntime")
+from pet.onnx_backend import export_onnx, ONNXModel
+
+
+def get_batches(all_species, r_cut):
+    structures = ase.io.read('../example/methane_val.xyz', index = ':10')
+    # two molecules close to each other, with more neighbors than in the other batches
+    dimer = structures[0].copy()
+    shifted = structures[1].copy()
+    shifted.positions += np.array([2.5, 0.0, 0.0])
+    dimer.extend(shifted)
+    graphs = get_pyg_graphs(structures + [dimer], all_species, r_cut, False, False, None)
+    collater = PaddingCollater(len(all_species))
+    return [collater(graphs[:7]), collater(graphs[7:10]), collater(graphs[10:])]
+
+
+def test_onnx_model(tmp_path):
+    '''Energies and forces of the exported model run by onnxruntime should match
+    the ones of PETMLIPWrapper for batches of different numbers of atoms and of 
+    neighbors, with and without rotational augmentations'''
+    hypers = load_hypers_from_file('../default_hypers/default_hypers.yaml')
+    ARCHITECTURAL_HYPERS = hypers.ARCHITECTURAL_HYPERS
+    ARCHITECTURAL_HYPERS.D_OUTPUT = 1
+    ARCHITECTURAL_HYPERS.TARGET_TYPE = 'structural'
+    ARCHITECTURAL_HYPERS.TARGET_AGGREGATION = 'sum'
+    ARCHITECTURAL_HYPERS.R_CUT = 3.0
+    ARCHITECTURAL_HYPERS.N_GNN_LAYERS = 2
+    ARCHITECTURAL_HYPERS.N_TRANS_LAYERS = 1
+    ARCHITECTURAL_HYPERS.TRANSFORMER_D_MODEL = 16
+    ARCHITECTURAL_HYPERS.TRANSFORMER_DIM_FEEDFORWARD = 32
+    ARCHITECTURAL_HYPERS.HEAD_N_NEURONS = 16
+    hypers.UTILITY_FLAGS.CALCULATION_TYPE = 'mlip'
+    hypers.FITTING_SCHEME.GLOBAL_AUG = False
+
+    all_species = np.array([1, 6])
+    torch.manual_seed(0)
+    model = PETMLIPWrapper(PETUtilityWrapper(PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species)), False), True, True)
+    model.eval()
+    path = str(tmp_path / 'model.onnx')
+    export_onnx(model.model.pet_model, path, True)
+    onnx_model = ONNXModel(path, hypers)
+
+    batches = get_batches(all_species, ARCHITECTURAL_HYPERS.R_CUT)
+    assert len(set(batch.x.shape[1] for batch in batches)) > 1
+    for batch in batches:
+        for augmentation in [False, True]:
+            np.random.seed(0)
+            energies, forces = model(batch, augmentation, False)
+            np.random.seed(0)
+            onnx_energies, onnx_forces = onnx_model(batch, augmentation)
+            assert torch.allclose(energies, onnx_energies, atol = 1e-4)
+            assert torch.allclose(forces, onnx_forces, atol = 1e-4)
@@ -0,0 +1,131 @@
+import pytest
+import torch
+import ase.io
+from torch_geometric.data import Batch
+
+from pet.pet import PET, PETMLIPWrapper, PETUtilityWrapper
+from pet.hypers import load_hypers_from_file
+from pet.molecule import pad_graph, PaddingCollater
+from pet.transformer import get_packed_index, get_ragged_groups, pack
+from pet.data_preparation import get_all_species, get_pyg_graphs
+
+
+def test_per_batch_padding():
+    '''Predictions should not depend on the number of padded neighbors,
+    so that batches can be padded to their own maximal number of neighbors'''
+    torch.manual_seed(0)
+    structures = ase.io.read('../example/methane_val.xyz', index = ':10')
+    all_species = get_all_species(structures)
+    graphs = get_pyg_graphs(structures, all_species, 5.0, False, False, None)
+
+    hypers = load_hypers_from_file('../default_hypers/default_hypers.yaml')
+    ARCHITECTURAL_HYPERS = hypers.ARCHITECTURAL_HYPERS
+    ARCHITECTURAL_HYPERS.D_OUTPUT = 1
+    ARCHITECTURAL_HYPERS.TARGET_TYPE = 'structural'
+    ARCHITECTURAL_HYPERS.TARGET_AGGREGATION = 'sum'
+    model = PETUtilityWrapper(PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species)), True)
+    model.eval()
+
+    batch = PaddingCollater(len(all_species))(graphs)
+    max_num = int(torch.max(batch.nums))
+    assert batch.x.shape[1] == max_num
+
+    wide_batch = Batch.from_data_list([pad_graph(graph, max_num + 7, len(all_species)) for graph in graphs])
+    with torch.no_grad():
+        predictions = model(batch, None)
+        wide_predictions = model(wide_batch, None)
+    assert torch.allclose(predictions, wide_predictions, atol = 1e-5)
+
+
+
+def test_ragged_groups():
+    '''Groups of the ragged attention should cover every packed token exactly once
+    and be padded less than the whole batch'''
+    torch.manual_seed(0)
+    lengths = torch.cat([torch.randint(0, 40, [50]), torch.LongTensor([0, 40])])
+    mask = torch.arange(40)[None, :] >= lengths[:, None]
+    multipliers = torch.rand([len(lengths), 1, 40]) * torch.logical_not(mask)[:, None, :]
+    ragged = get_ragged_groups(mask, multipliers, 4)
+
+    packed_index = get_packed_index(mask)
+    tokens = pack(torch.randn([len(lengths), 40, 3]), packed_index)
+    assert torch.equal(tokens[ragged['gather']][ragged['select']], tokens)
+    assert torch.equal(pack(multipliers[:, 0, :, None], packed_index)[:, 0],
+                       ragged['multipliers'][ragged['select']])
+
+    shapes = ragged['shapes']
+    assert int(shapes[:, 0].sum()) == int(torch.sum(lengths > 0))
+    assert int(torch.sum(shapes[:, 0] * shapes[:, 1])) < 1.2 * int(lengths.sum())
+
+
+@pytest.mark.parametrize("add_tokens", [True, False])
+@pytest.mark.parametrize("attention_implementation", ['explicit', 'sdpa'])
+def test_ragged_transformer(add_tokens, attention_implementation):
+    '''Energies and forces should not change when the transformers skip padded tokens'''
+    structures = ase.io.read('../example/methane_val.xyz', index = ':10')
+    all_species = get_all_species(structures)
+    # with the small cutoff, hydrogens have fewer neighbors than carbons
+    graphs = get_pyg_graphs(structures, all_species, 1.5, False, False, None)
+    batch = PaddingCollater(len(all_species))(graphs)
+    assert torch.any(batch.mask)
+
+    hypers = load_hypers_from_file('../default_hypers/default_hypers.yaml')
+    ARCHITECTURAL_HYPERS = hypers.ARCHITECTURAL_HYPERS
+    ARCHITECTURAL_HYPERS.D_OUTPUT = 1
+    ARCHITECTURAL_HYPERS.TARGET_TYPE = 'structural'
+    ARCHITECTURAL_HYPERS.TARGET_AGGREGATION = 'sum'
+    ARCHITECTURAL_HYPERS.ADD_TOKEN_FIRST = add_tokens
+    ARCHITECTURAL_HYPERS.ADD_TOKEN_SECOND = add_tokens
+    ARCHITECTURAL_HYPERS.ATTENTION_IMPLEMENTATION = attention_implementation
+    ARCHITECTURAL_HYPERS.R_CUT = 1.5
+
+    results = []
+    for ragged in [False, True]:
+        ARCHITECTURAL_HYPERS.RAGGED_TRANSFORMER = ragged
+        torch.manual_seed(0)
+        model = PETMLIPWrapper(PETUtilityWrapper(PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species)), False),
+                               True, True)
+        model.eval()
+        results.append(model(batch, augmentation = False, create_graph = False))
+
+    for padded_result, ragged_result in zip(results[0], results[1]):
+        assert torch.allclose(padded_result, ragged_result, atol = 1e-5)
+
+    torch.jit.script(PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species)))
+
+
+@pytest.mark.parametrize("add_tokens", [True, False])
+@pytest.mark.parametrize("ragged", [False, True])
+def test_atom_buckets(add_tokens, ragged):
+    '''Energies and forces should not change in double precision when atoms 
+    are split into buckets by numbers of neighbors'''
+    structures = ase.io.read('../example/methane_val.xyz', index = ':10')
+    all_species = get_all_species(structures)
+    graphs = get_pyg_graphs(structures, all_species, 1.5, False, False, None)
+    batch = PaddingCollater(len(all_species))(graphs)
+    batch.x = batch.x.double()
+    
+    hypers = load_hypers_from_file('../default_hypers/default_hypers.yaml')
+    ARCHITECTURAL_HYPERS = hypers.ARCHITECTURAL_HYPERS
+    ARCHITECTURAL_HYPERS.D_OUTPUT = 1
+    ARCHITECTURAL_HYPERS.TARGET_TYPE = 'structural'
+    ARCHITECTURAL_HYPERS.TARGET_AGGREGATION = 'sum'
+    ARCHITECTURAL_HYPERS.ADD_TOKEN_FIRST = add_tokens
+    ARCHITECTURAL_HYPERS.ADD_TOKEN_SECOND = add_tokens
+    ARCHITECTURAL_HYPERS.RAGGED_TRANSFORMER = ragged
+    ARCHITECTURAL_HYPERS.R_CUT = 1.5
+
+    results = []
+    for n_atom_buckets in [None, 2, 3]:
+        ARCHITECTURAL_HYPERS.N_ATOM_BUCKETS = n_atom_buckets
+        torch.manual_seed(0)
+        model = PETMLIPWrapper(PETUtilityWrapper(PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species)).double(), False),
+                               True, True)
+        model.eval()
+        results.append(model(batch, augmentation = False, create_graph = False))
+
+    for bucketed_results in results[1:]:
+        for default_result, bucketed_result in zip(results[0], bucketed_results):
+            assert torch.allclose(default_result, bucketed_result, atol = 1e-12)
+
+    torch.jit.script(PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species)))
@@ -4,6 +4,7 @@ import shutil
 import os
 from pet import SingleStructCalculator
 import ase.io
+import numpy as np
 
 
 def clean():
@@ -55,7 +56,12 @@ def prepare_model():
                                          "hypers_minimal_only_forces.yaml",
                                          "hypers_minimal_only_energies.yaml",
                                          "hypers_minimal_gradient_clipping.yaml",
-                                         "hypers_minimal_loss_per_atom.yaml"])
+                                         "hypers_minimal_loss_per_atom.yaml",
+                                         "hypers_minimal_parallel_preprocessing.yaml",
+                                         "hypers_minimal_sharded_graphs.yaml",
+                                         "hypers_minimal_bucketed_batches.yaml",
+                                         "hypers_minimal_tokens_per_batch.yaml",
+                                         "hypers_minimal_mixed_precision.yaml"])
 def test_pet_train(hypers_path):
     """
     Test the 'pet_train' script for successful execution.
@@ -104,6 +110,108 @@ def test_pet_run(prepare_model):
     assert process.returncode == 0, "pet_run script failed"
 
 
+def test_pet_run_bucketed_batches(prepare_model):
+    """
+    Test that 'pet_run' with bucketed batches, with a budget of atoms per batch 
+    or in the streaming mode saves the same predictions, in the same order, 
+    as with batches of consecutive structures.
+    """
+    model_folder = prepare_model
+    script = "pet_run"
+
+    predictions = {}
+    for name, flags in [("default", []), ("bucketed", ["--bucketed_batches"]),
+                        ("budget", ["--bucketed_batches", "--max_atoms_per_batch=23"]),
+                        ("streaming", ["--streaming", "--streaming_chunk_size=3", "--bucketed_batches"])]:
+        path_save_predictions = f"results/predictions_{name}"
+        os.makedirs(path_save_predictions)
+        args = [
+            "../example/methane_test.xyz",
+            model_folder,
+            "best_val_rmse_both_model",
+            "-1",
+            "7",
+            f"--path_save_predictions={path_save_predictions}",
+        ]
+        process = subprocess.run(
+            [script] + args + flags, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        assert process.returncode == 0, "pet_run script failed"
+        predictions[name] = [np.load(f"{path_save_predictions}/{target}_predicted.npy")
+                             for target in ["energies", "forces"]]
+
+    for name in ["bucketed", "budget", "streaming"]:
+        for default, other in zip(predictions["default"], predictions[name]):
+            assert np.allclose(default, other, atol=1e-5)
+
+
+def test_pet_run_onnx_backend(prepare_model):
+    """
+    Test that 'pet_run' with the onnx backend, which exports the model first,
+    saves the same predictions as with the torch backend.
+    """
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("onnxscript")
+    model_folder = prepare_model
+    predictions = {}
+    for backend in ["torch", "onnx"]:
+        path_save_predictions = f"results/predictions_{backend}"
+        os.makedirs(path_save_predictions)
+        args = [
+            "../example/methane_test.xyz",
+            model_folder,
+            "best_val_rmse_both_model",
+            "-1",
+            "7",
+            f"--path_save_predictions={path_save_predictions}",
+            f"--backend={backend}",
+            "--virials",
+        ]
+        process = subprocess.run(
+            ["pet_run"] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        assert process.returncode == 0, "pet_run script failed"
+        predictions[backend] = [np.load(f"{path_save_predictions}/{target}_predicted.npy")
+                                for target in ["energies", "forces", "virials"]]
+    assert os.path.exists(f"{model_folder}/best_val_rmse_both_model_grad.onnx")
+
+    for torch_predictions, onnx_predictions in zip(predictions["torch"], predictions["onnx"]):
+        assert np.allclose(torch_predictions, onnx_predictions, atol=1e-4)
+
+
+def test_pet_train_virials(tmp_path):
+    """
+    Test fitting on virials, and that 'pet_run --virials' reports their errors
+    and saves them.
+    """
+    clean()
+    paths = []
+    for name in ["train", "val"]:
+        structures = ase.io.read(f"../example/methane_{name}.xyz", index=":")
+        for structure in structures:
+            # for molecules, the virial is the sum of the outer products of positions and forces
+            structure.info["virial"] = np.dot(structure.positions.T, structure.arrays["forces"])
+        paths.append(str(tmp_path / f"{name}.xyz"))
+        ase.io.write(paths[-1], structures)
+
+    process = subprocess.run(
+        ["pet_train"] + paths + ["hypers_minimal_virials.yaml", "../default_hypers/default_hypers.yaml", "test"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    assert process.returncode == 0, "pet_train script failed"
+    assert os.path.exists("results/test/best_val_rmse_virials_model_state_dict")
+
+    process = subprocess.run(
+        ["pet_run", paths[1], "results/test", "best_val_rmse_both_model", "-1", "7",
+         f"--path_save_predictions={tmp_path}", "--virials"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    assert process.returncode == 0, "pet_run script failed"
+    assert "virials" in process.stdout.decode()
+    n_structures = len(ase.io.read(paths[1], index=":"))
+    assert np.load(tmp_path / "virials_predicted.npy").shape == (n_structures, 3, 3)
+
+
 def test_single_struct_calculator(prepare_model):
     """
     Test the SingleStructCalculator class with a prepared model.
@@ -121,6 +229,88 @@ def test_single_struct_calculator(prepare_model):
 
     assert forces.shape == (5, 3), "single_struct_calculator failed"
 
+    single_struct_calculator = SingleStructCalculator(
+        model_folder, use_torch_neighbor_list=True,
+    )
+    energy_torch, forces_torch = single_struct_calculator.forward(structure)
+    assert np.allclose(energy, energy_torch, atol=1e-5)
+    assert np.allclose(forces, forces_torch, atol=1e-5)
+
+    single_struct_calculator = SingleStructCalculator(
+        model_folder, mixed_precision="bf16",
+    )
+    energy_bf16, forces_bf16 = single_struct_calculator.forward(structure)
+    assert forces_bf16.dtype == np.float32
+    assert np.allclose(forces, forces_bf16, atol=0.05 * np.max(np.abs(forces)))
+
+    single_struct_calculator = SingleStructCalculator(
+        model_folder, quantize=True,
+    )
+    energy_int8, forces_int8 = single_struct_calculator.forward(structure)
+    assert np.allclose(forces, forces_int8, atol=0.05 * np.max(np.abs(forces)))
+
+    single_struct_calculator = SingleStructCalculator(
+        model_folder, use_virials=True,
+    )
+    energy_virials, forces_virials, virial = single_struct_calculator.forward(structure)
+    assert np.allclose(forces, forces_virials, atol=1e-5)
+    assert np.allclose(virial, np.dot(structure.positions.T, forces), atol=1e-4)
+
+
+def test_pet_quantization(prepare_model):
+    """
+    Test that 'pet_quantization_report' reports the speedup and the loss of 
+    accuracy of the int8 model, and that 'pet_run' runs it.
+    """
+    model_folder = prepare_model
+    process = subprocess.run(
+        ["pet_quantization_report", "../example/methane_test.xyz", model_folder, "best_val_rmse_both_model"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    assert process.returncode == 0, "pet_quantization_report script failed"
+    output = process.stdout.decode()
+    assert "speedup" in output
+    assert "forces: rmse of int8 predictions from fp32 ones" in output
+
+    process = subprocess.run(
+        ["pet_run", "../example/methane_test.xyz", model_folder, "best_val_rmse_both_model", "-1", "7", "--quantize"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    assert process.returncode == 0, "pet_run script failed"
+
+
+def test_pet_export(prepare_model):
+    """
+    Test that the module written by 'pet_export' loads and runs without
+    importing pet, torch_geometric or ase, and gives the same energies and
+    forces as SingleStructCalculator.
+    """
+    model_folder = prepare_model
+    process = subprocess.run(
+        ["pet_export", model_folder, "best_val_rmse_both_model", "results/exported.pt"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    assert process.returncode == 0, "pet_export script failed"
+
+    structure = ase.io.read("../example/methane_test.xyz", index=0)
+    np.savez("results/inputs.npz", positions=structure.positions, numbers=structure.numbers,
+             cell=np.array(structure.cell), pbc=structure.pbc)
+    code = (
+        "import sys, torch, numpy as np\n"
+        "module = torch.jit.load('results/exported.pt')\n"
+        "inputs = np.load('results/inputs.npz')\n"
+        "result = module(*[torch.tensor(inputs[key]) for key in ['positions', 'numbers', 'cell', 'pbc']])\n"
+        "assert not any(name in sys.modules for name in ['pet', 'torch_geometric', 'ase'])\n"
+        "np.savez('results/outputs.npz', energy=result['energy'].numpy(), forces=result['forces'].numpy())\n"
+    )
+    process = subprocess.run(["python", "-c", code], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert process.returncode == 0, "exported module failed"
+
+    outputs = np.load("results/outputs.npz")
+    energy, forces = SingleStructCalculator(model_folder).forward(structure)
+    assert np.allclose(energy, outputs["energy"], atol=1e-4)
+    assert np.allclose(forces, outputs["forces"], atol=1e-5)
+
 
 @pytest.fixture(scope="session", autouse=True)
 def run_at_the_end(request):
@@ -0,0 +1,61 @@
+import torch
+import ase.io
+
+from pet.pet import PET, PETMLIPWrapper, PETUtilityWrapper
+from pet.hypers import load_hypers_from_file
+from pet.molecule import PaddingCollater
+from pet.data_preparation import get_all_species, get_pyg_graphs
+from pet.species_layers import get_linear, Sequential
+from pet.quantization import QuantizedLinear, QuantizedSpeciesLinear, quantize_linear_layers, quantize
+
+
+def test_quantized_linear():
+    '''int8 layers should be close to the fp32 ones, with gradients with respect
+    to the input given by the dequantized weights'''
+    torch.manual_seed(0)
+    species = torch.LongTensor([0, 0, 0, 2, 2, 2, 2, 2])
+    for n_species in [None, 3]:
+        layers = Sequential(get_linear(16, 32, n_species))
+        x = torch.randn(8, 4, 16)
+        expected = layers(x, species).detach()
+        quantize_linear_layers(layers)
+        assert isinstance(layers[0], QuantizedSpeciesLinear if n_species is not None else QuantizedLinear)
+        assert len(list(layers.parameters())) == 0
+        assert len(layers.state_dict()) == 0
+
+        x.requires_grad = True
+        result = layers(x, species)
+        assert torch.allclose(result, expected, atol = 0.05 * float(torch.max(torch.abs(expected))))
+        result.sum().backward()
+        weight = layers[0].dequantized_weight
+        if n_species is None:
+            assert torch.allclose(x.grad, weight.sum(dim = 0).expand(8, 4, 16), atol = 1e-5)
+        else:
+            assert torch.allclose(x.grad[:3], weight[0].sum(dim = 0).expand(3, 4, 16), atol = 1e-5)
+            assert torch.allclose(x.grad[3:], weight[2].sum(dim = 0).expand(5, 4, 16), atol = 1e-5)
+
+
+def test_quantized_model():
+    '''Energies and forces of the int8 model should be close to the fp32 ones'''
+    structures = ase.io.read('../example/methane_val.xyz', index = ':10')
+    all_species = get_all_species(structures)
+    graphs = get_pyg_graphs(structures, all_species, 5.0, False, False, None)
+    batch = PaddingCollater(len(all_species))(graphs)
+
+    hypers = load_hypers_from_file('../default_hypers/default_hypers.yaml')
+    ARCHITECTURAL_HYPERS = hypers.ARCHITECTURAL_HYPERS
+    ARCHITECTURAL_HYPERS.D_OUTPUT = 1
+    ARCHITECTURAL_HYPERS.TARGET_TYPE = 'structural'
+    ARCHITECTURAL_HYPERS.TARGET_AGGREGATION = 'sum'
+    ARCHITECTURAL_HYPERS.TRANSFORMERS_CENTRAL_SPECIFIC = True
+    torch.manual_seed(0)
+    model = PETMLIPWrapper(PETUtilityWrapper(PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species)), False), True, True)
+    model.eval()
+    quantized = quantize(model)
+    # the initial model is not modified
+    assert len(list(quantized.parameters())) < len(list(model.parameters()))
+
+    energies, forces = model(batch, augmentation = False, create_graph = False)
+    energies_int8, forces_int8 = quantized(batch, augmentation = False, create_graph = False)
+    assert torch.allclose(energies_int8, energies, atol = 0.05 * float(torch.max(torch.abs(energies))))
+    assert torch.allclose(forces_int8, forces, atol = 0.05 * float(torch.max(torch.abs(forces))))
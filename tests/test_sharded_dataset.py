@@ -0,0 +1,32 @@
+import pytest
+import torch
+import ase.io
+
+from pet.data_preparation import get_all_species, get_pyg_graphs, get_forces
+from pet.data_preparation import update_pyg_graphs, write_sharded_graphs
+from pet.molecule import PaddingCollater
+
+
+def test_sharded_dataset(tmp_path):
+    '''Graphs read from memory-mapped shards should be batched
+    identically to the in-memory ones'''
+    structures = ase.io.read('../example/methane_val.xyz', index = ':')
+    all_species = get_all_species(structures)
+    energies = [structure.info['energy'] for structure in structures]
+    forces = get_forces(structures, 'forces')
+
+    graphs = get_pyg_graphs(structures, all_species, 5.0, False, False, None)
+    update_pyg_graphs(graphs, 'y', energies)
+    update_pyg_graphs(graphs, 'forces', forces)
+
+    dataset = write_sharded_graphs(str(tmp_path), structures, {'y' : energies, 'forces' : forces},
+                                   all_species, 5.0, False, False, None, shard_size = 30)
+    assert len(dataset) == len(graphs)
+
+    indices = [0, 29, 30, 31, 99, 57, 3]
+    collater = PaddingCollater(len(all_species))
+    expected = collater([graphs[index] for index in indices])
+    result = collater([dataset[index] for index in indices])
+    for key in expected.keys():
+        if isinstance(expected[key], torch.Tensor):
+            assert torch.equal(expected[key], result[key]), f"{key} is different"
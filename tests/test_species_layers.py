@@ -0,0 +1,78 @@
+import pytest
+import torch
+import ase.io
+
+from pet.pet import PET, PETMLIPWrapper, PETUtilityWrapper
+from pet.species_layers import SpeciesLinear, SpeciesLayerNorm, SpeciesEmbedding
+from pet.hypers import load_hypers_from_file
+from pet.molecule import PaddingCollater, batch_to_dict
+from pet.data_preparation import get_all_species, get_pyg_graphs
+
+
+def test_species_layers():
+    '''Species-specific layers should apply the weights of the species of each entry'''
+    torch.manual_seed(0)
+    # entries in any order, with no entries of species 1
+    species = torch.randint(0, 2, (20,)) * 2
+    # per-entry weights for 7 tokens, and all the species for single rows
+    x = torch.randn(20, 7, 8)
+    layers = [SpeciesLinear(3, 8, 5), SpeciesLinear(3, 8, 5), SpeciesLayerNorm(3, 8), SpeciesEmbedding(3, 4, 5)]
+    for layer in layers[2:]:
+        torch.nn.init.normal_(layer.weight)
+    inputs = [x, x[:, 0], x, torch.randint(0, 4, (20, 7))]
+    
+    for layer, inputs_now in zip(layers, inputs):
+        result = layer(inputs_now, species)
+        for specie in range(3):
+            mask = species == specie
+            if isinstance(layer, SpeciesLinear):
+                expected = torch.nn.functional.linear(inputs_now[mask], layer.weight[specie], layer.bias[specie])
+            if isinstance(layer, SpeciesLayerNorm):
+                expected = torch.nn.functional.layer_norm(inputs_now[mask], [8], layer.weight[specie], layer.bias[specie])
+            if isinstance(layer, SpeciesEmbedding):
+                expected = layer.weight[specie][inputs_now[mask]]
+            assert torch.allclose(result[mask], expected, atol = 1e-6)
+
+
+@pytest.mark.parametrize("ragged", [False, True])
+def test_species_specific_pet(ragged):
+    '''A model with species-specific transformers and heads, with the weights of 
+    all the species equal to the ones of a shared model, should predict the same'''
+    structures = ase.io.read('../example/methane_val.xyz', index = ':10')
+    all_species = get_all_species(structures)
+    graphs = get_pyg_graphs(structures, all_species, 5.0, False, False, None)
+    batch = PaddingCollater(len(all_species))(graphs)
+    
+    hypers = load_hypers_from_file('../default_hypers/default_hypers.yaml')
+    ARCHITECTURAL_HYPERS = hypers.ARCHITECTURAL_HYPERS
+    ARCHITECTURAL_HYPERS.D_OUTPUT = 1
+    ARCHITECTURAL_HYPERS.TARGET_TYPE = 'structural'
+    ARCHITECTURAL_HYPERS.TARGET_AGGREGATION = 'sum'
+    ARCHITECTURAL_HYPERS.BLEND_NEIGHBOR_SPECIES = True
+    ARCHITECTURAL_HYPERS.RAGGED_TRANSFORMER = ragged
+    shared = PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species))
+
+    ARCHITECTURAL_HYPERS.TRANSFORMERS_CENTRAL_SPECIFIC = True
+    ARCHITECTURAL_HYPERS.HEADS_CENTRAL_SPECIFIC = True
+    specific = PET(ARCHITECTURAL_HYPERS, 0.0, len(all_species))
+    
+    state_dict = specific.state_dict()
+    for key, value in shared.state_dict().items():
+        if state_dict[key].shape != value.shape:
+            value = value[None].expand(state_dict[key].shape)
+        state_dict[key] = value
+    specific.load_state_dict(state_dict)
+
+    results = []
+    for model in [shared, specific]:
+        model = PETMLIPWrapper(PETUtilityWrapper(model, False), True, True)
+        model.eval()
+        results.append(model(batch, augmentation = False, create_graph = False))
+
+    for shared_result, specific_result in zip(results[0], results[1]):
+        assert torch.allclose(shared_result, specific_result, atol = 1e-5)
+
+    scripted = torch.jit.script(specific)
+    scripted.eval()
+    energies = scripted(batch_to_dict(batch))[:, 0]
+    assert torch.allclose(energies, results[0][0], atol = 1e-5)
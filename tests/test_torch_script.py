@@ -17,7 +17,8 @@ def test_torch_scriptability():
     'AVERAGE_POOLING',
     'ADD_TOKEN_FIRST', 'ADD_TOKEN_SECOND', 'R_EMBEDDING_ACTIVATION',
     'BLEND_NEIGHBOR_SPECIES', 'AVERAGE_BOND_ENERGIES',
-    'USE_ONLY_LENGTH', 'USE_LENGTH']
+    'USE_ONLY_LENGTH', 'USE_LENGTH',
+    'TRANSFORMERS_CENTRAL_SPECIFIC', 'HEADS_CENTRAL_SPECIFIC']
 
     for key in boolean_architectural_hypers:
         initial_value = ARCHITECTURAL_HYPERS.__dict__[key]
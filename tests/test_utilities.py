@@ -0,0 +1,34 @@
+import numpy as np
+
+from pet.utilities import NpyAppender, RunningAccuracy, get_mae, get_rmse
+
+
+def test_npy_appender(tmp_path):
+    '''Arrays appended in parts should be loaded as a single concatenated array'''
+    rng = np.random.default_rng(0)
+    parts = [rng.normal(size = [n, 3]) for n in [4, 0, 7, 1]]
+    appender = NpyAppender(tmp_path / "values.npy")
+    for part in parts:
+        appender.append(part)
+    appender.close()
+    assert np.array_equal(np.load(tmp_path / "values.npy"), np.concatenate(parts, axis = 0))
+
+
+def test_running_accuracy(capsys):
+    '''Errors accumulated over chunks should match the ones of the whole dataset'''
+    rng = np.random.default_rng(0)
+    all_predictions = rng.normal(size = [3, 10])
+    ground_truth = rng.normal(size = [10])
+    n_atoms = rng.integers(1, 10, size = 10)
+
+    accuracy = RunningAccuracy("energies", True, False, 'structural')
+    for begin in range(0, 10, 4):
+        accuracy.update(all_predictions[:, begin : begin + 4], ground_truth[begin : begin + 4],
+                        n_atoms[begin : begin + 4])
+    accuracy.report()
+    lines = capsys.readouterr().out.split('\n')
+
+    predictions_mean = np.mean(all_predictions, axis = 0)
+    assert np.isclose(float(lines[0].split(':')[-1]), get_mae(predictions_mean, ground_truth))
+    assert np.isclose(float(lines[1].split(':')[-1]), get_rmse(predictions_mean, ground_truth))
+    assert np.isclose(float(lines[4].split(':')[-1]), get_rmse(predictions_mean / n_atoms, ground_truth / n_atoms))
@@ -0,0 +1,74 @@
+import torch
+import numpy as np
+import ase.io
+from ase.build import bulk
+
+from pet.pet import PET, PETMLIPWrapper, PETUtilityWrapper
+from pet.hypers import load_hypers_from_file
+from pet.molecule import PaddingCollater
+from pet.data_preparation import get_pyg_graphs, get_all_species
+
+
+def get_model(n_species):
+    hypers = load_hypers_from_file('../default_hypers/default_hypers.yaml')
+    ARCHITECTURAL_HYPERS = hypers.ARCHITECTURAL_HYPERS
+    ARCHITECTURAL_HYPERS.D_OUTPUT = 1
+    ARCHITECTURAL_HYPERS.TARGET_TYPE = 'structural'
+    ARCHITECTURAL_HYPERS.TARGET_AGGREGATION = 'sum'
+    ARCHITECTURAL_HYPERS.TRANSFORMER_D_MODEL = 32
+    ARCHITECTURAL_HYPERS.TRANSFORMER_DIM_FEEDFORWARD = 64
+    ARCHITECTURAL_HYPERS.HEAD_N_NEURONS = 32
+    ARCHITECTURAL_HYPERS.R_CUT = 3.0
+    torch.manual_seed(0)
+    model = PETMLIPWrapper(PETUtilityWrapper(PET(ARCHITECTURAL_HYPERS, 0.0, n_species).double(), False),
+                           True, True, use_virials = True)
+    model.eval()
+    return model
+
+
+def get_batch(structures, all_species):
+    graphs = get_pyg_graphs(structures, all_species, 3.0, False, False, None)
+    batch = PaddingCollater(len(all_species))(graphs)
+    batch.x = batch.x.double()
+    return batch
+
+
+def test_virials_of_molecules():
+    '''For finite systems, virials should be the sums of the outer products of r_i and F_i over atoms'''
+    structures = ase.io.read('../example/methane_val.xyz', index = ':5')
+    all_species = get_all_species(structures)
+    model = get_model(len(all_species))
+    energies, forces, virials = model(get_batch(structures, all_species), augmentation = False, create_graph = False)
+    assert virials.shape == (len(structures), 3, 3)
+
+    forces = forces.data.numpy()
+    begin = 0
+    for index, structure in enumerate(structures):
+        end = begin + len(structure)
+        expected = np.einsum('ia,ib->ab', structure.positions, forces[begin : end])
+        assert np.allclose(virials[index].data.numpy(), expected, atol = 1e-10)
+        begin = end
+
+
+def test_virials_of_periodic_structures():
+    '''For periodic structures, virials should be minus the derivatives of energies
+    with respect to the strain applied to both the positions and the cell'''
+    structure = bulk('Si', 'diamond', a = 5.43)
+    structure.rattle(0.1, seed = 0)
+    all_species = get_all_species([structure])
+    model = get_model(len(all_species))
+    virial = model(get_batch([structure], all_species), augmentation = False, create_graph = False)[2][0]
+    virial = virial.data.numpy()
+
+    def get_energy(strain):
+        strained = structure.copy()
+        strained.set_cell(np.dot(structure.cell, np.eye(3) + strain), scale_atoms = True)
+        return model(get_batch([strained], all_species), augmentation = False, create_graph = False)[0].item()
+
+    delta = 1e-4
+    for alpha in range(3):
+        for beta in range(3):
+            strain = np.zeros([3, 3])
+            strain[alpha, beta] = delta
+            derivative = (get_energy(strain) - get_energy(-strain)) / (2 * delta)
+            assert np.abs(-derivative - virial[alpha, beta]) < 1e-3 * np.max(np.abs(virial)) + 1e-6